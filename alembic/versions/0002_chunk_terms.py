@@ -0,0 +1,21 @@
+"""chunk term index
+
+Revision ID: 0002_chunk_terms
+Revises: 0001_initial
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002_chunk_terms'
+down_revision = '0001_initial'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_table('chunk_terms', sa.Column('id', sa.Integer(), primary_key=True), sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id')), sa.Column('chunk_id', sa.Integer(), sa.ForeignKey('chunks.id')), sa.Column('term', sa.String(64)), sa.Column('pdf_page_index', sa.Integer()), sa.Column('tf', sa.Integer()))
+    op.create_index('ix_chunk_terms_subject_term_page', 'chunk_terms', ['subject_id', 'term', 'pdf_page_index'])
+
+def downgrade() -> None:
+    op.drop_index('ix_chunk_terms_subject_term_page', table_name='chunk_terms')
+    op.drop_table('chunk_terms')
@@ -0,0 +1,24 @@
+"""chunk embeddings + ANN index
+
+Revision ID: 0003_chunk_embeddings
+Revises: 0002_chunk_terms
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from pgvector.sqlalchemy import Vector
+
+revision = '0003_chunk_embeddings'
+down_revision = '0002_chunk_terms'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('chunks', sa.Column('embedding', Vector(1536), nullable=True))
+    op.create_index('ix_chunks_subject_page', 'chunks', ['subject_id', 'pdf_page_index'])
+    op.execute("CREATE INDEX IF NOT EXISTS ix_chunks_embedding_hnsw ON chunks USING hnsw (embedding vector_cosine_ops)")
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_chunks_embedding_hnsw")
+    op.drop_index('ix_chunks_subject_page', table_name='chunks')
+    op.drop_column('chunks', 'embedding')
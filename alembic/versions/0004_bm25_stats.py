@@ -0,0 +1,23 @@
+"""bm25 corpus statistics
+
+Revision ID: 0004_bm25_stats
+Revises: 0003_chunk_embeddings
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004_bm25_stats'
+down_revision = '0003_chunk_embeddings'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('chunks', sa.Column('token_count', sa.Integer(), nullable=True))
+    op.create_table('term_stats', sa.Column('id', sa.Integer(), primary_key=True), sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id')), sa.Column('content_version', sa.Integer()), sa.Column('term', sa.String(64)), sa.Column('df', sa.Integer()), sa.UniqueConstraint('subject_id', 'content_version', 'term', name='uq_term_stats_subject_version_term'))
+    op.create_table('corpus_stats', sa.Column('id', sa.Integer(), primary_key=True), sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id')), sa.Column('content_version', sa.Integer()), sa.Column('doc_count', sa.Integer()), sa.Column('avg_doc_len', sa.Float()), sa.UniqueConstraint('subject_id', 'content_version', name='uq_corpus_stats_subject_version'))
+
+def downgrade() -> None:
+    op.drop_table('corpus_stats')
+    op.drop_table('term_stats')
+    op.drop_column('chunks', 'token_count')
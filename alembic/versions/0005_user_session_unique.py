@@ -0,0 +1,20 @@
+"""one session row per user
+
+Revision ID: 0005_user_session_unique
+Revises: 0004_bm25_stats
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005_user_session_unique'
+down_revision = '0004_bm25_stats'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.execute(sa.text('DELETE FROM user_sessions WHERE id NOT IN (SELECT MIN(id) FROM user_sessions GROUP BY user_id)'))
+    op.create_unique_constraint('uq_user_sessions_user_id', 'user_sessions', ['user_id'])
+
+def downgrade() -> None:
+    op.drop_constraint('uq_user_sessions_user_id', 'user_sessions', type_='unique')
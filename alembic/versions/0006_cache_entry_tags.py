@@ -0,0 +1,29 @@
+"""cache entry tags for sweeping
+
+Revision ID: 0006_cache_entry_tags
+Revises: 0005_user_session_unique
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006_cache_entry_tags'
+down_revision = '0005_user_session_unique'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('cache_entries', sa.Column('subject_id', sa.Integer(), nullable=True))
+    op.add_column('cache_entries', sa.Column('content_version', sa.Integer(), nullable=True))
+    op.add_column('cache_entries', sa.Column('size_bytes', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('cache_entries', sa.Column('created_at', sa.DateTime(), nullable=True, server_default=sa.func.now()))
+    op.add_column('cache_entries', sa.Column('last_hit_at', sa.DateTime(), nullable=True))
+    op.execute(sa.text('UPDATE cache_entries SET size_bytes = octet_length(value)'))
+    op.create_index('ix_cache_entries_subject_version', 'cache_entries', ['subject_id', 'content_version'])
+    op.create_index('ix_cache_entries_expires_at', 'cache_entries', ['expires_at'])
+
+def downgrade() -> None:
+    op.drop_index('ix_cache_entries_expires_at', 'cache_entries')
+    op.drop_index('ix_cache_entries_subject_version', 'cache_entries')
+    for col in ['last_hit_at', 'created_at', 'size_bytes', 'content_version', 'subject_id']:
+        op.drop_column('cache_entries', col)
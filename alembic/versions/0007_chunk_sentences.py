@@ -0,0 +1,21 @@
+"""precomputed chunk sentences
+
+Revision ID: 0007_chunk_sentences
+Revises: 0006_cache_entry_tags
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0007_chunk_sentences'
+down_revision = '0006_cache_entry_tags'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_table('chunk_sentences', sa.Column('id', sa.Integer(), primary_key=True), sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id')), sa.Column('chunk_id', sa.Integer(), sa.ForeignKey('chunks.id')), sa.Column('position', sa.Integer()), sa.Column('char_offset', sa.Integer()), sa.Column('length', sa.Integer()), sa.Column('norm', sa.Text()), sa.Column('arabic_letters', sa.Integer()), sa.Column('latin_letters', sa.Integer()), sa.Column('is_question', sa.Boolean()))
+    op.create_index('ix_chunk_sentences_chunk_position', 'chunk_sentences', ['chunk_id', 'position'])
+
+def downgrade() -> None:
+    op.drop_index('ix_chunk_sentences_chunk_position', 'chunk_sentences')
+    op.drop_table('chunk_sentences')
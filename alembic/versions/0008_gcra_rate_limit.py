@@ -0,0 +1,21 @@
+"""gcra rate limit state
+
+Revision ID: 0008_gcra_rate_limit
+Revises: 0007_chunk_sentences
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0008_gcra_rate_limit'
+down_revision = '0007_chunk_sentences'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_table('rate_limit_states', sa.Column('user_id', sa.Integer(), primary_key=True), sa.Column('bucket', sa.String(32), primary_key=True), sa.Column('tat', sa.Float()), sa.Column('interval_sec', sa.Float()), sa.Column('window_sec', sa.Float()), sa.Column('allowed', sa.Boolean()))
+    op.drop_table('rate_limit_buckets')
+
+def downgrade() -> None:
+    op.create_table('rate_limit_buckets', sa.Column('id', sa.Integer(), primary_key=True), sa.Column('user_id', sa.Integer()), sa.Column('bucket', sa.String(32)), sa.Column('window_start', sa.DateTime()), sa.Column('count', sa.Integer()))
+    op.drop_table('rate_limit_states')
@@ -0,0 +1,19 @@
+"""per-user per-subject usage counters
+
+Revision ID: 0009_usage_counters
+Revises: 0008_gcra_rate_limit
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0009_usage_counters'
+down_revision = '0008_gcra_rate_limit'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_table('usage_counters', sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), primary_key=True), sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id'), primary_key=True), sa.Column('count', sa.Integer(), nullable=False, server_default='0'))
+
+def downgrade() -> None:
+    op.drop_table('usage_counters')
@@ -0,0 +1,23 @@
+"""page fingerprints and page-range cache tags for incremental reindex
+
+Revision ID: 0010_page_fingerprints
+Revises: 0009_usage_counters
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0010_page_fingerprints'
+down_revision = '0009_usage_counters'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.create_table('page_fingerprints', sa.Column('subject_id', sa.Integer(), sa.ForeignKey('subjects.id'), primary_key=True), sa.Column('pdf_page_index', sa.Integer(), primary_key=True), sa.Column('digest', sa.String(64), nullable=False))
+    op.add_column('cache_entries', sa.Column('page_start', sa.Integer(), nullable=True))
+    op.add_column('cache_entries', sa.Column('page_end', sa.Integer(), nullable=True))
+
+def downgrade() -> None:
+    op.drop_column('cache_entries', 'page_end')
+    op.drop_column('cache_entries', 'page_start')
+    op.drop_table('page_fingerprints')
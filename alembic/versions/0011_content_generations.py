@@ -0,0 +1,37 @@
+"""content generations: tag content rows with content_version
+
+Revision ID: 0011_content_generations
+Revises: 0010_page_fingerprints
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0011_content_generations'
+down_revision = '0010_page_fingerprints'
+branch_labels = None
+depends_on = None
+
+_TABLES = ['toc_items', 'chunks', 'chunk_terms', 'lesson_embeddings']
+
+def upgrade() -> None:
+    for table in _TABLES:
+        op.add_column(table, sa.Column('content_version', sa.Integer(), nullable=True))
+        # Existing rows are the subject's live generation.
+        op.execute(sa.text(f'UPDATE {table} SET content_version = (SELECT s.content_version FROM subjects s WHERE s.id = {table}.subject_id)'))
+        op.execute(sa.text(f'UPDATE {table} SET content_version = 1 WHERE content_version IS NULL'))
+        op.alter_column(table, 'content_version', nullable=False, server_default='1')
+    op.drop_index('ix_chunks_subject_page', table_name='chunks')
+    op.create_index('ix_chunks_subject_version_page', 'chunks', ['subject_id', 'content_version', 'pdf_page_index'])
+    op.drop_index('ix_chunk_terms_subject_term_page', table_name='chunk_terms')
+    op.create_index('ix_chunk_terms_subject_version_term_page', 'chunk_terms', ['subject_id', 'content_version', 'term', 'pdf_page_index'])
+    op.create_index('ix_toc_items_subject_version', 'toc_items', ['subject_id', 'content_version'])
+
+def downgrade() -> None:
+    op.drop_index('ix_toc_items_subject_version', table_name='toc_items')
+    op.drop_index('ix_chunk_terms_subject_version_term_page', table_name='chunk_terms')
+    op.create_index('ix_chunk_terms_subject_term_page', 'chunk_terms', ['subject_id', 'term', 'pdf_page_index'])
+    op.drop_index('ix_chunks_subject_version_page', table_name='chunks')
+    op.create_index('ix_chunks_subject_page', 'chunks', ['subject_id', 'pdf_page_index'])
+    for table in reversed(_TABLES):
+        op.drop_column(table, 'content_version')
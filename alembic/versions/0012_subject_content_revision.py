@@ -0,0 +1,19 @@
+"""subject content revision for cross-process cache invalidation
+
+Revision ID: 0012_subject_content_revision
+Revises: 0011_content_generations
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0012_subject_content_revision'
+down_revision = '0011_content_generations'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('subjects', sa.Column('content_revision', sa.Integer(), nullable=False, server_default='0'))
+
+def downgrade() -> None:
+    op.drop_column('subjects', 'content_revision')
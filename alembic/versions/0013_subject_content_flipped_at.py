@@ -0,0 +1,19 @@
+"""record when a subject's content generation flipped
+
+Revision ID: 0013_subject_content_flipped_at
+Revises: 0012_subject_content_revision
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0013_subject_content_flipped_at'
+down_revision = '0012_subject_content_revision'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    op.add_column('subjects', sa.Column('content_flipped_at', sa.DateTime(), nullable=True))
+
+def downgrade() -> None:
+    op.drop_column('subjects', 'content_flipped_at')
@@ -0,0 +1,21 @@
+"""byte-accurate cache entry sizes and an index for the LRU sweep
+
+Revision ID: 0014_cache_entry_lru_index
+Revises: 0013_subject_content_flipped_at
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0014_cache_entry_lru_index'
+down_revision = '0013_subject_content_flipped_at'
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # 0006 backfilled characters, not bytes; match _entry_fields (UTF-8 size of the value).
+    op.execute(sa.text('UPDATE cache_entries SET size_bytes = octet_length(value)'))
+    op.create_index('ix_cache_entries_lru', 'cache_entries', [sa.text('coalesce(last_hit_at, created_at)'), 'id'])
+
+def downgrade() -> None:
+    op.drop_index('ix_cache_entries_lru', 'cache_entries')
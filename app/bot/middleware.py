@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.services.users import UserContext, load_user_context_async
+
+
+class IdentityCache:
+    """Per-process ``telegram_id -> UserContext`` map with a short TTL and LRU bound.
+
+    Handlers that change the session write through with ``put`` so the next update
+    sees the new selection without a round trip.
+    """
+
+    def __init__(self, ttl_sec: float, max_size: int):
+        self.ttl_sec = ttl_sec
+        self.max_size = max_size
+        self._items: OrderedDict[int, tuple[float, UserContext]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id: int) -> UserContext | None:
+        hit = self._items.get(tg_id)
+        if hit is None or hit[0] <= time.monotonic():
+            if hit is not None:
+                del self._items[tg_id]
+            self.misses += 1
+            return None
+        self._items.move_to_end(tg_id)
+        self.hits += 1
+        return hit[1]
+
+    def put(self, ctx: UserContext) -> UserContext:
+        self._items[ctx.telegram_id] = (time.monotonic() + self.ttl_sec, ctx)
+        self._items.move_to_end(ctx.telegram_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return ctx
+
+
+identity_cache = IdentityCache(settings.BOT_IDENTITY_TTL_SEC, settings.BOT_IDENTITY_CACHE_SIZE)
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Injects ``ctx: UserContext`` for the update's sender into handler kwargs."""
+
+    def __init__(self, cache: IdentityCache = identity_cache, session_factory=AsyncSessionLocal):
+        self.cache = cache
+        self.session_factory = session_factory
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            ctx = self.cache.get(user.id)
+            if ctx is None:
+                async with self.session_factory() as db:
+                    ctx = self.cache.put(await load_user_context_async(db, user.id, user.username))
+            data["ctx"] = ctx
+        return await handler(event, data)
@@ -1,11 +1,16 @@
 import asyncio
 import random
+from dataclasses import replace
+from datetime import datetime
+from pathlib import Path
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 from app.core.config import settings
 from app.core.logging import setup_logging
-from app.db.session import SessionLocal
+from sqlalchemy import select, update
+from app.db.session import AsyncSessionLocal, SessionLocal, async_engine
+from app.bot.workers import pool, run_blocking
 from app.bot.keyboards import (
     grade_keyboard,
     subjects_keyboard,
@@ -14,49 +19,71 @@ from app.bot.keyboards import (
     lessons_keyboard,
     lesson_suggestions_keyboard,
 )
-from app.services.coupons import generate_coupons, redeem_coupon
-from app.services.rate_limit import check_limit_with_meta
-from app.models.entities import Subject, User, UserSession, EventLog, Subscription, SubjectUnlock, TocItem, Chunk
-from app.services.rag_service import answer_question
-from app.services.toc_service import get_units, get_lessons_for_unit, search_lessons
+from app.services.cache_service import cache_stats, sweep_cache
+from app.services.coupons import generate_coupons, generate_coupons_bulk, redeem_coupon_async
+from app.services.rate_limit import Limit, check_limits_async
+from app.models.entities import Subject, User, UserSession, TocItem, Chunk
+from app.rag.generations import active_version, collect_due_generations
+from app.services.rag_service import answer_flights, answer_question
+from app.services.toc_service import get_units_async, get_lessons_for_unit_async, search_lessons
+from app.services.entitlements import entitlement_cache_size, get_entitlements, peek_entitlements, warm_entitlements
+from app.services.events import event_sink
+from app.services.usage import DEMO_QUESTION_LIMIT, demo_remaining, question_count, question_count_async, record_question
+from app.services.users import UserContext
+from app.bot.middleware import UserContextMiddleware, identity_cache
 
 setup_logging(settings.LOG_LEVEL)
 bot = Bot(settings.BOT_TOKEN)
 dp = Dispatcher()
+dp.message.outer_middleware(UserContextMiddleware())
+dp.callback_query.outer_middleware(UserContextMiddleware())
 
 # Lightweight ephemeral flow-state for UX modes.
 FLOW_STATE: dict[int, str] = {}
 QUIZ_STATE: dict[int, int] = {}
 
+# Checked together in one statement per text message.
+TEXT_LIMITS = [Limit("global", 30, 600), Limit("ai_heavy", 10, 600)]
+
 
 def is_admin(uid: int) -> bool:
     ids = [int(x.strip()) for x in settings.ADMIN_USER_IDS.split(",") if x.strip().isdigit()]
     return uid in ids
 
 
-def _get_or_create_user(db, tg_id: int, username: str | None):
-    u = db.query(User).filter(User.telegram_id == tg_id).first()
-    if not u:
-        u = User(telegram_id=tg_id, username=username, grade="الثالث الثانوي - علمي")
-        db.add(u)
-        db.commit()
-        db.refresh(u)
-    return u
+async def _demo_usage_async(db, user_id: int, subject_id: int) -> tuple[int, int]:
+    used = await question_count_async(db, user_id, subject_id)
+    return used, demo_remaining(used)
+
+
+async def _save_session(db, ctx: UserContext) -> None:
+    """Persist the selection carried by ``ctx`` and refresh the identity cache."""
+    await db.execute(
+        update(UserSession)
+        .where(UserSession.user_id == ctx.user_id)
+        .values(
+            subject_id=ctx.subject_id,
+            toc_item_id=ctx.toc_item_id,
+            selected_range_start=ctx.selected_range_start,
+            selected_range_end=ctx.selected_range_end,
+        )
+    )
+    await db.commit()
+    identity_cache.put(ctx)
 
 
-def _get_or_create_session(db, user_id: int):
-    sess = db.query(UserSession).filter(UserSession.user_id == user_id).first()
-    if not sess:
-        sess = UserSession(user_id=user_id)
-        db.add(sess)
-        db.commit()
-        db.refresh(sess)
-    return sess
+async def _units_for(subject_id: int | None) -> list[tuple[int, str]]:
+    if not subject_id:
+        return []
+    async with AsyncSessionLocal() as db:
+        return [(x.id, x.title) for x in await get_units_async(db, subject_id)]
 
 
-def _demo_usage(db, user_id: int, subject_id: int) -> tuple[int, int]:
-    used = db.query(EventLog).filter(EventLog.user_id == user_id, EventLog.event_type == f"q:{subject_id}").count()
-    return used, max(0, 10 - used)
+async def _lessons_for(subject_id: int | None, unit_id: int) -> list[tuple[int, str]]:
+    if not subject_id:
+        return []
+    async with AsyncSessionLocal() as db:
+        return [(x.id, x.title) for x in await get_lessons_for_unit_async(db, subject_id, unit_id)]
 
 
 @dp.message(Command("start"))
@@ -72,34 +99,27 @@ async def choose_subject(c: CallbackQuery):
 
 
 @dp.callback_query(F.data == "menu:actions")
-async def back_actions(c: CallbackQuery):
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        remaining = None
-        if sess.subject_id:
-            _, remaining = _demo_usage(db, u.id, sess.subject_id)
+async def back_actions(c: CallbackQuery, ctx: UserContext):
+    remaining = None
+    if ctx.subject_id:
+        async with AsyncSessionLocal() as db:
+            _, remaining = await _demo_usage_async(db, ctx.user_id, ctx.subject_id)
     await c.message.answer("اختر الخدمة:", reply_markup=actions_keyboard(remaining))
     await c.answer()
 
 
 @dp.callback_query(F.data.startswith("sub:"))
-async def subject_menu(c: CallbackQuery):
+async def subject_menu(c: CallbackQuery, ctx: UserContext):
     code = c.data.split(":", 1)[1]
-    with SessionLocal() as db:
-        s = db.query(Subject).filter(Subject.code == code).first()
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        if not s:
+    async with AsyncSessionLocal() as db:
+        subject_id = (await db.execute(select(Subject.id).where(Subject.code == code))).scalar()
+        if subject_id is None:
             await c.message.answer("تعذّر العثور على هذه المادة حالياً. جرّب /start مرة أخرى.")
             return await c.answer()
 
-        sess.subject_id = s.id
-        sess.toc_item_id = None
-        sess.selected_range_start = None
-        sess.selected_range_end = None
-        db.commit()
-        used, remaining = _demo_usage(db, u.id, s.id)
+        ctx = replace(ctx, subject_id=subject_id, toc_item_id=None, selected_range_start=None, selected_range_end=None)
+        await _save_session(db, ctx)
+        used, remaining = await _demo_usage_async(db, ctx.user_id, subject_id)
     FLOW_STATE[c.from_user.id] = "idle"
     await c.message.answer(
         f"✅ تم اختيار المادة.\n🎁 النسخة التجريبية: {remaining}/10 متبقية في هذه المادة.",
@@ -108,146 +128,138 @@ async def subject_menu(c: CallbackQuery):
     await c.answer()
 
 
+def _quiz_options(sess: UserContext) -> list[tuple[str, int]]:
+    with SessionLocal() as db:
+        # Quick MCQ from current lesson range (or subject fallback)
+        live = (Chunk.subject_id == sess.subject_id, Chunk.content_version == active_version(sess.subject_id))
+        q = db.query(Chunk).filter(*live)
+        if sess.selected_range_start is not None:
+            q = q.filter(Chunk.pdf_page_index >= sess.selected_range_start)
+        if sess.selected_range_end is not None:
+            q = q.filter(Chunk.pdf_page_index <= sess.selected_range_end)
+        rows = q.limit(200).all()
+        if len(rows) < 4:
+            rows = db.query(Chunk).filter(*live).limit(300).all()
+
+        options = []
+        for r in rows:
+            txt = (r.content or "").strip().replace("\n", " ")
+            if len(txt) < 20:
+                continue
+            options.append((txt[:80], r.id))
+            if len(options) >= 20:
+                break
+        return options
+
+
 @dp.callback_query(F.data.startswith("act:"))
-async def action_handler(c: CallbackQuery):
+async def action_handler(c: CallbackQuery, ctx: UserContext):
     aid = c.data.split(":", 1)[1]
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        if not sess.subject_id:
-            await c.message.answer("اختر المادة أولاً عبر /start")
-            return await c.answer()
+    if not ctx.subject_id:
+        await c.message.answer("اختر المادة أولاً عبر /start")
+        return await c.answer()
 
-        if aid == "demo":
-            used, remaining = _demo_usage(db, u.id, sess.subject_id)
-            await c.message.answer(f"🎁 المتبقي لك في هذه المادة: {remaining}/10 (المستخدم: {used}/10)")
-        elif aid == "0":
-            units = get_units(db, sess.subject_id)
-            if not units:
-                await c.message.answer("لا توجد فهرسة وحدات حالياً لهذه المادة. جرّب البحث باسم الدرس.")
-            else:
-                data = [(x.id, x.title) for x in units]
-                await c.message.answer("📚 اختر الوحدة:", reply_markup=units_keyboard(data, page=0))
-            FLOW_STATE[c.from_user.id] = "toc"
-        elif aid == "1":
-            FLOW_STATE[c.from_user.id] = "search"
-            await c.message.answer("🔎 اكتب كلمة البحث الآن، وسأقترح أفضل 3 دروس مع أزرار فتح مباشر.")
-        elif aid in {"2", "5"}:
-            FLOW_STATE[c.from_user.id] = "ask"
-            await c.message.answer("✍️ أرسل سؤالك الآن. يفضّل اختيار درس أولاً لتحسين الدقة والتوثيق.")
-        elif aid == "3":
-            # Quick MCQ from current lesson range (or subject fallback)
-            q = db.query(Chunk).filter(Chunk.subject_id == sess.subject_id)
-            if sess.selected_range_start is not None:
-                q = q.filter(Chunk.pdf_page_index >= sess.selected_range_start)
-            if sess.selected_range_end is not None:
-                q = q.filter(Chunk.pdf_page_index <= sess.selected_range_end)
-            rows = q.limit(200).all()
-            if len(rows) < 4:
-                rows = db.query(Chunk).filter(Chunk.subject_id == sess.subject_id).limit(300).all()
-
-            options = []
-            for r in rows:
-                txt = (r.content or "").strip().replace("\n", " ")
-                if len(txt) < 20:
-                    continue
-                options.append((txt[:80], r.id))
-                if len(options) >= 20:
-                    break
-
-            if len(options) < 4:
-                await c.message.answer("لم أتمكن من تجهيز اختبار سريع الآن. اختر درساً آخر أو جرّب بعد قليل.")
-            else:
-                correct_idx = random.randrange(len(options))
-                correct_text = options[correct_idx][0]
-                distractors = [t for i, (t, _) in enumerate(options) if i != correct_idx]
-                random.shuffle(distractors)
-                choices = [correct_text] + distractors[:3]
-                random.shuffle(choices)
-                right = choices.index(correct_text)
-                QUIZ_STATE[c.from_user.id] = right
-
-                kb = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text=f"{i+1}) {ch[:50]}", callback_data=f"quiz_ans:{i}")]
-                        for i, ch in enumerate(choices)
-                    ]
-                )
-                await c.message.answer("⚡️ اختبار سريع: أي خيار ورد في الدرس؟", reply_markup=kb)
-        elif aid == "4":
-            await c.message.answer("اختبار امتحاني: قريباً.")
+    if aid == "demo":
+        async with AsyncSessionLocal() as db:
+            used, remaining = await _demo_usage_async(db, ctx.user_id, ctx.subject_id)
+        await c.message.answer(f"🎁 المتبقي لك في هذه المادة: {remaining}/10 (المستخدم: {used}/10)")
+    elif aid == "0":
+        units = await _units_for(ctx.subject_id)
+        if not units:
+            await c.message.answer("لا توجد فهرسة وحدات حالياً لهذه المادة. جرّب البحث باسم الدرس.")
         else:
-            await c.message.answer("خيار غير معروف")
+            await c.message.answer("📚 اختر الوحدة:", reply_markup=units_keyboard(units, page=0))
+        FLOW_STATE[c.from_user.id] = "toc"
+    elif aid == "1":
+        FLOW_STATE[c.from_user.id] = "search"
+        await c.message.answer("🔎 اكتب كلمة البحث الآن، وسأقترح أفضل 3 دروس مع أزرار فتح مباشر.")
+    elif aid in {"2", "5"}:
+        FLOW_STATE[c.from_user.id] = "ask"
+        await c.message.answer("✍️ أرسل سؤالك الآن. يفضّل اختيار درس أولاً لتحسين الدقة والتوثيق.")
+    elif aid == "3":
+        options = await run_blocking(_quiz_options, ctx)
+        if len(options) < 4:
+            await c.message.answer("لم أتمكن من تجهيز اختبار سريع الآن. اختر درساً آخر أو جرّب بعد قليل.")
+        else:
+            correct_idx = random.randrange(len(options))
+            correct_text = options[correct_idx][0]
+            distractors = [t for i, (t, _) in enumerate(options) if i != correct_idx]
+            random.shuffle(distractors)
+            choices = [correct_text] + distractors[:3]
+            random.shuffle(choices)
+            right = choices.index(correct_text)
+            QUIZ_STATE[c.from_user.id] = right
+
+            kb = InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [InlineKeyboardButton(text=f"{i+1}) {ch[:50]}", callback_data=f"quiz_ans:{i}")]
+                    for i, ch in enumerate(choices)
+                ]
+            )
+            await c.message.answer("⚡️ اختبار سريع: أي خيار ورد في الدرس؟", reply_markup=kb)
+    elif aid == "4":
+        await c.message.answer("اختبار امتحاني: قريباً.")
+    else:
+        await c.message.answer("خيار غير معروف")
     await c.answer()
 
 
 @dp.callback_query(F.data.startswith("toc_units:"))
-async def toc_units_page(c: CallbackQuery):
+async def toc_units_page(c: CallbackQuery, ctx: UserContext):
     page = int(c.data.split(":", 1)[1])
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        units = get_units(db, sess.subject_id) if sess.subject_id else []
-    await c.message.edit_reply_markup(reply_markup=units_keyboard([(x.id, x.title) for x in units], page=page))
+    units = await _units_for(ctx.subject_id)
+    await c.message.edit_reply_markup(reply_markup=units_keyboard(units, page=page))
     await c.answer()
 
 
 @dp.callback_query(F.data == "toc_back_units")
-async def toc_back_units(c: CallbackQuery):
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        units = get_units(db, sess.subject_id) if sess.subject_id else []
-    await c.message.answer("📚 اختر الوحدة:", reply_markup=units_keyboard([(x.id, x.title) for x in units], page=0))
+async def toc_back_units(c: CallbackQuery, ctx: UserContext):
+    units = await _units_for(ctx.subject_id)
+    await c.message.answer("📚 اختر الوحدة:", reply_markup=units_keyboard(units, page=0))
     await c.answer()
 
 
 @dp.callback_query(F.data.startswith("toc_unit:"))
-async def toc_select_unit(c: CallbackQuery):
+async def toc_select_unit(c: CallbackQuery, ctx: UserContext):
     unit_id = int(c.data.split(":", 1)[1])
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        lessons = get_lessons_for_unit(db, sess.subject_id, unit_id) if sess.subject_id else []
+    lessons = await _lessons_for(ctx.subject_id, unit_id)
     if not lessons:
         await c.message.answer("لا توجد دروس داخل هذه الوحدة حالياً.")
     else:
         await c.message.answer(
             "📖 اختر الدرس:",
-            reply_markup=lessons_keyboard([(x.id, x.title) for x in lessons], unit_id=unit_id, page=0),
+            reply_markup=lessons_keyboard(lessons, unit_id=unit_id, page=0),
         )
     await c.answer()
 
 
 @dp.callback_query(F.data.startswith("toc_lessons:"))
-async def toc_lessons_page(c: CallbackQuery):
+async def toc_lessons_page(c: CallbackQuery, ctx: UserContext):
     _, unit_id_str, page_str = c.data.split(":")
     unit_id = int(unit_id_str)
     page = int(page_str)
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        lessons = get_lessons_for_unit(db, sess.subject_id, unit_id) if sess.subject_id else []
-    await c.message.edit_reply_markup(reply_markup=lessons_keyboard([(x.id, x.title) for x in lessons], unit_id=unit_id, page=page))
+    lessons = await _lessons_for(ctx.subject_id, unit_id)
+    await c.message.edit_reply_markup(reply_markup=lessons_keyboard(lessons, unit_id=unit_id, page=page))
     await c.answer()
 
 
 @dp.callback_query(F.data.startswith("toc_lesson:"))
-async def toc_select_lesson(c: CallbackQuery):
+async def toc_select_lesson(c: CallbackQuery, ctx: UserContext):
     lesson_id = int(c.data.split(":", 1)[1])
-    with SessionLocal() as db:
-        u = _get_or_create_user(db, c.from_user.id, c.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        lesson = db.query(TocItem).filter(TocItem.id == lesson_id).first()
+    async with AsyncSessionLocal() as db:
+        lesson = await db.get(TocItem, lesson_id)
         if not lesson:
             await c.message.answer("تعذّر فتح هذا الدرس. جرّب من جديد.")
             return await c.answer()
 
         lesson_title = lesson.title
-        sess.toc_item_id = lesson.id
-        sess.selected_range_start = lesson.start_pdf_page if lesson.start_pdf_page is not None else 0
-        sess.selected_range_end = lesson.end_pdf_page if lesson.end_pdf_page is not None else 99999
-        db.commit()
+        sess = replace(
+            ctx,
+            toc_item_id=lesson.id,
+            selected_range_start=lesson.start_pdf_page if lesson.start_pdf_page is not None else 0,
+            selected_range_end=lesson.end_pdf_page if lesson.end_pdf_page is not None else 99999,
+        )
+        await _save_session(db, sess)
         start = (sess.selected_range_start or 0) + 1
         end = (sess.selected_range_end + 1) if sess.selected_range_end is not None else "آخر الكتاب"
     FLOW_STATE[c.from_user.id] = "ask"
@@ -286,11 +298,20 @@ async def redeem(m: Message):
     if len(args) < 2:
         await m.answer("استخدم: /redeem CODE")
         return
-    with SessionLocal() as db:
-        ok, msg = redeem_coupon(db, m.from_user.id, args[1].strip())
+    async with AsyncSessionLocal() as db:
+        ok, msg = await redeem_coupon_async(db, m.from_user.id, args[1].strip())
     await m.answer(msg)
 
 
+def _generate_coupons_work(kind: str, count: int, subject_code: str | None):
+    with SessionLocal() as db:
+        if count <= 30:
+            return generate_coupons(db, kind, count, subject_code), None
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        path = Path(settings.COUPON_EXPORT_DIR, f"coupons-{kind}-{subject_code or 'all'}-{stamp}.csv")
+        return None, generate_coupons_bulk(db, kind, count, subject_code, csv_path=path)
+
+
 @dp.message(Command("admin_gen_coupons"))
 async def admin_gen(m: Message):
     if not is_admin(m.from_user.id):
@@ -300,9 +321,13 @@ async def admin_gen(m: Message):
         return await m.answer("/admin_gen_coupons subscription|subject_unlock count [subject_code]")
     kind, count = parts[1], int(parts[2])
     subject_code = parts[3] if len(parts) > 3 else None
-    with SessionLocal() as db:
-        codes = generate_coupons(db, kind, count, subject_code)
-    await m.answer("\n".join(codes[:30]))
+    codes, report = await run_blocking(_generate_coupons_work, kind, count, subject_code)
+    if codes is not None:
+        return await m.answer("\n".join(codes))
+    await m.answer_document(
+        FSInputFile(report.path),
+        caption=f"{report.created} codes in {report.seconds:.1f}s ({report.per_second:.0f}/s), collisions retried: {report.collisions}",
+    )
 
 
 @dp.message(Command("admin_reindex"))
@@ -312,62 +337,134 @@ async def admin_reindex(m: Message):
     await m.answer("أعد الفهرسة عبر سكربت: python scripts/reindex_subject.py <subject_code>")
 
 
-@dp.message()
-async def on_text(m: Message):
-    text = (m.text or "").strip()
-    if not text:
-        return
+@dp.message(Command("admin_pool"))
+async def admin_pool(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("غير مصرح")
+    await m.answer("\n".join(f"{k}: {v}" for k, v in pool.stats().items()))
+
+
+@dp.message(Command("admin_cache"))
+async def admin_cache(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("غير مصرح")
+    stats = {
+        **cache_stats(),
+        **{f"flights_{k}": v for k, v in answer_flights.stats().items()},
+        **{f"events_{k}": v for k, v in event_sink.stats().items()},
+    }
+    await m.answer("\n".join(f"{k}: {v}" for k, v in stats.items()))
 
+
+def _sweep_cache_work() -> dict[str, int]:
+    with SessionLocal() as db:
+        gc = collect_due_generations(db)
+        return {**sweep_cache(db), "old_generations": gc["generations"]}
+
+
+@dp.message(Command("admin_sweep_cache"))
+async def admin_sweep_cache(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("غير مصرح")
+    report = await run_blocking(_sweep_cache_work)
+    await m.answer("\n".join(f"{k}: {v}" for k, v in report.items()))
+
+
+def _warm_entitlements_work() -> int:
+    with SessionLocal() as db:
+        return warm_entitlements(db)
+
+
+def _inspect_entitlements_work(tg_id: int) -> str:
+    with SessionLocal() as db:
+        user_id = db.query(User.id).filter(User.telegram_id == tg_id).scalar()
+        if user_id is None:
+            return "مستخدم غير موجود"
+        cached = peek_entitlements(user_id)
+        ent = cached or get_entitlements(db, user_id)
+    return (
+        f"user_id: {ent.user_id}\nsubscribed: {ent.subscribed}\n"
+        f"unlocked_subjects: {sorted(ent.unlocked_subjects)}\ncached: {cached is not None}"
+    )
+
+
+@dp.message(Command("admin_entitlements"))
+async def admin_entitlements(m: Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("غير مصرح")
+    parts = (m.text or "").split()
+    if len(parts) > 1 and parts[1] == "warm":
+        n = await run_blocking(_warm_entitlements_work)
+        return await m.answer(f"warmed: {n}\ncached: {entitlement_cache_size()}")
+    if len(parts) > 1 and parts[1].isdigit():
+        return await m.answer(await run_blocking(_inspect_entitlements_work, int(parts[1])))
+    await m.answer(f"/admin_entitlements warm|<telegram_id>\ncached: {entitlement_cache_size()}")
+
+
+def _handle_text(state: UserContext, tg_id: int, username: str | None, text: str, flow: str) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Blocking part of ``on_text``: lesson search, or demo gating plus the RAG answer."""
     with SessionLocal() as db:
-        ok_global, global_minutes_left = check_limit_with_meta(db, m.from_user.id, "global", 30, 600)
-        if not ok_global:
-            return await m.answer(f"⏳ تم التهدئة المؤقتة لحماية الخدمة. حاول بعد حوالي {global_minutes_left} دقيقة.")
-        ok_ai, ai_minutes_left = check_limit_with_meta(db, m.from_user.id, "ai_heavy", 10, 600)
-        if not ok_ai:
-            return await m.answer(f"⏳ وصلت للحد الذكي حالياً. يمكنك المحاولة بعد حوالي {ai_minutes_left} دقيقة.")
-
-        u = _get_or_create_user(db, m.from_user.id, m.from_user.username)
-        sess = _get_or_create_session(db, u.id)
-        if not sess.subject_id:
-            return await m.answer("اختر المادة أولاً عبر /start")
-
-        flow = FLOW_STATE.get(m.from_user.id, "ask")
         if flow == "search":
-            suggestions = search_lessons(db, sess.subject_id, text, limit=3)
+            suggestions = search_lessons(db, state.subject_id, text, limit=3)
             if not suggestions:
-                return await m.answer("لم أجد دروساً مطابقة بوضوح. جرّب كلمة أدق أو افتح الفهرس لاختيار الدرس.")
+                return "لم أجد دروساً مطابقة بوضوح. جرّب كلمة أدق أو افتح الفهرس لاختيار الدرس.", None
             msg = "أفضل الدروس المطابقة لسؤالك:\n" + "\n".join(
                 [f"{i+1}) {s.unit_title + ' — ' if s.unit_title else ''}{s.title}" for i, s in enumerate(suggestions)]
             )
             kb = lesson_suggestions_keyboard([(s.id, f"{s.unit_title + ' — ' if s.unit_title else ''}{s.title}") for s in suggestions])
-            return await m.answer(msg, reply_markup=kb)
+            return msg, kb
 
-        used = db.query(EventLog).filter(EventLog.user_id == u.id, EventLog.event_type == f"q:{sess.subject_id}").count()
-        has_sub = db.query(Subscription).filter(Subscription.user_id == u.id, Subscription.active == True).first() is not None  # noqa: E712
-        has_unlock = db.query(SubjectUnlock).filter(SubjectUnlock.user_id == u.id, SubjectUnlock.subject_id == sess.subject_id).first() is not None
-        if not (has_sub and has_unlock) and used >= 10:
-            return await m.answer("انتهت النسخة التجريبية لهذه المادة (10 أسئلة). فعّل الاشتراك وكود فتح المادة.")
+        user_id = state.user_id
+        used = question_count(db, user_id, state.subject_id)
+        has_paid_access = get_entitlements(db, user_id).has_paid_access(state.subject_id)
+        if not has_paid_access and used >= DEMO_QUESTION_LIMIT:
+            return "انتهت النسخة التجريبية لهذه المادة (10 أسئلة). فعّل الاشتراك وكود فتح المادة.", None
 
-        db.add(EventLog(user_id=u.id, event_type=f"q:{sess.subject_id}", payload=text))
-        db.commit()
+        used = record_question(db, user_id, state.subject_id, text, sink=event_sink)
 
         ans = answer_question(
             db,
-            user_id=m.from_user.id,
-            subject_id=sess.subject_id,
+            user_id=tg_id,
+            subject_id=state.subject_id,
             question=text,
-            lesson_range=[sess.selected_range_start, sess.selected_range_end],
-            watermark=f"User: @{m.from_user.username or 'unknown'} / id: {m.from_user.id}",
+            lesson_range=[state.selected_range_start, state.selected_range_end],
+            watermark=f"User: @{username or 'unknown'} / id: {tg_id}",
         )
-        _, remaining = _demo_usage(db, u.id, sess.subject_id)
-        has_paid_access = bool(has_sub and has_unlock)
+        remaining = demo_remaining(used)
 
     footer = "🔓 حسابك مفعل بدون حد أسئلة في هذه المادة." if has_paid_access else f"🎁 المتبقي في النسخة التجريبية لهذه المادة: {remaining}/10"
-    await m.answer(f"{ans['answer']}\n\n{footer}")
+    return f"{ans['answer']}\n\n{footer}", None
+
+
+@dp.message()
+async def on_text(m: Message, ctx: UserContext):
+    text = (m.text or "").strip()
+    if not text:
+        return
+
+    async with AsyncSessionLocal() as db:
+        # ai_heavy is only checked (and charged) once global allows.
+        global_limit, *rest = await check_limits_async(db, m.from_user.id, TEXT_LIMITS)
+    if not global_limit.allowed:
+        return await m.answer(f"⏳ تم التهدئة المؤقتة لحماية الخدمة. حاول بعد حوالي {global_limit.minutes_left} دقيقة.")
+    (ai_limit,) = rest
+    if not ai_limit.allowed:
+        return await m.answer(f"⏳ وصلت للحد الذكي حالياً. يمكنك المحاولة بعد حوالي {ai_limit.minutes_left} دقيقة.")
+    if not ctx.subject_id:
+        return await m.answer("اختر المادة أولاً عبر /start")
+
+    flow = FLOW_STATE.get(m.from_user.id, "ask")
+    reply, kb = await run_blocking(_handle_text, ctx, m.from_user.id, m.from_user.username, text, flow)
+    await m.answer(reply, reply_markup=kb)
 
 
 async def main():
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        pool.shutdown()
+        event_sink.close()
+        await async_engine.dispose()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.config import settings
+
+
+class BlockingPool:
+    """Bounded thread pool for the synchronous DB/RAG service layer.
+
+    At most ``max_pending`` calls are admitted at once (running or waiting for a
+    thread); further callers wait on the event loop instead of piling up work.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bot-worker")
+        self._slots: asyncio.Semaphore | None = None
+        self._lock = threading.Lock()
+        self.waiting = 0  # blocked on admission
+        self.queued = 0  # admitted, waiting for a thread
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _admission(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        return self._slots
+
+    def _call(self, fn, args, kwargs, claim):
+        with self._lock:
+            if not claim:
+                claim.append(True)
+                self.queued -= 1
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        slots = self._admission()
+        self.waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        # Whoever claims first (the thread starting, or the caller giving up) leaves the queue.
+        claim: list[bool] = []
+        try:
+            with self._lock:
+                self.queued += 1
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, functools.partial(self._call, fn, args, kwargs, claim))
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                if not claim:
+                    claim.append(True)
+                    self.queued -= 1
+            slots.release()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+pool = BlockingPool(settings.BOT_WORKER_THREADS, settings.BOT_WORKER_MAX_PENDING)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    return await pool.run(fn, *args, **kwargs)
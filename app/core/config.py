@@ -19,6 +19,30 @@ class Settings(BaseSettings):
     WEBHOOK_BASE_URL: str = ""
     USE_WEBHOOK: bool = False
     CONTENT_VERSION: int = 1
+    SNAPSHOT_DIR: str = "data/snapshots"
+    INGEST_WORKERS: int = 0  # page extraction processes; 0 = one per CPU, 1 = serial
+    INGEST_PAGES_PER_TASK: int = 32
+    GENERATION_GC_DELAY_SEC: int = 30
+    DB_ASYNC_POOL_SIZE: int = 5
+    DB_ASYNC_MAX_OVERFLOW: int = 10
+    BOT_WORKER_THREADS: int = 8
+    BOT_WORKER_MAX_PENDING: int = 64
+    BOT_IDENTITY_TTL_SEC: int = 30
+    BOT_IDENTITY_CACHE_SIZE: int = 10000
+    CACHE_LOCAL_MAX_ENTRIES: int = 5000
+    CACHE_LOCAL_TTL_SEC: int = 300
+    CACHE_NEGATIVE_TTL_SEC: int = 60
+    CACHE_MAX_ROWS: int = 200000
+    CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    CACHE_SWEEP_BATCH: int = 1000
+    EVENT_SINK_BATCH: int = 200
+    EVENT_SINK_FLUSH_MS: int = 500
+    EVENT_SINK_MAX_QUEUE: int = 10000
+    EVENT_SINK_OVERFLOW: str = "drop"  # "drop" or "block"
+    ENTITLEMENT_TTL_SEC: int = 300
+    ENTITLEMENT_CACHE_SIZE: int = 10000
+    COUPON_EXPORT_DIR: str = "data/exports"
+    RATE_LIMIT_BACKEND: str = "db"  # "db" or "memory" (single worker only)
 
 
 settings = Settings()  # type: ignore[call-arg]
@@ -0,0 +1,18 @@
+from itertools import islice
+from typing import Iterable
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+
+def insert_batches(db: Session, model, rows: Iterable[dict], batch_size: int = 1000) -> int:
+    """Write ``rows`` with one executemany ``INSERT`` per ``batch_size``; returns the count.
+
+    Rows are consumed lazily, so a generator keeps at most one batch in memory.
+    """
+    it = iter(rows)
+    written = 0
+    while batch := list(islice(it, batch_size)):
+        db.execute(insert(model), batch)
+        written += len(batch)
+    return written
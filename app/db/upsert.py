@@ -0,0 +1,8 @@
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def dialect_insert(bind, table):
+    """``INSERT`` construct with ``on_conflict_*`` support for the bound dialect."""
+    if bind.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
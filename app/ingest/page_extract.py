@@ -0,0 +1,165 @@
+"""Page text extraction, optionally spread over worker processes.
+
+Each worker opens its own ``fitz`` document and extracts a contiguous page range;
+records come back to the parent in page order, so callers see the same stream as the
+serial loop. Besides the text, a record carries the per-page TOC signals (TOC-page
+lines, heading spans, printed page number) so the book is only read once.
+"""
+from __future__ import annotations
+
+import hashlib
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator
+
+import fitz
+
+from app.core.config import settings
+from app.ingest.pdf_text_utils import compute_text_quality_metrics
+
+AR_TOC_KEYWORDS = ["الفهرس", "المحتويات", "الوحدة", "الدرس"]
+HEADING_KEYWORDS = ("الدرس", "الوحدة")
+TOC_PAGE_LIMIT = 25
+HEADING_MIN_SIZE = 14
+
+_TOC_LINE_RE = re.compile(r"(.+?)\s+([0-9]{1,3})$")
+_PAGE_NUM_RE = re.compile(r"\b([0-9]{1,3})\b")
+
+
+@dataclass(frozen=True)
+class PageRecord:
+    index: int
+    text: str
+    text_len: int
+    arabic_char_ratio: float
+    gibberish_ratio: float
+    digest: str
+    printed_page: int | None = None
+    toc_lines: tuple[tuple[str, int], ...] = ()
+    headings: tuple[str, ...] = ()
+
+    def metrics(self) -> dict[str, float]:
+        return {"text_len": float(self.text_len), "arabic_char_ratio": self.arabic_char_ratio, "gibberish_ratio": self.gibberish_ratio}
+
+
+def page_digest(page, text: str) -> str:
+    """Fingerprint of the extracted text plus page size and block boxes (rounded to points)."""
+    h = hashlib.sha256(text.encode("utf-8"))
+    r = page.rect
+    h.update(f"{r.width:.0f}x{r.height:.0f}".encode())
+    for b in page.get_text("blocks"):
+        h.update(f";{b[0]:.0f},{b[1]:.0f},{b[2]:.0f},{b[3]:.0f}".encode())
+    return h.hexdigest()
+
+
+def printed_page_number(text: str) -> int | None:
+    """Last 1-3 digit number near the end of the page, usually its footer."""
+    nums = _PAGE_NUM_RE.findall(text[-500:])
+    return int(nums[-1]) if nums else None
+
+
+def toc_page_lines(index: int, text: str) -> tuple[tuple[str, int], ...]:
+    """``(title, printed page)`` lines of a printed contents page among the first pages."""
+    if index >= TOC_PAGE_LIMIT or not any(k in text for k in AR_TOC_KEYWORDS):
+        return ()
+    out = []
+    for line in text.splitlines():
+        m = _TOC_LINE_RE.search(line.strip())
+        if m:
+            out.append((m.group(1).strip(" ."), int(m.group(2))))
+    return tuple(out)
+
+
+def heading_spans(page, text: str) -> tuple[str, ...]:
+    """Large-font unit/lesson headings; the costly ``dict`` layout is only read when
+    the plain text already mentions a heading keyword."""
+    if not any(k in text for k in HEADING_KEYWORDS):
+        return ()
+    out = []
+    for b in page.get_text("dict").get("blocks", []):
+        for l in b.get("lines", []):
+            for s in l.get("spans", []):
+                t = s.get("text", "").strip()
+                if len(t) > 4 and s.get("size", 0) >= HEADING_MIN_SIZE and any(k in t for k in HEADING_KEYWORDS):
+                    out.append(t)
+                    break
+    return tuple(out)
+
+
+def _record(index: int, page) -> PageRecord:
+    text = page.get_text("text")
+    m = compute_text_quality_metrics(text)
+    return PageRecord(
+        index,
+        text,
+        int(m["text_len"]),
+        m["arabic_char_ratio"],
+        m["gibberish_ratio"],
+        page_digest(page, text),
+        printed_page_number(text),
+        toc_page_lines(index, text),
+        heading_spans(page, text),
+    )
+
+
+def extract_range(pdf_path: str, start: int, stop: int) -> list[PageRecord]:
+    """Records for pages ``start <= i < stop``; runs inside a worker process."""
+    doc = fitz.open(pdf_path)
+    try:
+        return [_record(i, doc[i]) for i in range(start, min(stop, doc.page_count))]
+    finally:
+        doc.close()
+
+
+def page_count(pdf_path: str) -> int:
+    doc = fitz.open(pdf_path)
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+def resolve_workers(workers: int | None = None) -> int:
+    """``INGEST_WORKERS`` when ``workers`` is None; 0 means one per CPU."""
+    n = settings.INGEST_WORKERS if workers is None else workers
+    return max(1, n or os.cpu_count() or 1)
+
+
+def iter_pages(pdf_path: str, workers: int | None = None, pages_per_task: int | None = None) -> Iterator[PageRecord]:
+    """Yield a ``PageRecord`` per page in order.
+
+    With more than one worker, contiguous ranges of ``pages_per_task`` pages go to a
+    process pool and at most two ranges per worker are in flight, so memory stays
+    bounded by the window rather than the book. Books shorter than two ranges are
+    extracted in-process.
+    """
+    workers = resolve_workers(workers)
+    per_task = max(1, pages_per_task or settings.INGEST_PAGES_PER_TASK)
+    total = page_count(pdf_path)
+    if workers <= 1 or total < 2 * per_task:
+        doc = fitz.open(pdf_path)
+        try:
+            for i in range(doc.page_count):
+                yield _record(i, doc[i])
+        finally:
+            doc.close()
+        return
+
+    ranges = iter(range(0, total, per_task))
+    # spawn: workers never inherit the parent's DB connections or MuPDF state.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending: deque = deque()
+        for start in ranges:
+            pending.append(pool.submit(extract_range, pdf_path, start, start + per_task))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            records = pending.popleft().result()
+            start = next(ranges, None)
+            if start is not None:
+                pending.append(pool.submit(extract_range, pdf_path, start, start + per_task))
+            yield from records
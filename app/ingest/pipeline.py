@@ -1,9 +1,27 @@
+import logging
+import time
+from datetime import datetime
+from contextlib import contextmanager
 from pathlib import Path
-import fitz
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from app.ingest.toc_extractor import extract_toc_with_fallback
-from app.models.entities import Subject, TocItem, Chunk, LessonEmbedding
+from app.db.bulk import insert_batches
+from app.ingest.page_extract import resolve_workers
+from app.ingest.pdf_text_utils import classify_pdf_quality
+from app.ingest.toc_extractor import extract_toc_with_fallback, scan_pdf
+from app.models.entities import Subject, TocItem, Chunk, ChunkSentence, ChunkTerm, LessonEmbedding, PageFingerprint, UserSession
 from app.rag.embeddings import deterministic_embedding
+from app.rag.bm25 import build_bm25_stats
+from app.rag.generations import drop_generation, schedule_generation_gc
+from app.rag.sentences import index_chunk_sentences
+from app.rag.snapshot import snapshot_path, write_snapshot
+from app.rag.term_index import index_chunk_rows, tokenize
+from app.services.cache_service import invalidate_pages
+from app.services.toc_service import TocIndex, invalidate_toc_index
+
+log = logging.getLogger(__name__)
+
+LESSON_SUMMARY_CHUNKS = 15
 
 
 def _build_synthetic_toc(page_count: int) -> list[dict]:
@@ -46,89 +64,354 @@ def _resolve_start_page(item: dict, mapping: dict[int, int]) -> int | None:
     return None
 
 
-def ingest_subject(db: Session, subject_code: str, name_ar: str, pdf_path: str, content_version: int):
+@contextmanager
+def _stage(timings: dict[str, float], name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.perf_counter() - started, 3)
+
+
+def _plan_toc(raw_items: list[dict], mapping: dict[int, int]) -> list[dict]:
+    """Flat TOC rows in order, with ``parent`` (index into the list) and end pages."""
+    plan: list[dict] = []
+    stack: list[int] = []
+    for i, it in enumerate(raw_items):
+        level = int(it.get("level", 2) or 2)
+        while len(stack) >= level:
+            stack.pop()
+        plan.append(
+            {
+                "title": it.get("title", f"Item {i+1}"),
+                "level": level,
+                "order_index": i,
+                "start_pdf_page": _resolve_start_page(it, mapping),
+                "end_pdf_page": None,
+                "printed_page_start": it.get("printed_page"),
+                "parent": stack[-1] if stack else None,
+            }
+        )
+        stack.append(i)
+
+    # End page = first later start past this one, minus one (next-greater via a stack).
+    later_starts: list[int] = []
+    for row in reversed(plan):
+        sp = row["start_pdf_page"]
+        if sp is None:
+            continue
+        while later_starts and later_starts[-1] <= sp:
+            later_starts.pop()
+        row["end_pdf_page"] = later_starts[-1] - 1 if later_starts else None
+        later_starts.append(sp)
+    return plan
+
+
+def _toc_key(title: str, level: int, start: int | None, end: int | None) -> tuple:
+    return (title, level, start, end)
+
+
+def _write_toc(
+    db: Session, subject_id: int, content_version: int, plan: list[dict], existing: list[TocItem]
+) -> tuple[list[TocItem], list[int]]:
+    """Reconcile ``existing`` TOC rows of the generation with ``plan``.
+
+    Rows whose title, level and page range still match keep their id; the rest are
+    inserted with one flush per nesting depth, or deleted after references to them
+    are cleared. Returns the items in plan order and the removed ids.
+    """
+    reusable: dict[tuple, list[TocItem]] = {}
+    for ti in existing:
+        reusable.setdefault(_toc_key(ti.title, ti.level, ti.start_pdf_page, ti.end_pdf_page), []).append(ti)
+
+    items: list[TocItem] = []
+    depth: list[int] = []
+    for row in plan:
+        matches = reusable.get(_toc_key(row["title"], row["level"], row["start_pdf_page"], row["end_pdf_page"]))
+        if matches:
+            ti = matches.pop(0)
+        else:
+            ti = TocItem(
+                subject_id=subject_id,
+                content_version=content_version,
+                title=row["title"],
+                level=row["level"],
+                start_pdf_page=row["start_pdf_page"],
+                end_pdf_page=row["end_pdf_page"],
+            )
+        ti.order_index = row["order_index"]
+        ti.printed_page_start = row["printed_page_start"]
+        items.append(ti)
+        depth.append(depth[row["parent"]] + 1 if row["parent"] is not None else 0)
+
+    for d in range(max(depth, default=-1) + 1):
+        for i, ti in enumerate(items):
+            if depth[i] == d:
+                parent = plan[i]["parent"]
+                ti.parent_id = items[parent].id if parent is not None else None
+                if ti.id is None:
+                    db.add(ti)
+        db.flush()
+
+    removed = [ti.id for rest in reusable.values() for ti in rest]
+    if removed:
+        db.query(Chunk).filter(Chunk.toc_item_id.in_(removed)).update({Chunk.toc_item_id: None}, synchronize_session=False)
+        db.query(LessonEmbedding).filter(LessonEmbedding.toc_item_id.in_(removed)).delete(synchronize_session=False)
+        db.query(UserSession).filter(UserSession.toc_item_id.in_(removed)).update({UserSession.toc_item_id: None}, synchronize_session=False)
+        db.query(TocItem).filter(TocItem.id.in_(removed)).update({TocItem.parent_id: None}, synchronize_session=False)
+        db.query(TocItem).filter(TocItem.id.in_(removed)).delete(synchronize_session=False)
+    return items, removed
+
+
+def _drop_pages(db: Session, subject_id: int, content_version: int, pages: list[int]) -> None:
+    """Remove the generation's chunks, postings and sentences on ``pages``, and their fingerprints."""
+    on_pages = (Chunk.subject_id == subject_id, Chunk.content_version == content_version, Chunk.pdf_page_index.in_(pages))
+    db.query(ChunkTerm).filter(
+        ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == content_version, ChunkTerm.pdf_page_index.in_(pages)
+    ).delete(synchronize_session=False)
+    db.query(ChunkSentence).filter(ChunkSentence.chunk_id.in_(select(Chunk.id).where(*on_pages))).delete(synchronize_session=False)
+    db.query(Chunk).filter(*on_pages).delete(synchronize_session=False)
+    db.query(PageFingerprint).filter(PageFingerprint.subject_id == subject_id, PageFingerprint.pdf_page_index.in_(pages)).delete(
+        synchronize_session=False
+    )
+
+
+def _lesson_embedding_row(subject_id: int, content_version: int, toc_item_id: int, heads) -> dict:
+    summary = "\n".join(heads)[:2000]
+    return {
+        "subject_id": subject_id,
+        "content_version": content_version,
+        "toc_item_id": toc_item_id,
+        "summary": summary,
+        "embedding": deterministic_embedding(summary or f"lesson-{toc_item_id}"),
+    }
+
+
+def ingest_subject(
+    db: Session,
+    subject_code: str,
+    name_ar: str,
+    pdf_path: str,
+    content_version: int,
+    batch_size: int = 500,
+    workers: int | None = None,
+    full: bool = False,
+    gc_delay_sec: float | None = None,
+):
+    # One PDF scan feeds TOC extraction and chunking. A newer content_version (or full=True)
+    # builds a new generation and flips to it; otherwise only changed pages are reindexed.
+    timings: dict[str, float] = {}
     subj = db.query(Subject).filter(Subject.code == subject_code).first()
+    active = subj.content_version if subj else None
+    incremental = (
+        not full
+        and subj is not None
+        and content_version <= active
+        and db.query(PageFingerprint.pdf_page_index).filter(PageFingerprint.subject_id == subj.id).first() is not None
+    )
     if not subj:
         subj = Subject(code=subject_code, name_ar=name_ar, pdf_path=pdf_path, content_version=content_version)
         db.add(subj)
         db.commit()
         db.refresh(subj)
-    else:
-        subj.content_version = content_version
-        db.commit()
+    version = active if incremental else (content_version if active is None or content_version > active else active + 1)
 
-    toc_debug = extract_toc_with_fallback(pdf_path, subject_code)
+    # An in-place update of the live generation is one transaction; a new generation
+    # is invisible until the flip, so it can commit as it goes.
+    save = db.flush if incremental else db.commit
+    workers = resolve_workers(workers)
+    with _stage(timings, "scan"):
+        scan = scan_pdf(pdf_path, workers)
+    with _stage(timings, "toc_extract"):
+        toc_debug = extract_toc_with_fallback(pdf_path, subject_code, scan=scan)
 
-    db.query(TocItem).filter(TocItem.subject_id == subj.id).delete()
-    db.query(Chunk).filter(Chunk.subject_id == subj.id).delete()
-    db.query(LessonEmbedding).filter(LessonEmbedding.subject_id == subj.id).delete()
-    db.commit()
+    old_digests: dict[int, str] = {}
+    old_lessons: dict[int, int | None] = {}
+    with _stage(timings, "clear"):
+        if incremental:
+            old_digests = dict(db.query(PageFingerprint.pdf_page_index, PageFingerprint.digest).filter(PageFingerprint.subject_id == subj.id))
+            old_lessons = dict(
+                db.query(Chunk.pdf_page_index, Chunk.toc_item_id).filter(Chunk.subject_id == subj.id, Chunk.content_version == version).distinct()
+            )
+        elif version != active:
+            # Leftovers of an interrupted build of the same generation; never the live one.
+            drop_generation(db, subj.id, version)
+            db.commit()
 
-    toc_items: list[TocItem] = []
-    stack: list[TocItem] = []
-    mapping = {int(k): int(v) for k, v in (toc_debug.get("page_mapping") or {}).items()}
-    raw_items = toc_debug.get("items") or []
+    with _stage(timings, "toc_items"):
+        mapping = {int(k): int(v) for k, v in (toc_debug.get("page_mapping") or {}).items()}
+        raw_items = toc_debug.get("items") or []
 
-    # Hard fallback: if TOC extraction returns nothing, synthesize a navigable plan.
-    if not raw_items:
-        doc_tmp = fitz.open(pdf_path)
-        raw_items = _build_synthetic_toc(doc_tmp.page_count)
-        doc_tmp.close()
+        # Hard fallback: if TOC extraction returns nothing, synthesize a navigable plan.
+        if not raw_items:
+            raw_items = _build_synthetic_toc(scan.page_count)
 
-    for i, it in enumerate(raw_items):
-        level = int(it.get("level", 2) or 2)
-        while len(stack) >= level:
-            stack.pop()
-        parent = stack[-1] if stack else None
-
-        ti = TocItem(
-            subject_id=subj.id,
-            parent_id=parent.id if parent else None,
-            title=it.get("title", f"Item {i+1}"),
-            level=level,
-            order_index=i,
-            start_pdf_page=_resolve_start_page(it, mapping),
-            printed_page_start=it.get("printed_page"),
-        )
-        db.add(ti)
-        db.flush()
-        toc_items.append(ti)
-        stack.append(ti)
+        existing = db.query(TocItem).filter(TocItem.subject_id == subj.id, TocItem.content_version == version).all()
+        existing_ids = {ti.id for ti in existing}
+        toc_items, removed_toc = _write_toc(db, subj.id, version, _plan_toc(raw_items, mapping), existing)
+        save()
+        toc_index = TocIndex(subj.id, version, toc_items)
+        new_lessons = {x.id for x in toc_index.items if x.id not in existing_ids and x.level >= 2 and x.start_pdf_page is not None}
 
-    # Fill end pages using next start page.
-    for idx, ti in enumerate(toc_items):
-        if ti.start_pdf_page is None:
-            continue
-        nxt = None
-        for j in range(idx + 1, len(toc_items)):
-            if toc_items[j].start_pdf_page is not None and toc_items[j].start_pdf_page > ti.start_pdf_page:
-                nxt = toc_items[j].start_pdf_page
-                break
-        ti.end_pdf_page = (nxt - 1) if nxt is not None else None
-    db.commit()
-
-    doc = fitz.open(pdf_path)
-    lesson_items = [x for x in toc_items if x.level >= 2 and x.start_pdf_page is not None]
-    lesson_items.sort(key=lambda x: x.start_pdf_page)
-
-    for i in range(doc.page_count):
-        txt = doc[i].get_text("text")
-        chunks = _chunk_text(txt)
-        toc_id = None
-        for ls in lesson_items:
-            end = ls.end_pdf_page if ls.end_pdf_page is not None else doc.page_count - 1
-            if (ls.start_pdf_page or 0) <= i <= end:
-                toc_id = ls.id
-                break
-        for c in chunks:
-            db.add(Chunk(subject_id=subj.id, toc_item_id=toc_id, pdf_page_index=i, printed_page_number=None, content=c))
-    db.commit()
-
-    for ti in lesson_items:
-        texts = db.query(Chunk).filter(Chunk.subject_id == subj.id, Chunk.toc_item_id == ti.id).limit(15).all()
-        summary = "\n".join([t.content[:200] for t in texts])[:2000] or ""
-        emb = deterministic_embedding(summary or f"lesson-{ti.id}")
-        db.add(LessonEmbedding(subject_id=subj.id, toc_item_id=ti.id, summary=summary, embedding=emb))
-    db.commit()
-
-    return {"subject": subject_code, "toc_items": len(toc_items)}
+    # First few chunk heads per lesson, collected on the way for the lesson summaries.
+    heads: dict[int, list[str]] = {}
+    page_metrics: list[dict[str, float]] = []
+    changed: list[int] = []
+    fingerprints: list[dict] = []
+
+    def chunk_rows():
+        for rec, txt in scan.iter_texts():
+            i = rec.index
+            page_metrics.append(rec.metrics())
+            if old_digests.get(i) == rec.digest:
+                continue
+            if incremental:
+                _drop_pages(db, subj.id, version, [i])
+            changed.append(i)
+            fingerprints.append({"subject_id": subj.id, "pdf_page_index": i, "digest": rec.digest})
+            lesson = toc_index.lesson_for_page(i)
+            toc_id = lesson.id if lesson is not None else None
+            for c in _chunk_text(txt):
+                if toc_id is not None and len(heads.setdefault(toc_id, [])) < LESSON_SUMMARY_CHUNKS:
+                    heads[toc_id].append(c[:200])
+                yield {
+                    "subject_id": subj.id,
+                    "content_version": version,
+                    "toc_item_id": toc_id,
+                    "pdf_page_index": i,
+                    "printed_page_number": rec.printed_page,
+                    "content": c,
+                    "token_count": len(tokenize(c)),
+                    "embedding": deterministic_embedding(c[:500]),
+                }
+
+    with _stage(timings, "chunks"):
+        with scan:
+            chunk_count = insert_batches(db, Chunk, chunk_rows(), batch_size)
+        pages = len(page_metrics)
+        removed_pages = sorted(p for p in old_digests if p >= pages)
+        if removed_pages:
+            _drop_pages(db, subj.id, version, removed_pages)
+        if incremental:
+            insert_batches(db, PageFingerprint, fingerprints, batch_size)
+
+        # Unchanged pages keep their chunks but may now fall in a different lesson.
+        changed_set = set(changed)
+        relabel: dict[int | None, list[int]] = {}
+        for p, old_id in old_lessons.items():
+            if p in changed_set or p >= pages:
+                continue
+            lesson = toc_index.lesson_for_page(p)
+            new_id = lesson.id if lesson is not None else None
+            if new_id != old_id:
+                relabel.setdefault(new_id, []).append(p)
+        for new_id, ps in relabel.items():
+            db.query(Chunk).filter(Chunk.subject_id == subj.id, Chunk.content_version == version, Chunk.pdf_page_index.in_(ps)).update(
+                {Chunk.toc_item_id: new_id}, synchronize_session=False
+            )
+        relabeled = sorted(p for ps in relabel.values() for p in ps)
+        save()
+
+    with _stage(timings, "term_index"):
+        new_chunks = db.query(Chunk).filter(Chunk.subject_id == subj.id, Chunk.content_version == version).order_by(Chunk.id.asc())
+        if incremental:
+            new_chunks = new_chunks.filter(Chunk.pdf_page_index.in_(changed))
+        index_chunk_rows(db, subj.id, new_chunks.yield_per(500))
+        save()
+    with _stage(timings, "sentence_index"):
+        index_chunk_sentences(db, subj.id, new_chunks.yield_per(500))
+        save()
+
+    dirty = bool(changed or removed_pages or relabeled)
+    if dirty or not incremental:
+        with _stage(timings, "bm25"):
+            build_bm25_stats(db, subj.id, version, commit=not incremental)
+
+    with _stage(timings, "lesson_embeddings"):
+        lessons = [x for x in toc_index.items if x.level >= 2 and x.start_pdf_page is not None]
+        if incremental:
+            touched = {ls.id for p in changed + relabeled if (ls := toc_index.lesson_for_page(p)) is not None} | new_lessons
+            # Lessons that lost pages need a fresh summary too.
+            touched |= {old_lessons.get(p) for p in changed + relabeled + removed_pages} - {None}
+            lessons = [x for x in lessons if x.id in touched]
+            db.query(LessonEmbedding).filter(LessonEmbedding.toc_item_id.in_([x.id for x in lessons])).delete(synchronize_session=False)
+            rows = []
+            for ls in lessons:
+                texts = (
+                    db.query(Chunk.content)
+                    .filter(Chunk.subject_id == subj.id, Chunk.toc_item_id == ls.id)
+                    .order_by(Chunk.pdf_page_index.asc(), Chunk.id.asc())
+                    .limit(LESSON_SUMMARY_CHUNKS)
+                )
+                rows.append(_lesson_embedding_row(subj.id, version, ls.id, [t[:200] for (t,) in texts]))
+        else:
+            rows = [_lesson_embedding_row(subj.id, version, ls.id, heads.get(ls.id, ())) for ls in lessons]
+        insert_batches(db, LessonEmbedding, rows, batch_size)
+        save()
+
+    if not incremental:
+        with _stage(timings, "snapshot"):
+            write_snapshot(db, subj.id, version)
+
+    invalidated = 0
+    if incremental:
+        with _stage(timings, "cache"):
+            invalidated = invalidate_pages(db, subj.id, changed + removed_pages + relabeled, commit=False) if dirty else 0
+            # Other processes key their TOC index and local answer copies on the revision.
+            db.query(Subject).filter(Subject.id == subj.id).update(
+                {Subject.content_revision: Subject.content_revision + 1}, synchronize_session=False
+            )
+            # The whole in-place update becomes visible at once.
+            db.commit()
+            db.refresh(subj)
+    else:
+        with _stage(timings, "flip"):
+            # One commit makes the new generation (and its fingerprints) live.
+            db.query(PageFingerprint).filter(PageFingerprint.subject_id == subj.id).delete(synchronize_session=False)
+            insert_batches(db, PageFingerprint, fingerprints, batch_size)
+            db.query(Subject).filter(Subject.id == subj.id).update(
+                {Subject.content_version: version, Subject.content_flipped_at: datetime.utcnow()}, synchronize_session=False
+            )
+            db.commit()
+            db.refresh(subj)
+
+    if incremental and (dirty or not snapshot_path(subj.id, version).exists()):
+        # Rewritten from the committed rows; until it lands readers use the previous file.
+        with _stage(timings, "snapshot"):
+            write_snapshot(db, subj.id, version)
+    invalidate_toc_index(subj.id)
+    if active is not None and version != active:
+        # Cache keys embed the version, so old answers simply stop matching; the GC
+        # reclaims them with the old rows once in-flight readers are done.
+        schedule_generation_gc(db.get_bind(), subj.id, gc_delay_sec)
+
+    quality = classify_pdf_quality(page_metrics)
+    log.info(
+        "ingested %s (%s, v%d): %d pages, %d changed, %d chunks, quality %s, %d workers, stages %s",
+        subject_code,
+        "incremental" if incremental else "full",
+        version,
+        pages,
+        len(changed),
+        chunk_count,
+        quality,
+        workers,
+        timings,
+    )
+    return {
+        "subject": subject_code,
+        "mode": "incremental" if incremental else "full",
+        "content_version": version,
+        "content_revision": subj.content_revision,
+        "toc_items": len(toc_items),
+        "toc_kept": len(existing_ids) - len(removed_toc),
+        "pages": pages,
+        "changed_pages": len(changed),
+        "removed_pages": len(removed_pages),
+        "relabeled_pages": len(relabeled),
+        "chunks": chunk_count,
+        "cache_invalidated": invalidated,
+        "quality": quality,
+        "workers": workers,
+        "timings": timings,
+    }
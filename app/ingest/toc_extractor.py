@@ -1,70 +1,86 @@
 import json
-import re
+import tempfile
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from typing import IO, Iterator
 import fitz
-from pypdf import PdfReader
 
-AR_TOC_KEYWORDS = ["الفهرس", "المحتويات", "الوحدة", "الدرس"]
+from app.ingest.page_extract import PageRecord, iter_pages
 
 
-def extract_from_outlines(pdf_path: str):
+@dataclass
+class PdfScan:
+    """Everything read from the PDF in one pass: the outline, one text-less record of
+    per-page signals per page, and the page texts spooled to a temporary file so they
+    can be streamed into chunking without being held in memory."""
+
+    outline: list[dict]
+    pages: list[PageRecord]
+    _spool: IO[bytes] = field(repr=False)
+    _spans: list[tuple[int, int]] = field(repr=False)
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pages)
+
+    def iter_texts(self) -> Iterator[tuple[PageRecord, str]]:
+        """``(record, text)`` per page, read back from the spool in page order."""
+        for rec, (offset, size) in zip(self.pages, self._spans):
+            self._spool.seek(offset)
+            yield rec, self._spool.read(size).decode("utf-8")
+
+    def close(self) -> None:
+        self._spool.close()
+
+    def __enter__(self) -> "PdfScan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def scan_pdf(pdf_path: str, workers: int | None = None) -> PdfScan:
+    doc = fitz.open(pdf_path)
+    try:
+        outline = extract_from_outlines(doc)
+    finally:
+        doc.close()
+    spool = tempfile.TemporaryFile()
+    pages: list[PageRecord] = []
+    spans: list[tuple[int, int]] = []
+    try:
+        for rec in iter_pages(pdf_path, workers):
+            data = rec.text.encode("utf-8")
+            spans.append((spool.tell(), len(data)))
+            spool.write(data)
+            pages.append(replace(rec, text=""))
+    except BaseException:
+        spool.close()
+        raise
+    return PdfScan(outline, pages, spool, spans)
+
+
+def extract_from_outlines(doc):
     try:
-        reader = PdfReader(pdf_path)
-        out = []
-        def walk(items, level=1):
-            for it in items:
-                if isinstance(it, list):
-                    walk(it, level + 1)
-                else:
-                    title = getattr(it, "title", "").strip()
-                    page = reader.get_destination_page_number(it) if hasattr(reader, "get_destination_page_number") else None
-                    if title:
-                        out.append({"title": title, "level": level, "page": page})
-        walk(reader.outline)
-        return out
+        return [
+            {"title": title.strip(), "level": level, "page": page - 1 if page > 0 else None}
+            for level, title, page in doc.get_toc(simple=True)
+            if title.strip()
+        ]
     except Exception:
         return []
 
 
-def extract_from_toc_pages(pdf_path: str):
-    doc = fitz.open(pdf_path)
-    items = []
-    pattern = re.compile(r"(.+?)\s+([0-9]{1,3})$")
-    for i in range(min(25, doc.page_count)):
-        text = doc[i].get_text("text")
-        if any(k in text for k in AR_TOC_KEYWORDS):
-            for line in text.splitlines():
-                m = pattern.search(line.strip())
-                if m:
-                    items.append({"title": m.group(1).strip(" ."), "printed_page": int(m.group(2)), "level": 2})
-    return items
-
-
-def extract_by_heading_heuristic(pdf_path: str):
-    doc = fitz.open(pdf_path)
-    items = []
-    for i in range(doc.page_count):
-        blocks = doc[i].get_text("dict").get("blocks", [])
-        for b in blocks:
-            for l in b.get("lines", []):
-                for s in l.get("spans", []):
-                    t = s.get("text", "").strip()
-                    if len(t) > 4 and s.get("size", 0) >= 14 and ("الدرس" in t or "الوحدة" in t):
-                        items.append({"title": t, "level": 2, "page": i})
-                        break
-    return items
-
-
-def compute_page_mapping(pdf_path: str):
-    doc = fitz.open(pdf_path)
-    mapping = {}
-    num_pattern = re.compile(r"\b([0-9]{1,3})\b")
-    for i in range(doc.page_count):
-        text = doc[i].get_text("text")[-500:]
-        nums = num_pattern.findall(text)
-        if nums:
-            mapping[int(nums[-1])] = i
-    return mapping
+def extract_from_toc_pages(scan: PdfScan):
+    return [{"title": title, "printed_page": printed, "level": 2} for rec in scan.pages for title, printed in rec.toc_lines]
+
+
+def extract_by_heading_heuristic(scan: PdfScan):
+    return [{"title": t, "level": 2, "page": rec.index} for rec in scan.pages for t in rec.headings]
+
+
+def compute_page_mapping(scan: PdfScan):
+    return {rec.printed_page: rec.index for rec in scan.pages if rec.printed_page is not None}
 
 
 def validate_toc_targets(toc_items, page_mapping):
@@ -76,17 +92,22 @@ def validate_toc_targets(toc_items, page_mapping):
     return validated
 
 
-def extract_toc_with_fallback(pdf_path: str, subject_code: str, output_dir: str = "data/toc"):
-    toc = extract_from_outlines(pdf_path)
-    method = "A_outlines"
-    if not toc:
-        toc = extract_from_toc_pages(pdf_path)
-        method = "B_toc_pages"
-    if not toc:
-        toc = extract_by_heading_heuristic(pdf_path)
-        method = "C_heading_heuristic"
-
-    mapping = compute_page_mapping(pdf_path)
+def extract_toc_with_fallback(pdf_path: str, subject_code: str, output_dir: str = "data/toc", scan: PdfScan | None = None):
+    owned = scan is None
+    scan = scan_pdf(pdf_path) if owned else scan
+    try:
+        toc = scan.outline
+        method = "A_outlines"
+        if not toc:
+            toc = extract_from_toc_pages(scan)
+            method = "B_toc_pages"
+        if not toc:
+            toc = extract_by_heading_heuristic(scan)
+            method = "C_heading_heuristic"
+        mapping = compute_page_mapping(scan)
+    finally:
+        if owned:
+            scan.close()
     validated = validate_toc_targets(toc, mapping)
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import ForeignKey, String, Integer, DateTime, Text, Boolean, Float, UniqueConstraint
+from sqlalchemy import ForeignKey, String, Integer, DateTime, Text, Boolean, Float, UniqueConstraint, Index, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from pgvector.sqlalchemy import Vector
 from app.db.base import Base
@@ -12,13 +12,21 @@ class Subject(Base):
     code: Mapped[str] = mapped_column(String(32), unique=True)
     pdf_path: Mapped[str] = mapped_column(String(255))
     content_version: Mapped[int] = mapped_column(Integer, default=1)
+    # Bumped by every in-place (incremental) reindex; process caches key on it.
+    content_revision: Mapped[int] = mapped_column(Integer, default=0)
+    # When ``content_version`` last flipped; older generations are collectable after
+    # GENERATION_GC_DELAY_SEC from here.
+    content_flipped_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
 class TocItem(Base):
     __tablename__ = "toc_items"
+    __table_args__ = (Index("ix_toc_items_subject_version", "subject_id", "content_version"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    # Content rows belong to one generation; readers only see the subject's active one.
+    content_version: Mapped[int] = mapped_column(Integer, default=1)
     parent_id: Mapped[int | None] = mapped_column(ForeignKey("toc_items.id"), nullable=True)
     title: Mapped[str] = mapped_column(String(512))
     level: Mapped[int] = mapped_column(Integer)
@@ -30,18 +38,88 @@ class TocItem(Base):
 
 class Chunk(Base):
     __tablename__ = "chunks"
+    __table_args__ = (Index("ix_chunks_subject_version_page", "subject_id", "content_version", "pdf_page_index"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    content_version: Mapped[int] = mapped_column(Integer, default=1)
     toc_item_id: Mapped[int | None] = mapped_column(ForeignKey("toc_items.id"), nullable=True)
     pdf_page_index: Mapped[int] = mapped_column(Integer)
     printed_page_number: Mapped[int | None] = mapped_column(Integer, nullable=True)
     content: Mapped[str] = mapped_column(Text)
+    token_count: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Deferred so plain chunk loads (quiz, cached retrieval) don't pull 1536 floats per row.
+    embedding: Mapped[list[float] | None] = mapped_column(Vector(1536), nullable=True, deferred=True)
+
+
+class ChunkTerm(Base):
+    """Inverted-index posting: one row per (chunk, normalized term)."""
+
+    __tablename__ = "chunk_terms"
+    __table_args__ = (Index("ix_chunk_terms_subject_version_term_page", "subject_id", "content_version", "term", "pdf_page_index"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    content_version: Mapped[int] = mapped_column(Integer, default=1)
+    chunk_id: Mapped[int] = mapped_column(ForeignKey("chunks.id"))
+    term: Mapped[str] = mapped_column(String(64))
+    pdf_page_index: Mapped[int] = mapped_column(Integer)
+    tf: Mapped[int] = mapped_column(Integer, default=1)
+
+
+class ChunkSentence(Base):
+    """Quotable sentence of a chunk with the features answer assembly scores on."""
+
+    __tablename__ = "chunk_sentences"
+    __table_args__ = (Index("ix_chunk_sentences_chunk_position", "chunk_id", "position"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    chunk_id: Mapped[int] = mapped_column(ForeignKey("chunks.id"))
+    position: Mapped[int] = mapped_column(Integer)
+    char_offset: Mapped[int] = mapped_column(Integer)
+    length: Mapped[int] = mapped_column(Integer)
+    norm: Mapped[str] = mapped_column(Text)
+    arabic_letters: Mapped[int] = mapped_column(Integer, default=0)
+    latin_letters: Mapped[int] = mapped_column(Integer, default=0)
+    is_question: Mapped[bool] = mapped_column(Boolean, default=False)
+
+
+class TermStat(Base):
+    """BM25 document frequency of a term within one subject generation."""
+
+    __tablename__ = "term_stats"
+    __table_args__ = (UniqueConstraint("subject_id", "content_version", "term", name="uq_term_stats_subject_version_term"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    content_version: Mapped[int] = mapped_column(Integer)
+    term: Mapped[str] = mapped_column(String(64))
+    df: Mapped[int] = mapped_column(Integer)
+
+
+class CorpusStat(Base):
+    """BM25 corpus size and average chunk length for one subject generation."""
+
+    __tablename__ = "corpus_stats"
+    __table_args__ = (UniqueConstraint("subject_id", "content_version", name="uq_corpus_stats_subject_version"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    content_version: Mapped[int] = mapped_column(Integer)
+    doc_count: Mapped[int] = mapped_column(Integer)
+    avg_doc_len: Mapped[float] = mapped_column(Float)
+
+
+class PageFingerprint(Base):
+    """Digest of one page's extracted text and block layout; unchanged pages skip reindex."""
+
+    __tablename__ = "page_fingerprints"
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"), primary_key=True)
+    pdf_page_index: Mapped[int] = mapped_column(Integer, primary_key=True)
+    digest: Mapped[str] = mapped_column(String(64))
 
 
 class LessonEmbedding(Base):
     __tablename__ = "lesson_embeddings"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
+    content_version: Mapped[int] = mapped_column(Integer, default=1)
     toc_item_id: Mapped[int] = mapped_column(ForeignKey("toc_items.id"))
     summary: Mapped[str] = mapped_column(Text)
     embedding: Mapped[list[float]] = mapped_column(Vector(1536))
@@ -59,7 +137,7 @@ class User(Base):
 class UserSession(Base):
     __tablename__ = "user_sessions"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), unique=True)
     subject_id: Mapped[int | None] = mapped_column(ForeignKey("subjects.id"), nullable=True)
     toc_item_id: Mapped[int | None] = mapped_column(ForeignKey("toc_items.id"), nullable=True)
     selected_range_start: Mapped[int | None] = mapped_column(Integer, nullable=True)
@@ -99,6 +177,15 @@ class SubjectUnlock(Base):
     subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"))
 
 
+class UsageCounter(Base):
+    """Questions asked per (user, subject); the demo quota reads this, not ``event_logs``."""
+
+    __tablename__ = "usage_counters"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    subject_id: Mapped[int] = mapped_column(ForeignKey("subjects.id"), primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, default=0)
+
+
 class EventLog(Base):
     __tablename__ = "event_logs"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -108,18 +195,39 @@ class EventLog(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
-class RateLimitBucket(Base):
-    __tablename__ = "rate_limit_buckets"
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    user_id: Mapped[int] = mapped_column(Integer)
-    bucket: Mapped[str] = mapped_column(String(32))
-    window_start: Mapped[datetime] = mapped_column(DateTime)
-    count: Mapped[int] = mapped_column(Integer, default=0)
+class RateLimitState(Base):
+    """GCRA state: one row per (user, bucket), updated in place."""
+
+    __tablename__ = "rate_limit_states"
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket: Mapped[str] = mapped_column(String(32), primary_key=True)
+    # Theoretical arrival time, epoch seconds.
+    tat: Mapped[float] = mapped_column(Float)
+    interval_sec: Mapped[float] = mapped_column(Float)
+    window_sec: Mapped[float] = mapped_column(Float)
+    allowed: Mapped[bool] = mapped_column(Boolean, default=True)
 
 
 class CacheEntry(Base):
     __tablename__ = "cache_entries"
+    __table_args__ = (
+        Index("ix_cache_entries_subject_version", "subject_id", "content_version"),
+        Index("ix_cache_entries_expires_at", "expires_at"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     cache_key: Mapped[str] = mapped_column(String(512), unique=True)
     value: Mapped[str] = mapped_column(Text)
     expires_at: Mapped[datetime] = mapped_column(DateTime)
+    # Tags for the sweeper: superseded-version invalidation and size-capped LRU eviction.
+    subject_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    content_version: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    size_bytes: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_hit_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    # PDF page range the value was derived from (NULL = open-ended / whole subject).
+    page_start: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    page_end: Mapped[int | None] = mapped_column(Integer, nullable=True)
+
+
+# Serves the sweeper's LRU scan (ORDER BY coalesce(last_hit_at, created_at), id).
+Index("ix_cache_entries_lru", func.coalesce(CacheEntry.last_hit_at, CacheEntry.created_at), CacheEntry.id)
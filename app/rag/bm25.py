@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.db.bulk import insert_batches
+from app.models.entities import Chunk, ChunkTerm, CorpusStat, TermStat
+
+K1 = 1.2
+B = 0.75
+RRF_K = 60
+
+
+@dataclass(frozen=True)
+class Bm25Stats:
+    doc_count: int
+    avg_doc_len: float
+    df: dict[str, int]
+
+    def idf(self, term: str) -> float:
+        n = self.df.get(term, 0)
+        return math.log(1.0 + (self.doc_count - n + 0.5) / (n + 0.5))
+
+
+def bm25_score(tfs: dict[str, int], doc_len: int | None, stats: Bm25Stats, k1: float = K1, b: float = B) -> float:
+    avg = stats.avg_doc_len or 1.0
+    norm = k1 * (1.0 - b + b * (doc_len if doc_len is not None else avg) / avg)
+    return sum(stats.idf(t) * tf * (k1 + 1.0) / (tf + norm) for t, tf in tfs.items())
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> dict[int, float]:
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+def build_bm25_stats(db: Session, subject_id: int, content_version: int, commit: bool = True) -> Bm25Stats:
+    """Precompute corpus statistics from the subject's postings (run at ingest)."""
+    db.query(TermStat).filter(TermStat.subject_id == subject_id, TermStat.content_version == content_version).delete()
+    db.query(CorpusStat).filter(CorpusStat.subject_id == subject_id, CorpusStat.content_version == content_version).delete()
+
+    doc_count, avg_len = (
+        db.query(func.count(Chunk.id), func.avg(Chunk.token_count))
+        .filter(Chunk.subject_id == subject_id, Chunk.content_version == content_version)
+        .one()
+    )
+    df = dict(
+        db.query(ChunkTerm.term, func.count(ChunkTerm.id))
+        .filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == content_version)
+        .group_by(ChunkTerm.term)
+        .all()
+    )
+    db.add(CorpusStat(subject_id=subject_id, content_version=content_version, doc_count=int(doc_count or 0), avg_doc_len=float(avg_len or 0.0)))
+    insert_batches(db, TermStat, ({"subject_id": subject_id, "content_version": content_version, "term": t, "df": int(n)} for t, n in df.items()))
+    if commit:
+        db.commit()
+    return Bm25Stats(doc_count=int(doc_count or 0), avg_doc_len=float(avg_len or 0.0), df=df)
+
+
+def load_bm25_stats(db: Session, subject_id: int, content_version: int, terms: list[str]) -> Bm25Stats:
+    """Statistics for the query terms; aggregates live postings if ingest didn't store any."""
+    corpus = (
+        db.query(CorpusStat)
+        .filter(CorpusStat.subject_id == subject_id, CorpusStat.content_version == content_version)
+        .first()
+    )
+    if corpus is not None:
+        df = dict(
+            db.query(TermStat.term, TermStat.df).filter(
+                TermStat.subject_id == subject_id,
+                TermStat.content_version == content_version,
+                TermStat.term.in_(terms),
+            )
+        )
+        return Bm25Stats(doc_count=corpus.doc_count, avg_doc_len=corpus.avg_doc_len, df=df)
+
+    doc_count, avg_len = (
+        db.query(func.count(Chunk.id), func.avg(Chunk.token_count))
+        .filter(Chunk.subject_id == subject_id, Chunk.content_version == content_version)
+        .one()
+    )
+    df = dict(
+        db.query(ChunkTerm.term, func.count(ChunkTerm.id))
+        .filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == content_version, ChunkTerm.term.in_(terms))
+        .group_by(ChunkTerm.term)
+    )
+    return Bm25Stats(doc_count=int(doc_count or 0), avg_doc_len=float(avg_len or 0.0), df=df)
+
+
+def chunk_lengths(db: Session, chunk_ids) -> dict[int, int | None]:
+    ids = list(chunk_ids)
+    out: dict[int, int | None] = {}
+    for i in range(0, len(ids), 500):
+        out.update(dict(db.query(Chunk.id, Chunk.token_count).filter(Chunk.id.in_(ids[i : i + 500]))))
+    return out
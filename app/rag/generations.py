@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, union
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.models.entities import (
+    CacheEntry,
+    Chunk,
+    ChunkSentence,
+    ChunkTerm,
+    CorpusStat,
+    LessonEmbedding,
+    Subject,
+    TermStat,
+    TocItem,
+    UserSession,
+)
+from app.rag.snapshot import remove_snapshot
+
+log = logging.getLogger(__name__)
+
+
+# Content rows carry the content_version they were ingested under; a rebuild writes a new
+# generation beside the live one, flips Subject.content_version, then collects the old one.
+def active_version(subject_id: int):
+    """Scalar subquery for the subject's live ``content_version``."""
+    return select(Subject.content_version).where(Subject.id == subject_id).scalar_subquery()
+
+
+def version_or_active(subject_id: int, content_version: int | None):
+    return active_version(subject_id) if content_version is None else content_version
+
+
+def drop_generation(db: Session, subject_id: int, content_version: int) -> int:
+    """Delete every content row of one generation (no commit); returns chunks removed."""
+    chunk_ids = select(Chunk.id).where(Chunk.subject_id == subject_id, Chunk.content_version == content_version)
+    toc_ids = select(TocItem.id).where(TocItem.subject_id == subject_id, TocItem.content_version == content_version)
+    db.query(ChunkSentence).filter(ChunkSentence.chunk_id.in_(chunk_ids)).delete(synchronize_session=False)
+    db.query(ChunkTerm).filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == content_version).delete(
+        synchronize_session=False
+    )
+    db.query(LessonEmbedding).filter(LessonEmbedding.subject_id == subject_id, LessonEmbedding.content_version == content_version).delete(
+        synchronize_session=False
+    )
+    n = db.query(Chunk).filter(Chunk.subject_id == subject_id, Chunk.content_version == content_version).delete(synchronize_session=False)
+    db.query(UserSession).filter(UserSession.toc_item_id.in_(toc_ids)).update({UserSession.toc_item_id: None}, synchronize_session=False)
+    db.query(TocItem).filter(TocItem.id.in_(toc_ids)).update({TocItem.parent_id: None}, synchronize_session=False)
+    db.query(TocItem).filter(TocItem.subject_id == subject_id, TocItem.content_version == content_version).delete(synchronize_session=False)
+    db.query(TermStat).filter(TermStat.subject_id == subject_id, TermStat.content_version == content_version).delete(synchronize_session=False)
+    db.query(CorpusStat).filter(CorpusStat.subject_id == subject_id, CorpusStat.content_version == content_version).delete(
+        synchronize_session=False
+    )
+    return n
+
+
+def _remap_sessions(db: Session, subject_id: int, active: int) -> int:
+    """Point sessions at the active generation's TOC row with the same title and range."""
+    live = {
+        (t.title, t.level, t.start_pdf_page, t.end_pdf_page): t.id
+        for t in db.query(TocItem).filter(TocItem.subject_id == subject_id, TocItem.content_version == active)
+    }
+    stale = (
+        db.query(TocItem)
+        .join(UserSession, UserSession.toc_item_id == TocItem.id)
+        .filter(TocItem.subject_id == subject_id, TocItem.content_version < active)
+        .distinct()
+        .all()
+    )
+    for t in stale:
+        db.query(UserSession).filter(UserSession.toc_item_id == t.id).update(
+            {UserSession.toc_item_id: live.get((t.title, t.level, t.start_pdf_page, t.end_pdf_page))}, synchronize_session=False
+        )
+    return len(stale)
+
+
+def collect_old_generations(db: Session, subject_id: int) -> dict[str, int]:
+    """Drop generations older than the active one; newer ones may be a build in progress."""
+    active = db.query(Subject.content_version).filter(Subject.id == subject_id).scalar()
+    report = {"generations": 0, "chunks": 0, "sessions": 0, "cache_entries": 0}
+    if active is None:
+        return report
+    versions = db.execute(
+        union(
+            select(Chunk.content_version).where(Chunk.subject_id == subject_id, Chunk.content_version < active),
+            select(TocItem.content_version).where(TocItem.subject_id == subject_id, TocItem.content_version < active),
+            select(CorpusStat.content_version).where(CorpusStat.subject_id == subject_id, CorpusStat.content_version < active),
+        )
+    ).scalars().all()
+    report["sessions"] = _remap_sessions(db, subject_id, active)
+    for v in versions:
+        report["chunks"] += drop_generation(db, subject_id, v)
+        db.commit()
+        remove_snapshot(subject_id, v)
+    report["generations"] = len(versions)
+    report["cache_entries"] = (
+        db.query(CacheEntry)
+        .filter(CacheEntry.subject_id == subject_id, CacheEntry.content_version.is_not(None), CacheEntry.content_version < active)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return report
+
+
+def collect_due_generations(db: Session, delay_sec: float | None = None) -> dict[str, int]:
+    """``collect_old_generations`` for subjects flipped at least ``delay_sec`` ago."""
+    delay = settings.GENERATION_GC_DELAY_SEC if delay_sec is None else delay_sec
+    cutoff = datetime.utcnow() - timedelta(seconds=delay)
+    due = db.query(Subject.id).filter(Subject.content_flipped_at.is_not(None), Subject.content_flipped_at <= cutoff).all()
+    report = {"subjects": 0, "generations": 0, "chunks": 0, "sessions": 0, "cache_entries": 0}
+    for (subject_id,) in due:
+        report["subjects"] += 1
+        for k, v in collect_old_generations(db, subject_id).items():
+            report[k] += v
+    return report
+
+
+def schedule_generation_gc(bind, subject_id: int, delay_sec: float | None = None) -> threading.Thread | None:
+    # Daemon timer: a short-lived process exits without waiting and collect_due_generations
+    # finishes the job later. A delay of 0 runs inline.
+    delay = settings.GENERATION_GC_DELAY_SEC if delay_sec is None else delay_sec
+
+    def run() -> None:
+        time.sleep(delay)
+        try:
+            with Session(bind=bind) as db:
+                log.info("generation gc for subject %s: %s", subject_id, collect_old_generations(db, subject_id))
+        except Exception:
+            log.exception("generation gc failed for subject %s", subject_id)
+
+    if delay <= 0:
+        run()
+        return None
+    t = threading.Thread(target=run, name=f"generation-gc-{subject_id}", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,119 @@
+"""Per-chunk sentence rows used by answer assembly.
+
+Splitting, normalization and the letter counts behind the noise filter run once at
+ingest instead of on every answer.
+"""
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+
+from sqlalchemy.orm import Session
+
+from app.db.bulk import insert_batches
+from app.ingest.pdf_text_utils import normalize_arabic
+from app.models.entities import Chunk, ChunkSentence
+from app.rag.generations import version_or_active
+
+_SPLIT_RE = re.compile(r"[\n\.؛!?]+")
+_NUMERIC_RE = re.compile(r"[\d\s\-–—.,:;()]+")
+MIN_SENTENCE_LEN = 25
+
+
+@dataclass(frozen=True)
+class Sentence:
+    offset: int
+    length: int
+    norm: str
+    arabic_letters: int
+    latin_letters: int
+    is_question: bool
+
+    def text(self, content: str) -> str:
+        return content[self.offset : self.offset + self.length]
+
+    @property
+    def is_clean(self) -> bool:
+        """Mostly Arabic prose rather than formulas, labels or OCR noise."""
+        return self.arabic_letters >= 8 and self.latin_letters <= self.arabic_letters
+
+
+def split_sentences(text: str) -> list[Sentence]:
+    """Sentence-like snippets of ``text`` long enough to quote, in document order."""
+    text = text or ""
+    bounds = [(m.start(), m.end()) for m in _SPLIT_RE.finditer(text)] + [(len(text), len(text))]
+    out: list[Sentence] = []
+    pos = 0
+    for sep_start, sep_end in bounds:
+        part = text[pos:sep_start]
+        start = pos + len(part) - len(part.lstrip())
+        pos = sep_end
+        stripped = part.strip()
+        if len(stripped) < MIN_SENTENCE_LEN or _NUMERIC_RE.fullmatch(stripped):
+            continue
+        out.append(
+            Sentence(
+                offset=start,
+                length=len(stripped),
+                norm=normalize_arabic(stripped).lower(),
+                arabic_letters=sum(1 for ch in stripped if "\u0600" <= ch <= "\u06FF"),
+                latin_letters=sum(1 for ch in stripped if "a" <= ch.lower() <= "z"),
+                is_question="؟" in stripped or "?" in stripped,
+            )
+        )
+    return out
+
+
+def index_chunk_sentences(db: Session, subject_id: int, rows) -> int:
+    """Add sentence rows for already-flushed chunks; returns the number written."""
+
+    def sentence_rows():
+        for ch in rows:
+            for pos, s in enumerate(split_sentences(ch.content)):
+                yield {
+                    "subject_id": subject_id,
+                    "chunk_id": ch.id,
+                    "position": pos,
+                    "char_offset": s.offset,
+                    "length": s.length,
+                    "norm": s.norm,
+                    "arabic_letters": s.arabic_letters,
+                    "latin_letters": s.latin_letters,
+                    "is_question": s.is_question,
+                }
+
+    return insert_batches(db, ChunkSentence, sentence_rows())
+
+
+def build_sentence_index(db: Session, subject_id: int, content_version: int | None = None) -> int:
+    """Rebuild sentence rows for one generation (the active one by default)."""
+    version = version_or_active(subject_id, content_version)
+    chunks = db.query(Chunk).filter(Chunk.subject_id == subject_id, Chunk.content_version == version)
+    db.query(ChunkSentence).filter(ChunkSentence.chunk_id.in_(chunks.with_entities(Chunk.id))).delete(synchronize_session=False)
+    written = index_chunk_sentences(db, subject_id, chunks.order_by(Chunk.id.asc()).yield_per(500))
+    db.commit()
+    return written
+
+
+def load_sentences(db: Session, chunk_ids) -> dict[int, list[Sentence]]:
+    """Stored sentences per chunk id; chunks indexed before this table have no entry."""
+    ids = list(chunk_ids)
+    if not ids:
+        return {}
+    q = (
+        db.query(
+            ChunkSentence.chunk_id,
+            ChunkSentence.char_offset,
+            ChunkSentence.length,
+            ChunkSentence.norm,
+            ChunkSentence.arabic_letters,
+            ChunkSentence.latin_letters,
+            ChunkSentence.is_question,
+        )
+        .filter(ChunkSentence.chunk_id.in_(ids))
+        .order_by(ChunkSentence.chunk_id.asc(), ChunkSentence.position.asc())
+    )
+    out: dict[int, list[Sentence]] = {}
+    for cid, *fields in q:
+        out.setdefault(cid, []).append(Sentence(*fields))
+    return out
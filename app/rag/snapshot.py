@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.models.entities import Chunk, ChunkTerm, CorpusStat
+from app.rag.embeddings import EMBED_DIM, deterministic_embedding
+
+# Memory-mapped per-subject corpus, rows ordered by page; snapshot_path is a symlink to the
+# build being served, swapped with one rename so readers always see a complete snapshot.
+_ARRAYS = (
+    "chunk_ids",
+    "pages",
+    "toc_ids",
+    "printed",
+    "token_counts",
+    "text_offsets",
+    "id_order",
+    "post_rows",
+    "post_tf",
+    "embeddings",
+    "term_offsets",
+    "term_start",
+    "term_stop",
+)
+
+
+def snapshot_path(subject_id: int, content_version: int, base_dir: str | None = None) -> Path:
+    return Path(base_dir or settings.SNAPSHOT_DIR, str(subject_id), f"v{content_version}")
+
+
+def _blob(path: Path) -> np.ndarray:
+    return np.memmap(path, dtype=np.uint8, mode="r") if path.stat().st_size else np.zeros(0, np.uint8)
+
+
+def remove_snapshot(subject_id: int, content_version: int, base_dir: str | None = None) -> None:
+    """Delete the served link, the build it points to and any leftover builds."""
+    final = snapshot_path(subject_id, content_version, base_dir)
+    if final.is_symlink():
+        final.unlink()
+    else:
+        shutil.rmtree(final, ignore_errors=True)
+    for old in final.parent.glob(final.name + ".*"):
+        shutil.rmtree(old, ignore_errors=True)
+
+
+class CorpusSnapshot:
+    def __init__(self, path: Path):
+        self.path = path
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        self.subject_id: int = meta["subject_id"]
+        self.content_version: int = meta["content_version"]
+        self.doc_count: int = meta["doc_count"]
+        self.avg_doc_len: float = meta["avg_doc_len"]
+        for name in _ARRAYS:
+            setattr(self, name, np.load(path / f"{name}.npy", mmap_mode="r"))
+        self.embeddings = self.embeddings[: len(self)]
+        self.sorted_ids = np.asarray(self.chunk_ids[self.id_order])
+        self.text_blob = _blob(path / "text.bin")
+        # Terms sorted by UTF-8 bytes; term i spans term_offsets[i:i+2] of the blob and
+        # its postings are post_rows/post_tf[term_start[i]:term_stop[i]].
+        self.term_blob = _blob(path / "terms.bin")
+
+    def __len__(self) -> int:
+        return int(self.chunk_ids.shape[0])
+
+    def row_range(self, lesson_range) -> tuple[int, int]:
+        lo, hi = 0, len(self)
+        if lesson_range:
+            start, end = lesson_range
+            if start is not None:
+                lo = int(np.searchsorted(self.pages, start, side="left"))
+            if end is not None:
+                hi = int(np.searchsorted(self.pages, end, side="right"))
+        return lo, hi
+
+    def _term(self, i: int) -> bytes:
+        return bytes(self.term_blob[int(self.term_offsets[i]) : int(self.term_offsets[i + 1])])
+
+    def _find_term(self, term: str) -> int:
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self.term_start)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self.term_start) and self._term(lo) == key else -1
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        i = self._find_term(term)
+        if i < 0:
+            return np.zeros(0, np.int32), np.zeros(0, np.int32)
+        start, stop = int(self.term_start[i]), int(self.term_stop[i])
+        return self.post_rows[start:stop], self.post_tf[start:stop]
+
+    def df(self, term: str) -> int:
+        # One posting per (term, chunk), so df is the postings length.
+        i = self._find_term(term)
+        return int(self.term_stop[i] - self.term_start[i]) if i >= 0 else 0
+
+    def text(self, row: int) -> str:
+        a, b = int(self.text_offsets[row]), int(self.text_offsets[row + 1])
+        return bytes(self.text_blob[a:b]).decode("utf-8")
+
+    def similarities(self, rows: np.ndarray, qv) -> np.ndarray:
+        if rows.size == 0:
+            return np.zeros(0, np.float32)
+        return self.embeddings[rows] @ np.asarray(qv, dtype=np.float32)
+
+    def rows_for_ids(self, chunk_ids) -> list[int]:
+        ids = np.asarray(list(chunk_ids), dtype=np.int64)
+        if ids.size == 0 or self.sorted_ids.size == 0:
+            return []
+        pos = np.minimum(np.searchsorted(self.sorted_ids, ids), self.sorted_ids.size - 1)
+        hit = self.sorted_ids[pos] == ids
+        return self.id_order[pos[hit]].tolist()
+
+    def chunk(self, row: int) -> Chunk:
+        """Detached ``Chunk`` carrying the fields answer assembly and citations read."""
+        toc_id = int(self.toc_ids[row])
+        printed = int(self.printed[row])
+        return Chunk(
+            id=int(self.chunk_ids[row]),
+            subject_id=self.subject_id,
+            toc_item_id=toc_id if toc_id >= 0 else None,
+            pdf_page_index=int(self.pages[row]),
+            printed_page_number=printed if printed >= 0 else None,
+            content=self.text(row),
+            token_count=int(self.token_counts[row]),
+        )
+
+
+def write_snapshot(db: Session, subject_id: int, content_version: int, base_dir: str | None = None) -> Path:
+    """Stream one generation into a new build directory and swap ``snapshot_path`` to it."""
+    final = snapshot_path(subject_id, content_version, base_dir)
+    tmp = final.with_name(f"{final.name}.{time.time_ns()}-{os.getpid()}")
+    tmp.mkdir(parents=True)
+
+    live = (Chunk.subject_id == subject_id, Chunk.content_version == content_version)
+    n = db.query(Chunk.id).filter(*live).count()
+    chunk_ids = np.zeros(n, np.int64)
+    pages = np.zeros(n, np.int32)
+    toc_ids = np.full(n, -1, np.int64)
+    printed = np.full(n, -1, np.int32)
+    token_counts = np.zeros(n, np.int32)
+    text_offsets = np.zeros(n + 1, np.int64)
+    embeddings = np.lib.format.open_memmap(tmp / "embeddings.npy", mode="w+", dtype=np.float32, shape=(max(n, 1), EMBED_DIM))
+
+    q = (
+        db.query(Chunk.id, Chunk.pdf_page_index, Chunk.toc_item_id, Chunk.printed_page_number, Chunk.token_count, Chunk.content, Chunk.embedding)
+        .filter(*live)
+        .order_by(Chunk.pdf_page_index.asc(), Chunk.id.asc())
+        .yield_per(500)
+    )
+    offset = 0
+    with open(tmp / "text.bin", "wb") as blob:
+        for row, (cid, page, toc_id, pp, tc, content, emb) in enumerate(q):
+            data = (content or "").encode("utf-8")
+            blob.write(data)
+            offset += len(data)
+            chunk_ids[row], pages[row], token_counts[row], text_offsets[row + 1] = cid, page, tc or 0, offset
+            if toc_id is not None:
+                toc_ids[row] = toc_id
+            if pp is not None:
+                printed[row] = pp
+            embeddings[row] = emb if emb is not None else deterministic_embedding((content or "")[:500])
+    embeddings.flush()
+    del embeddings
+
+    row_of = {int(cid): i for i, cid in enumerate(chunk_ids)}
+    # term -> [start, stop) into post_rows/post_tf
+    vocab: dict[str, list[int]] = {}
+    post_rows: list[int] = []
+    post_tf: list[int] = []
+    terms = (
+        db.query(ChunkTerm.term, ChunkTerm.chunk_id, ChunkTerm.tf)
+        .filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == content_version)
+        .order_by(ChunkTerm.term.asc(), ChunkTerm.pdf_page_index.asc(), ChunkTerm.chunk_id.asc())
+        .yield_per(5000)
+    )
+    for term, cid, tf in terms:
+        row = row_of.get(cid)
+        if row is None:
+            continue
+        entry = vocab.get(term)
+        if entry is None:
+            entry = vocab[term] = [len(post_rows), len(post_rows)]
+        entry[1] += 1
+        post_rows.append(row)
+        post_tf.append(tf)
+
+    corpus = (
+        db.query(CorpusStat)
+        .filter(CorpusStat.subject_id == subject_id, CorpusStat.content_version == content_version)
+        .first()
+    )
+    avg_len = corpus.avg_doc_len if corpus else (float(token_counts.mean()) if n else 0.0)
+    arrays = {
+        "chunk_ids": chunk_ids,
+        "pages": pages,
+        "toc_ids": toc_ids,
+        "printed": printed,
+        "token_counts": token_counts,
+        "text_offsets": text_offsets,
+        "id_order": np.argsort(chunk_ids, kind="stable").astype(np.int64),
+        "post_rows": np.asarray(post_rows, dtype=np.int32),
+        "post_tf": np.asarray(post_tf, dtype=np.int32),
+    }
+    # Byte order, not the database collation, so readers can bisect the raw blob.
+    encoded = sorted((term.encode("utf-8"), span) for term, span in vocab.items())
+    del vocab
+    term_offsets = np.zeros(len(encoded) + 1, np.int64)
+    with open(tmp / "terms.bin", "wb") as blob:
+        for i, (key, _) in enumerate(encoded):
+            blob.write(key)
+            term_offsets[i + 1] = term_offsets[i] + len(key)
+    arrays["term_offsets"] = term_offsets
+    arrays["term_start"] = np.asarray([span[0] for _, span in encoded], dtype=np.int64)
+    arrays["term_stop"] = np.asarray([span[1] for _, span in encoded], dtype=np.int64)
+    for name, arr in arrays.items():
+        np.save(tmp / f"{name}.npy", arr)
+    meta = {"subject_id": subject_id, "content_version": content_version, "doc_count": n, "avg_doc_len": avg_len}
+    (tmp / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+
+    _swap(final, tmp)
+    return final
+
+
+def _swap(final: Path, build: Path) -> None:
+    """Point the ``final`` symlink at ``build`` with one rename and drop older builds."""
+    if final.exists() and not final.is_symlink():
+        # Plain directory written before builds were symlinked; moved aside, removed below.
+        os.replace(final, final.with_name(f"{final.name}.{time.time_ns()}-old"))
+    link = final.with_name(f"{final.name}.link{os.getpid()}")
+    if link.is_symlink():
+        link.unlink()
+    os.symlink(build.name, link)
+    os.replace(link, final)
+    # Processes that already opened an older build keep their mappings.
+    for old in final.parent.glob(final.name + ".*"):
+        if old.name != build.name and not old.is_symlink():
+            shutil.rmtree(old, ignore_errors=True)
+
+
+_LOADED: dict[Path, CorpusSnapshot] = {}
+_LOCK = threading.Lock()
+
+
+def load_snapshot(subject_id: int, content_version: int, base_dir: str | None = None) -> CorpusSnapshot | None:
+    """Process-wide cached snapshot, reopened when the link points at a new build."""
+    path = snapshot_path(subject_id, content_version, base_dir)
+    try:
+        # Resolve once so every file comes from the same build even if a swap lands mid-open.
+        target = Path(os.path.realpath(path, strict=True)) if path.is_symlink() else None
+    except OSError:
+        return None
+    if target is None:
+        return None
+    hit = _LOADED.get(path)
+    if hit is not None and hit.path == target:
+        return hit
+    with _LOCK:
+        hit = _LOADED.get(path)
+        if hit is not None and hit.path == target:
+            return hit
+        try:
+            snap = CorpusSnapshot(target)
+        except OSError:
+            # Build swapped out and removed between resolve and open; serve from the DB.
+            return None
+        _LOADED[path] = snap
+        return snap
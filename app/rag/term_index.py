@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import re
+from collections import Counter
+
+from sqlalchemy.orm import Session
+
+from app.db.bulk import insert_batches
+from app.ingest.pdf_text_utils import normalize_arabic
+from app.models.entities import Chunk, ChunkTerm
+from app.rag.generations import version_or_active
+
+STOP_TERMS = {"ما", "ماذا", "هل", "هي", "هو", "على", "الى", "إلى", "في", "من", "عن", "احسب", "اكتب", "عرّف", "عرف", "the", "what", "is"}
+# Word characters plus Arabic combining marks; Arabic punctuation (، ؛ ؟) separates terms.
+_TERM_RE = re.compile(r"[\w\u064B-\u065F\u0670]+")
+MAX_TERM_LEN = 64
+
+
+def tokenize(text: str) -> list[str]:
+    """Normalized tokens of length >= 3, the unit stored in the term index."""
+    norm = normalize_arabic(text or "").lower()
+    return [t[:MAX_TERM_LEN] for t in _TERM_RE.findall(norm) if len(t) >= 3]
+
+
+def query_terms(query: str) -> list[str]:
+    return [t for t in tokenize(query) if t not in STOP_TERMS]
+
+
+def canonical_query(query: str) -> str:
+    """Order-insensitive form of ``query`` used for cache keys.
+
+    Spelling variants, punctuation, stop words and word order collapse to the same
+    sorted token list. Unlike ``query_terms`` short tokens and numbers are kept, so
+    questions that differ only in a value never share a key.
+    """
+    tokens = [t[:MAX_TERM_LEN] for t in _TERM_RE.findall(normalize_arabic(query or "").lower())]
+    terms = [t for t in tokens if t not in STOP_TERMS]
+    return " ".join(sorted(terms or tokens))
+
+
+def index_chunk_rows(db: Session, subject_id: int, rows) -> int:
+    """Add postings for already-flushed chunks; returns the number of postings written."""
+
+    def postings():
+        for ch in rows:
+            tokens = tokenize(ch.content)
+            if ch.token_count is None:
+                ch.token_count = len(tokens)
+            for term, tf in Counter(tokens).items():
+                yield {
+                    "subject_id": subject_id,
+                    "content_version": ch.content_version,
+                    "chunk_id": ch.id,
+                    "term": term,
+                    "pdf_page_index": ch.pdf_page_index,
+                    "tf": tf,
+                }
+
+    return insert_batches(db, ChunkTerm, postings())
+
+
+def build_term_index(db: Session, subject_id: int, content_version: int | None = None) -> int:
+    """Rebuild postings for one generation (the active one by default)."""
+    version = version_or_active(subject_id, content_version)
+    db.query(ChunkTerm).filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == version).delete(synchronize_session=False)
+    rows = (
+        db.query(Chunk)
+        .filter(Chunk.subject_id == subject_id, Chunk.content_version == version)
+        .order_by(Chunk.id.asc())
+        .yield_per(500)
+    )
+    written = index_chunk_rows(db, subject_id, rows)
+    db.commit()
+    return written
+
+
+def has_term_index(db: Session, subject_id: int, content_version: int | None = None) -> bool:
+    version = version_or_active(subject_id, content_version)
+    return db.query(ChunkTerm.id).filter(ChunkTerm.subject_id == subject_id, ChunkTerm.content_version == version).first() is not None
+
+
+def term_postings_with_pages(
+    db: Session,
+    subject_id: int,
+    terms: list[str],
+    lesson_range: tuple[int | None, int | None] | None = None,
+    content_version: int | None = None,
+) -> tuple[dict[int, dict[str, int]], dict[int, int]]:
+    """Chunk id -> {term: tf} for chunks containing any of ``terms``, plus chunk id -> page."""
+    if not terms:
+        return {}, {}
+    q = db.query(ChunkTerm.chunk_id, ChunkTerm.term, ChunkTerm.tf, ChunkTerm.pdf_page_index).filter(
+        ChunkTerm.subject_id == subject_id,
+        ChunkTerm.content_version == version_or_active(subject_id, content_version),
+        ChunkTerm.term.in_(set(terms)),
+    )
+    if lesson_range:
+        start, end = lesson_range
+        if start is not None:
+            q = q.filter(ChunkTerm.pdf_page_index >= start)
+        if end is not None:
+            q = q.filter(ChunkTerm.pdf_page_index <= end)
+    postings: dict[int, dict[str, int]] = {}
+    pages: dict[int, int] = {}
+    for chunk_id, term, tf, page in q:
+        postings.setdefault(chunk_id, {})[term] = tf
+        pages[chunk_id] = page
+    return postings, pages
+
+
+def term_postings(
+    db: Session,
+    subject_id: int,
+    terms: list[str],
+    lesson_range: tuple[int | None, int | None] | None = None,
+    content_version: int | None = None,
+) -> dict[int, dict[str, int]]:
+    """Chunk id -> {term: tf} for every chunk containing at least one of ``terms``."""
+    return term_postings_with_pages(db, subject_id, terms, lesson_range, content_version)[0]
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.models.entities import Chunk
+from app.rag.embeddings import deterministic_embedding
+from app.rag.generations import version_or_active
+
+
+def _uses_pgvector(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _range_filter(q, lesson_range):
+    if lesson_range:
+        start, end = lesson_range
+        if start is not None:
+            q = q.filter(Chunk.pdf_page_index >= start)
+        if end is not None:
+            q = q.filter(Chunk.pdf_page_index <= end)
+    return q
+
+
+def chunk_similarities(db: Session, chunk_ids, qv) -> dict[int, float]:
+    """Cosine similarity between ``qv`` and the stored embedding of each chunk.
+
+    Postgres computes the distance server-side; other backends (SQLite tests) fall
+    back to NumPy. Chunks without a stored embedding are embedded on the fly.
+    """
+    ids = list(chunk_ids)
+    if not ids:
+        return {}
+    out: dict[int, float] = {}
+    if _uses_pgvector(db):
+        rows = (
+            db.query(Chunk.id, Chunk.embedding.cosine_distance(qv))
+            .filter(Chunk.id.in_(ids), Chunk.embedding.isnot(None))
+            .all()
+        )
+        out = {cid: 1.0 - float(dist) for cid, dist in rows}
+    else:
+        q = np.asarray(qv, dtype=np.float32)
+        for cid, emb in db.query(Chunk.id, Chunk.embedding).filter(Chunk.id.in_(ids), Chunk.embedding.isnot(None)):
+            out[cid] = float(np.dot(np.asarray(emb, dtype=np.float32), q))
+    missing = [cid for cid in ids if cid not in out]
+    if missing:
+        q = np.asarray(qv, dtype=np.float32)
+        for cid, content in db.query(Chunk.id, Chunk.content).filter(Chunk.id.in_(missing)):
+            out[cid] = float(np.dot(np.asarray(deterministic_embedding((content or "")[:500]), dtype=np.float32), q))
+    return out
+
+
+def nearest_chunks(
+    db: Session, subject_id: int, qv, lesson_range=None, limit: int = 50, content_version: int | None = None
+) -> list[tuple[int, float]]:
+    """Page-range-filtered nearest neighbours as ``(chunk_id, similarity)``, best first.
+
+    On Postgres this is served by the HNSW index; elsewhere it is a brute-force scan.
+    """
+    live = (Chunk.subject_id == subject_id, Chunk.content_version == version_or_active(subject_id, content_version), Chunk.embedding.isnot(None))
+    if _uses_pgvector(db):
+        dist = Chunk.embedding.cosine_distance(qv)
+        q = db.query(Chunk.id, dist).filter(*live)
+        rows = _range_filter(q, lesson_range).order_by(dist).limit(limit).all()
+        return [(cid, 1.0 - float(d)) for cid, d in rows]
+
+    q = db.query(Chunk.id, Chunk.embedding).filter(*live)
+    rows = _range_filter(q, lesson_range).all()
+    if not rows:
+        return []
+    mat = np.asarray([emb for _, emb in rows], dtype=np.float32)
+    sims = mat @ np.asarray(qv, dtype=np.float32)
+    order = np.argsort(-sims)[:limit]
+    return [(rows[i][0], float(sims[i])) for i in order]
@@ -1,30 +1,361 @@
 import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from weakref import WeakKeyDictionary
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.models.entities import CacheEntry
+from app.core.config import settings
+from app.models.entities import CacheEntry, Subject
 
 
 def make_cache_key(*parts: str) -> str:
     return hashlib.sha256("||".join(parts).encode()).hexdigest()
 
 
-def get_cache(db: Session, key: str):
+class LocalCache:
+    """Thread-safe, size-bounded LRU with per-entry deadlines (``time.monotonic``).
+
+    Entries may carry a ``tag``; a lookup with a different tag is a miss, which lets
+    callers retire entries across processes by changing the tag they look up with.
+    """
+
+    def __init__(self, max_entries: int, max_ttl_sec: float):
+        self.max_entries = max_entries
+        self.max_ttl_sec = max_ttl_sec
+        self._items: OrderedDict[str, tuple[float, str, int | None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str, tag: int | None = None) -> str | None:
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is not None and (hit[0] <= time.monotonic() or (tag is not None and hit[2] != tag)):
+                del self._items[key]
+                self.expirations += 1
+                hit = None
+            if hit is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return hit[1]
+
+    def peek(self, key: str, tag: int | None = None) -> str | None:
+        """Live value without touching recency or counters."""
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None or hit[0] <= time.monotonic() or (tag is not None and hit[2] != tag):
+                return None
+            return hit[1]
+
+    def put(self, key: str, value: str, ttl_sec: float, tag: int | None = None) -> None:
+        ttl = min(ttl_sec, self.max_ttl_sec)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value, tag)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# One local tier per database, like the TOC index cache.
+_LOCAL: "WeakKeyDictionary[object, LocalCache]" = WeakKeyDictionary()
+_LOCAL_LOCK = threading.Lock()
+_MISS_PREFIX = "miss:"
+_TOUCH_INTERVAL = timedelta(hours=1)
+
+
+def _local_for(db) -> LocalCache:
+    bind = db.get_bind()
+    local = _LOCAL.get(bind)
+    if local is None:
+        with _LOCAL_LOCK:
+            local = _LOCAL.get(bind)
+            if local is None:
+                local = _LOCAL[bind] = LocalCache(settings.CACHE_LOCAL_MAX_ENTRIES, settings.CACHE_LOCAL_TTL_SEC)
+    return local
+
+
+def _remember(db, key: str, value: str, expires_at: datetime, revision: int | None = None) -> None:
+    _local_for(db).put(key, value, (expires_at - datetime.utcnow()).total_seconds(), revision)
+
+
+def cache_stats() -> dict[str, int]:
+    """Local-tier counters summed over every database this process has used."""
+    totals = {"size": 0, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+    for local in list(_LOCAL.values()):
+        for k, v in local.stats().items():
+            totals[k] += v
+    return totals
+
+
+def clear_local_cache() -> None:
+    for local in list(_LOCAL.values()):
+        local.clear()
+
+
+def remember_miss(db, key: str, ttl_sec: int | None = None, revision: int | None = None) -> None:
+    """Negative entry: ``key`` produced nothing worth storing; kept in-process only."""
+    ttl = settings.CACHE_NEGATIVE_TTL_SEC if ttl_sec is None else ttl_sec
+    _local_for(db).put(_MISS_PREFIX + key, "", ttl, revision)
+
+
+def is_known_miss(db, key: str, revision: int | None = None) -> bool:
+    return _local_for(db).peek(_MISS_PREFIX + key, revision) is not None
+
+
+def _entry_fields(value: str, exp: datetime, subject_id: int | None, content_version: int | None, page_range) -> dict:
+    start, end = page_range or (None, None)
+    return {
+        "value": value,
+        "expires_at": exp,
+        "subject_id": subject_id,
+        "content_version": content_version,
+        "size_bytes": len(value.encode("utf-8")),
+        "page_start": start,
+        "page_end": end,
+    }
+
+
+def _needs_touch(row: CacheEntry, now: datetime) -> bool:
+    """``last_hit_at`` is coarse (it only orders eviction), so refresh it at most hourly."""
+    return row.last_hit_at is None or now - row.last_hit_at > _TOUCH_INTERVAL
+
+
+def get_cache(db: Session, key: str, revision: int | None = None):
+    # ``revision`` is the subject's content_revision: local copies from before an
+    # in-place reindex fall through to the table, where invalidate_pages ran.
+    local = _local_for(db)
+    value = local.get(key, revision)
+    if value is not None:
+        return value
     row = db.query(CacheEntry).filter(CacheEntry.cache_key == key).first()
     if not row:
         return None
-    if row.expires_at < datetime.utcnow():
+    now = datetime.utcnow()
+    if row.expires_at < now:
         db.delete(row)
         db.commit()
         return None
+    if _needs_touch(row, now):
+        row.last_hit_at = now
+        db.commit()
+    _remember(db, key, row.value, row.expires_at, revision)
     return row.value
 
 
-def set_cache(db: Session, key: str, value: str, ttl_days: int):
+def set_cache(
+    db: Session,
+    key: str,
+    value: str,
+    ttl_days: int,
+    subject_id: int | None = None,
+    content_version: int | None = None,
+    page_range: tuple[int | None, int | None] | None = None,
+    revision: int | None = None,
+):
     exp = datetime.utcnow() + timedelta(days=ttl_days)
+    local = _local_for(db)
+    local.discard(_MISS_PREFIX + key)
+    if local.peek(key, revision) == value:
+        return
     row = db.query(CacheEntry).filter(CacheEntry.cache_key == key).first()
+    if row and row.value == value and row.expires_at > datetime.utcnow():
+        _remember(db, key, value, row.expires_at, revision)
+        return
+    fields = _entry_fields(value, exp, subject_id, content_version, page_range)
+    if row:
+        for k, v in fields.items():
+            setattr(row, k, v)
+    else:
+        db.add(CacheEntry(cache_key=key, **fields))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another writer inserted the key first; last write wins.
+        db.rollback()
+        db.query(CacheEntry).filter(CacheEntry.cache_key == key).update(fields)
+        db.commit()
+    _remember(db, key, value, exp, revision)
+
+
+async def get_cache_async(db: AsyncSession, key: str, revision: int | None = None):
+    local = _local_for(db)
+    value = local.get(key, revision)
+    if value is not None:
+        return value
+    row = (await db.execute(select(CacheEntry).where(CacheEntry.cache_key == key))).scalars().first()
+    if not row:
+        return None
+    now = datetime.utcnow()
+    if row.expires_at < now:
+        await db.delete(row)
+        await db.commit()
+        return None
+    if _needs_touch(row, now):
+        row.last_hit_at = now
+        await db.commit()
+    _remember(db, key, row.value, row.expires_at, revision)
+    return row.value
+
+
+async def set_cache_async(
+    db: AsyncSession,
+    key: str,
+    value: str,
+    ttl_days: int,
+    subject_id: int | None = None,
+    content_version: int | None = None,
+    page_range: tuple[int | None, int | None] | None = None,
+    revision: int | None = None,
+):
+    exp = datetime.utcnow() + timedelta(days=ttl_days)
+    local = _local_for(db)
+    local.discard(_MISS_PREFIX + key)
+    if local.peek(key, revision) == value:
+        return
+    row = (await db.execute(select(CacheEntry).where(CacheEntry.cache_key == key))).scalars().first()
+    if row and row.value == value and row.expires_at > datetime.utcnow():
+        _remember(db, key, value, row.expires_at, revision)
+        return
+    fields = _entry_fields(value, exp, subject_id, content_version, page_range)
     if row:
-        row.value = value
-        row.expires_at = exp
+        for k, v in fields.items():
+            setattr(row, k, v)
     else:
-        db.add(CacheEntry(cache_key=key, value=value, expires_at=exp))
-    db.commit()
+        db.add(CacheEntry(cache_key=key, **fields))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        await db.execute(update(CacheEntry).where(CacheEntry.cache_key == key).values(**fields))
+        await db.commit()
+    _remember(db, key, value, exp, revision)
+
+
+def _page_spans(pages, max_spans: int = 64) -> list[tuple[int, int]]:
+    spans: list[list[int]] = []
+    for p in sorted(set(pages)):
+        if spans and p == spans[-1][1] + 1:
+            spans[-1][1] = p
+        else:
+            spans.append([p, p])
+    if len(spans) > max_spans:
+        # Scattered edits: one covering span keeps the DELETE simple at the cost of extra misses.
+        return [(spans[0][0], spans[-1][1])]
+    return [(a, b) for a, b in spans]
+
+
+def invalidate_pages(db: Session, subject_id: int, pages=None, commit: bool = True) -> int:
+    """Delete the subject's entries whose page range touches ``pages`` (every entry of
+    the subject when ``pages`` is None); untagged ranges count as the whole book.
+    With ``commit=False`` the delete joins the caller's transaction."""
+    q = db.query(CacheEntry).filter(CacheEntry.subject_id == subject_id)
+    if pages is not None:
+        spans = _page_spans(pages)
+        if not spans:
+            return 0
+        q = q.filter(
+            or_(
+                *[
+                    and_(
+                        or_(CacheEntry.page_start.is_(None), CacheEntry.page_start <= b),
+                        or_(CacheEntry.page_end.is_(None), CacheEntry.page_end >= a),
+                    )
+                    for a, b in spans
+                ]
+            )
+        )
+    n = q.delete(synchronize_session=False)
+    if commit:
+        db.commit()
+    # The local tier is not range-tagged; other processes drop their copies when the
+    # subject's content_revision moves.
+    clear_local_cache()
+    return n
+
+
+def _delete_batches(db: Session, ids_stmt, batch_size: int) -> tuple[int, int]:
+    """Delete rows selected by ``ids_stmt`` (id, size_bytes) in committed batches."""
+    rows = bytes_ = 0
+    while True:
+        batch = db.execute(ids_stmt.limit(batch_size)).all()
+        if not batch:
+            return rows, bytes_
+        db.query(CacheEntry).filter(CacheEntry.id.in_([r[0] for r in batch])).delete(synchronize_session=False)
+        db.commit()
+        rows += len(batch)
+        bytes_ += sum(r[1] or 0 for r in batch)
+        if len(batch) < batch_size:
+            return rows, bytes_
+
+
+def sweep_cache(
+    db: Session,
+    batch_size: int | None = None,
+    max_rows: int | None = None,
+    max_bytes: int | None = None,
+) -> dict[str, int]:
+    """Reclaim ``cache_entries``: expired rows, rows tagged with a superseded
+    ``content_version``, then least recently hit rows over the row/byte caps."""
+    batch_size = batch_size or settings.CACHE_SWEEP_BATCH
+    max_rows = settings.CACHE_MAX_ROWS if max_rows is None else max_rows
+    max_bytes = settings.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    report = {"expired": 0, "superseded": 0, "evicted": 0, "bytes_freed": 0}
+    cols = select(CacheEntry.id, CacheEntry.size_bytes)
+
+    n, b = _delete_batches(db, cols.where(CacheEntry.expires_at < datetime.utcnow()), batch_size)
+    report["expired"] += n
+    report["bytes_freed"] += b
+
+    stale = cols.join(Subject, Subject.id == CacheEntry.subject_id).where(
+        CacheEntry.content_version.is_not(None), CacheEntry.content_version != Subject.content_version
+    )
+    n, b = _delete_batches(db, stale, batch_size)
+    report["superseded"] += n
+    report["bytes_freed"] += b
+
+    count, total = db.query(func.count(CacheEntry.id), func.coalesce(func.sum(CacheEntry.size_bytes), 0)).one()
+    lru = cols.order_by(func.coalesce(CacheEntry.last_hit_at, CacheEntry.created_at).asc(), CacheEntry.id.asc())
+    while count > max_rows or total > max_bytes:
+        victims = []
+        for cid, size in db.execute(lru.limit(batch_size)):
+            if count <= max_rows and total <= max_bytes:
+                break
+            victims.append(cid)
+            count -= 1
+            total -= size or 0
+            report["bytes_freed"] += size or 0
+        if not victims:
+            break
+        db.query(CacheEntry).filter(CacheEntry.id.in_(victims)).delete(synchronize_session=False)
+        db.commit()
+        report["evicted"] += len(victims)
+    return report
@@ -1,35 +1,140 @@
+import csv
 import secrets
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+from sqlalchemy import insert, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.models.entities import Coupon, Redemption, Subscription, SubjectUnlock, Subject, User
+from app.db.upsert import dialect_insert
+from app.models.entities import Coupon, Redemption, Subscription, SubjectUnlock, Subject
+from app.services.entitlements import invalidate_entitlements
+from app.services.users import ensure_user_id, ensure_user_id_async
+
+
+@dataclass
+class CouponBatchReport:
+    created: int = 0
+    collisions: int = 0
+    seconds: float = 0.0
+    path: str | None = None
+
+    @property
+    def per_second(self) -> float:
+        return self.created / self.seconds if self.seconds else 0.0
+
+
+def _new_code() -> str:
+    return f"EDU-{secrets.token_hex(4).upper()}"
+
+
+def generate_coupons_bulk(
+    db: Session,
+    kind: str,
+    count: int,
+    subject_code: str | None = None,
+    csv_path: str | Path | None = None,
+    batch_size: int = 2000,
+    on_codes: Callable[[list[str]], None] | None = None,
+) -> CouponBatchReport:
+    """Create ``count`` unique coupons with batched multi-row inserts.
+
+    Codes that collide with existing ones are skipped by ``ON CONFLICT DO NOTHING`` and
+    regenerated in the next round. Each committed batch is appended to ``csv_path``
+    (``code,kind,subject_code``) and/or passed to ``on_codes``.
+    """
+    report = CouponBatchReport(path=str(csv_path) if csv_path else None)
+    started = time.perf_counter()
+    bind = db.get_bind()
+    fh = None
+    if csv_path:
+        Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
+        fh = open(csv_path, "w", newline="", encoding="utf-8")
+        writer = csv.writer(fh)
+        writer.writerow(["code", "kind", "subject_code"])
+    try:
+        while report.created < count:
+            want = min(batch_size, count - report.created)
+            codes = {_new_code() for _ in range(want)}
+            stmt = (
+                dialect_insert(bind, Coupon)
+                .values([{"code": c, "kind": kind, "subject_code": subject_code, "is_used": False} for c in codes])
+                .on_conflict_do_nothing(index_elements=[Coupon.code])
+                .returning(Coupon.code)
+            )
+            inserted = db.execute(stmt).scalars().all()
+            db.commit()
+            report.created += len(inserted)
+            report.collisions += want - len(inserted)
+            if fh:
+                writer.writerows((c, kind, subject_code or "") for c in inserted)
+            if on_codes:
+                on_codes(inserted)
+    finally:
+        if fh:
+            fh.close()
+    report.seconds = time.perf_counter() - started
+    return report
 
 
 def generate_coupons(db: Session, kind: str, count: int, subject_code: str | None = None):
-    out = []
-    for _ in range(count):
-        code = f"EDU-{secrets.token_hex(4).upper()}"
-        db.add(Coupon(code=code, kind=kind, subject_code=subject_code, is_used=False))
-        out.append(code)
-    db.commit()
+    out: list[str] = []
+    generate_coupons_bulk(db, kind, count, subject_code, on_codes=out.extend)
     return out
 
 
+def _claim_stmt(code: str):
+    # Only one concurrent caller can flip is_used; everyone else gets no row back.
+    return (
+        update(Coupon)
+        .where(Coupon.code == code, Coupon.is_used == False)  # noqa: E712
+        .values(is_used=True)
+        .returning(Coupon.id, Coupon.kind, Coupon.subject_code)
+    )
+
+
+def _grant_stmt(bind, user_id: int, kind: str, subject_code: str | None):
+    if kind == "subscription":
+        stmt = dialect_insert(bind, Subscription).values(user_id=user_id, active=True)
+        return stmt.on_conflict_do_update(index_elements=[Subscription.user_id], set_={"active": True})
+    if kind == "subject_unlock" and subject_code:
+        subject = select(literal(user_id), Subject.id).where(Subject.code == subject_code)
+        return (
+            dialect_insert(bind, SubjectUnlock)
+            .from_select([SubjectUnlock.user_id, SubjectUnlock.subject_id], subject)
+            .on_conflict_do_nothing(index_elements=[SubjectUnlock.user_id, SubjectUnlock.subject_id])
+        )
+    return None
+
+
 def redeem_coupon(db: Session, telegram_id: int, code: str):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        user = User(telegram_id=telegram_id)
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    c = db.query(Coupon).filter(Coupon.code == code, Coupon.is_used == False).first()  # noqa: E712
-    if not c:
+    """Claim ``code`` with one conditional UPDATE and grant it in the same transaction."""
+    claimed = db.execute(_claim_stmt(code)).first()
+    if not claimed:
         return False, "كود غير صالح أو مستخدم"
-    c.is_used = True
-    db.add(Redemption(coupon_id=c.id, user_id=user.id))
-    if c.kind == "subscription":
-        db.merge(Subscription(user_id=user.id, active=True))
-    elif c.kind == "subject_unlock" and c.subject_code:
-        s = db.query(Subject).filter(Subject.code == c.subject_code).first()
-        if s:
-            db.merge(SubjectUnlock(user_id=user.id, subject_id=s.id))
+    coupon_id, kind, subject_code = claimed
+    user_id = ensure_user_id(db, telegram_id)
+    db.execute(insert(Redemption).values(coupon_id=coupon_id, user_id=user_id, redeemed_at=datetime.utcnow()))
+    grant = _grant_stmt(db.get_bind(), user_id, kind, subject_code)
+    if grant is not None:
+        db.execute(grant)
     db.commit()
+    invalidate_entitlements(user_id)
+    return True, "تم التفعيل بنجاح"
+
+
+async def redeem_coupon_async(db: AsyncSession, telegram_id: int, code: str):
+    claimed = (await db.execute(_claim_stmt(code))).first()
+    if not claimed:
+        return False, "كود غير صالح أو مستخدم"
+    coupon_id, kind, subject_code = claimed
+    user_id = await ensure_user_id_async(db, telegram_id)
+    await db.execute(insert(Redemption).values(coupon_id=coupon_id, user_id=user_id, redeemed_at=datetime.utcnow()))
+    grant = _grant_stmt(db.get_bind(), user_id, kind, subject_code)
+    if grant is not None:
+        await db.execute(grant)
+    await db.commit()
+    invalidate_entitlements(user_id)
     return True, "تم التفعيل بنجاح"
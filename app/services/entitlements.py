@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.models.entities import Subscription, SubjectUnlock
+
+
+@dataclass(frozen=True)
+class Entitlements:
+    user_id: int
+    subscribed: bool
+    unlocked_subjects: frozenset[int]
+
+    def has_paid_access(self, subject_id: int) -> bool:
+        """Unlimited questions need an active subscription and the subject's unlock."""
+        return self.subscribed and subject_id in self.unlocked_subjects
+
+
+# Per database bind: user_id -> (monotonic deadline, Entitlements), LRU-bounded. Rows only
+# change on redemption, which invalidates explicitly; the TTL bounds drift from other processes.
+_CACHE: "WeakKeyDictionary[object, OrderedDict[int, tuple[float, Entitlements]]]" = WeakKeyDictionary()
+_LOCK = threading.Lock()
+
+
+def _cached(bind, user_id: int) -> Entitlements | None:
+    with _LOCK:
+        per_bind = _CACHE.get(bind)
+        hit = per_bind.get(user_id) if per_bind is not None else None
+        if hit is None:
+            return None
+        if hit[0] <= time.monotonic():
+            del per_bind[user_id]
+            return None
+        per_bind.move_to_end(user_id)
+        return hit[1]
+
+
+def _store(bind, ents: list[Entitlements]) -> None:
+    now = time.monotonic()
+    deadline = now + settings.ENTITLEMENT_TTL_SEC
+    with _LOCK:
+        per_bind = _CACHE.setdefault(bind, OrderedDict())
+        for e in ents:
+            per_bind[e.user_id] = (deadline, e)
+            per_bind.move_to_end(e.user_id)
+        while per_bind and next(iter(per_bind.values()))[0] <= now:
+            per_bind.popitem(last=False)
+        while len(per_bind) > settings.ENTITLEMENT_CACHE_SIZE:
+            per_bind.popitem(last=False)
+
+
+def _subscribed_stmt(user_ids):
+    return select(Subscription.user_id).where(Subscription.user_id.in_(user_ids), Subscription.active == True)  # noqa: E712
+
+
+def _unlocks_stmt(user_ids):
+    return select(SubjectUnlock.user_id, SubjectUnlock.subject_id).where(SubjectUnlock.user_id.in_(user_ids))
+
+
+def _assemble(user_ids, subscribed, unlocks) -> list[Entitlements]:
+    per_user: dict[int, set[int]] = {}
+    for uid, sid in unlocks:
+        per_user.setdefault(uid, set()).add(sid)
+    subscribed = set(subscribed)
+    return [Entitlements(uid, uid in subscribed, frozenset(per_user.get(uid, ()))) for uid in user_ids]
+
+
+def load_entitlements(db: Session, user_ids) -> list[Entitlements]:
+    """Fresh entitlements for ``user_ids`` (two queries total), stored in the cache."""
+    ids = list(dict.fromkeys(user_ids))
+    out: list[Entitlements] = []
+    for i in range(0, len(ids), 500):
+        part = ids[i : i + 500]
+        subscribed = db.execute(_subscribed_stmt(part)).scalars().all()
+        unlocks = db.execute(_unlocks_stmt(part)).all()
+        out.extend(_assemble(part, subscribed, unlocks))
+    _store(db.get_bind(), out)
+    return out
+
+
+def get_entitlements(db: Session, user_id: int) -> Entitlements:
+    hit = _cached(db.get_bind(), user_id)
+    if hit is not None:
+        return hit
+    return load_entitlements(db, [user_id])[0]
+
+
+async def get_entitlements_async(db: AsyncSession, user_id: int) -> Entitlements:
+    bind = db.get_bind()
+    hit = _cached(bind, user_id)
+    if hit is not None:
+        return hit
+    subscribed = (await db.execute(_subscribed_stmt([user_id]))).scalars().all()
+    unlocks = (await db.execute(_unlocks_stmt([user_id]))).all()
+    (ent,) = _assemble([user_id], subscribed, unlocks)
+    _store(bind, [ent])
+    return ent
+
+
+def warm_entitlements(db: Session) -> int:
+    """Preload every user holding a subscription or an unlock; returns how many."""
+    ids = set(db.execute(select(Subscription.user_id)).scalars()) | set(db.execute(select(SubjectUnlock.user_id)).scalars())
+    return len(load_entitlements(db, sorted(ids)))
+
+
+def peek_entitlements(user_id: int) -> Entitlements | None:
+    """Live cached entry for ``user_id`` from any bind, without loading."""
+    for bind in list(_CACHE.keys()):
+        hit = _cached(bind, user_id)
+        if hit is not None:
+            return hit
+    return None
+
+
+def entitlement_cache_size() -> int:
+    return sum(len(v) for v in list(_CACHE.values()))
+
+
+def invalidate_entitlements(user_id: int | None = None) -> None:
+    """Drop ``user_id`` (or everyone) from every bind's cache, sync and async alike."""
+    with _LOCK:
+        for per_bind in _CACHE.values():
+            if user_id is None:
+                per_bind.clear()
+            else:
+                per_bind.pop(user_id, None)
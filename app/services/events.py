@@ -0,0 +1,159 @@
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.models.entities import EventLog
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class EventSink:
+    """Buffered, best-effort ``EventLog`` writer.
+
+    ``emit`` only enqueues; a background thread writes batches with one multi-row
+    INSERT every ``batch_size`` events or ``flush_ms`` milliseconds. When the bounded
+    queue is full the event is dropped (``overflow="drop"``) or the caller waits up to
+    a second first (``overflow="block"``). Anything that must not be lost, like the
+    demo quota, belongs in a synchronous write instead.
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size: int = 200, flush_ms: int = 500, max_queue: int = 10000, overflow: str = "drop"):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_sec = flush_ms / 1000
+        self.overflow = overflow
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        # Guards the counters, which both callers and the writer thread update.
+        self._stats_lock = threading.Lock()
+        self._closed = False
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+                    self._thread.start()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def emit(self, user_id: int | None, event_type: str, payload: str = "") -> bool:
+        if self._closed:
+            self._count("dropped")
+            return False
+        row = {"user_id": user_id, "event_type": event_type, "payload": payload, "created_at": datetime.utcnow()}
+        self._ensure_started()
+        try:
+            if self.overflow == "block":
+                self._queue.put(row, timeout=1.0)
+            else:
+                self._queue.put_nowait(row)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("emitted")
+        return True
+
+    def _run(self) -> None:
+        batch: list[dict] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_sec
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch: list[dict]) -> None:
+        if not batch:
+            return
+        try:
+            with self.session_factory() as db:
+                db.execute(insert(EventLog), batch)
+                db.commit()
+            with self._stats_lock:
+                self.written += len(batch)
+                self.flushes += 1
+        except Exception:
+            self._count("failed", len(batch))
+            log.exception("event sink flush failed; dropped %d events", len(batch))
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop accepting events and flush what is queued.
+
+        Waits at most ``timeout`` for room to post the stop marker; if the writer
+        thread is gone (or the marker never fit), the queue is flushed from here.
+        """
+        self._closed = True
+        if self._thread is None:
+            return
+        if self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                log.warning("event sink queue still full after %.1fs; flushing synchronously", timeout)
+            else:
+                self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._drain()
+
+    def _drain(self) -> None:
+        batch: list[dict] = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        self._flush(batch)
+
+    def stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "emitted": self.emitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "flushes": self.flushes,
+            }
+
+
+event_sink = EventSink(
+    batch_size=settings.EVENT_SINK_BATCH,
+    flush_ms=settings.EVENT_SINK_FLUSH_MS,
+    max_queue=settings.EVENT_SINK_MAX_QUEUE,
+    overflow=settings.EVENT_SINK_OVERFLOW,
+)
@@ -1,21 +1,32 @@
 from sqlalchemy.orm import Session
-from app.models.entities import Chunk, Subject, TocItem
+from app.models.entities import Chunk, Subject
 from app.rag.embeddings import deterministic_embedding
-from app.services.cache_service import make_cache_key, get_cache, set_cache
+from app.rag.snapshot import CorpusSnapshot, load_snapshot
+from app.rag.sentences import Sentence, load_sentences, split_sentences
+from app.rag.term_index import canonical_query, has_term_index, query_terms, term_postings_with_pages, tokenize
+from app.rag.bm25 import Bm25Stats, bm25_score, chunk_lengths, load_bm25_stats, reciprocal_rank_fusion
+from app.rag.vector_index import chunk_similarities, nearest_chunks
+from app.services.cache_service import make_cache_key, get_cache, set_cache, is_known_miss, remember_miss
+from app.services.toc_service import TocIndex, get_toc_index
+from app.utils.singleflight import SingleFlight
+import numpy as np
 from rapidfuzz import fuzz
 from app.core.config import settings
 from app.ingest.pdf_text_utils import normalize_arabic
-import re
 
 
-def _cos(a, b):
-    return sum(x * y for x, y in zip(a, b))
+def _score_rows(db: Session, rows, query_norm: str, qv, overlaps: dict[int, int]):
+    sims = chunk_similarities(db, [r.id for r in rows], qv)
+    ranked = []
+    for r in rows:
+        kw_score = fuzz.token_set_ratio(query_norm, normalize_arabic((r.content or "")[:300]))
+        ranked.append((kw_score, overlaps[r.id], sims.get(r.id, 0.0), r))
+    return ranked
 
 
-def retrieve_chunks(db: Session, subject_id: int, query: str, lesson_range: tuple[int | None, int | None] | None = None, top_k: int = 5):
-    query_norm = normalize_arabic(query)
-    qv = deterministic_embedding(query_norm)
-    q = db.query(Chunk).filter(Chunk.subject_id == subject_id)
+def _scan_candidates(db: Session, subject_id: int, content_version: int, query_norm: str, qv, q_terms: list[str], lesson_range):
+    """Legacy path for subjects ingested before the term index existed."""
+    q = db.query(Chunk).filter(Chunk.subject_id == subject_id, Chunk.content_version == content_version)
     if lesson_range:
         start, end = lesson_range
         if start is not None:
@@ -23,18 +34,161 @@ def retrieve_chunks(db: Session, subject_id: int, query: str, lesson_range: tupl
         if end is not None:
             q = q.filter(Chunk.pdf_page_index <= end)
     rows = q.limit(1200).all()
-
-    stop_terms = {"ما", "ماذا", "هل", "على", "الى", "إلى", "في", "من", "عن", "احسب", "اكتب", "عرّف", "عرف", "the", "what", "is"}
-    q_terms = [t for t in re.findall(r"[\w\u0600-\u06FF]+", query_norm.lower()) if len(t) >= 3 and t not in stop_terms]
-
-    ranked = []
+    overlaps = {}
     for r in rows:
         txt = normalize_arabic(r.content or "").lower()
-        kw_score = fuzz.token_set_ratio(query_norm, normalize_arabic((r.content or "")[:300]))
-        overlap = sum(1 for t in q_terms if t in txt)
-        rv = deterministic_embedding(r.content[:500])
-        sem_score = _cos(qv, rv)
-        ranked.append((kw_score, overlap, sem_score, r))
+        overlaps[r.id] = sum(1 for t in q_terms if t in txt)
+    return _score_rows(db, rows, query_norm, qv, overlaps)
+
+
+def _fused_order(lexical: dict[int, float], sims: dict[int, float], pool_size: int) -> list[int]:
+    """Reciprocal-rank fusion of the BM25 and vector rankings; ties broken by chunk id."""
+    bm25_rank = sorted(lexical, key=lambda cid: (-lexical[cid], cid))
+    vector_rank = sorted(sims, key=lambda cid: (-sims[cid], cid))
+    pool = set(bm25_rank[:pool_size]) | set(vector_rank[:pool_size])
+    fused = reciprocal_rank_fusion([[c for c in bm25_rank if c in pool], [c for c in vector_rank if c in pool]])
+    return sorted(pool, key=lambda cid: (-fused[cid], cid))
+
+
+def _guarded(order: list[int], load, query_norm: str, top_k: int) -> list[Chunk]:
+    # Lexical guard on the fused order only, until top_k chunks survive.
+    out = []
+    batch = max(top_k * 2, 10)
+    for i in range(0, len(order), batch):
+        ids = order[i : i + batch]
+        rows = load(ids)
+        for cid in ids:
+            r = rows.get(cid)
+            if r is None:
+                continue
+            if fuzz.token_set_ratio(query_norm, normalize_arabic((r.content or "")[:300])) >= 20:
+                out.append(r)
+                if len(out) >= top_k:
+                    return out
+    return out
+
+
+def _in_range(page: int, lesson_range) -> bool:
+    if not lesson_range:
+        return True
+    start, end = lesson_range
+    return (start is None or page >= start) and (end is None or page <= end)
+
+
+def _top_lexical(lexical: dict[int, float], keys, pool_size: int) -> list[int]:
+    return sorted(keys, key=lambda cid: (-lexical[cid], cid))[:pool_size]
+
+
+def _indexed_retrieve(db: Session, subject_id: int, content_version: int, query_norm: str, qv, q_terms: list[str], lesson_range, top_k: int, suggest_k: int):
+    """BM25 over the term index fused with the vector ranking.
+
+    With ``suggest_k`` the postings are read for the whole subject once; the
+    out-of-range part is only ranked when nothing in range survives the guard.
+    """
+    postings, pages = term_postings_with_pages(db, subject_id, q_terms, None if suggest_k else lesson_range, content_version)
+    if not postings:
+        return [], []
+    stats = load_bm25_stats(db, subject_id, content_version, sorted(set(q_terms)))
+    lengths = chunk_lengths(db, postings)
+    lexical = {cid: bm25_score(tfs, lengths.get(cid), stats) for cid, tfs in postings.items()}
+    inside = {cid for cid in postings if _in_range(pages[cid], lesson_range)}
+
+    def load(ids):
+        return {r.id: r for r in db.query(Chunk).filter(Chunk.id.in_(ids)).all()}
+
+    pool_size = max(50, top_k * 10)
+    hits = []
+    if inside:
+        sims = {cid: s for cid, s in nearest_chunks(db, subject_id, qv, lesson_range, limit=pool_size, content_version=content_version) if cid in inside}
+        sims.update(chunk_similarities(db, [cid for cid in _top_lexical(lexical, inside, pool_size) if cid not in sims], qv))
+        order = _fused_order({cid: lexical[cid] for cid in inside}, sims, pool_size)
+        hits = _guarded(order, load, query_norm, top_k)
+    if hits or not suggest_k:
+        return hits, []
+
+    outside = set(postings) - inside
+    sims = chunk_similarities(db, _top_lexical(lexical, outside, pool_size), qv)
+    order = _fused_order({cid: lexical[cid] for cid in outside}, sims, pool_size)
+    return [], _guarded(order, load, query_norm, suggest_k)
+
+
+def _snapshot_retrieve(snap: CorpusSnapshot, query_norm: str, qv, q_terms: list[str], lesson_range, top_k: int, suggest_k: int):
+    """Same ranking as ``_indexed_retrieve`` served from the memory-mapped snapshot."""
+    lo, hi = snap.row_range(lesson_range)
+    scan_lo, scan_hi = (0, len(snap)) if suggest_k else (lo, hi)
+    terms = sorted(set(q_terms))
+    postings: dict[int, dict[str, int]] = {}
+    for term in terms:
+        rows, tfs = snap.postings(term)
+        keep = (rows >= scan_lo) & (rows < scan_hi)
+        for row, tf in zip(rows[keep].tolist(), tfs[keep].tolist()):
+            postings.setdefault(row, {})[term] = tf
+    if not postings:
+        return [], []
+    stats = Bm25Stats(doc_count=snap.doc_count, avg_doc_len=snap.avg_doc_len, df={t: snap.df(t) for t in terms})
+    rows = np.fromiter(postings, dtype=np.int64, count=len(postings))
+    ids = snap.chunk_ids[rows].tolist()
+    row_of = dict(zip(ids, rows.tolist()))
+    lexical = {cid: bm25_score(postings[row_of[cid]], int(snap.token_counts[row_of[cid]]), stats) for cid in ids}
+    sims = dict(zip(ids, snap.similarities(rows, qv).tolist()))
+    inside = {cid for cid in ids if lo <= row_of[cid] < hi}
+
+    def load(chunk_ids):
+        return {cid: snap.chunk(row_of[cid]) for cid in chunk_ids}
+
+    pool_size = max(50, top_k * 10)
+    order = _fused_order({c: lexical[c] for c in inside}, {c: sims[c] for c in inside}, pool_size)
+    hits = _guarded(order, load, query_norm, top_k)
+    if hits or not suggest_k:
+        return hits, []
+    outside = set(ids) - inside
+    order = _fused_order({c: lexical[c] for c in outside}, {c: sims[c] for c in outside}, pool_size)
+    return [], _guarded(order, load, query_norm, suggest_k)
+
+
+def retrieve_with_suggestions(
+    db: Session,
+    subject_id: int,
+    query: str,
+    lesson_range: tuple[int | None, int | None] | None = None,
+    top_k: int = 5,
+    suggest_k: int = 3,
+    content_version: int | None = None,
+) -> tuple[list[Chunk], list[Chunk]]:
+    """In-range top_k plus, when nothing in range qualifies, the best out-of-range chunks."""
+    query_norm = normalize_arabic(query)
+    qv = deterministic_embedding(query_norm)
+    q_terms = query_terms(query)
+
+    if content_version is None:
+        content_version = db.query(Subject.content_version).filter(Subject.id == subject_id).scalar() or settings.CONTENT_VERSION
+    snap = load_snapshot(subject_id, int(content_version))
+    if snap is not None:
+        return _snapshot_retrieve(snap, query_norm, qv, q_terms, lesson_range, top_k, suggest_k)
+    content_version = int(content_version)
+    if has_term_index(db, subject_id, content_version):
+        return _indexed_retrieve(db, subject_id, content_version, query_norm, qv, q_terms, lesson_range, top_k, suggest_k)
+
+    hits = _scan_retrieve(db, subject_id, content_version, query_norm, qv, q_terms, lesson_range, top_k)
+    if hits or not suggest_k or not lesson_range:
+        return hits, []
+    return [], _scan_retrieve(db, subject_id, content_version, query_norm, qv, q_terms, None, top_k)[:suggest_k]
+
+
+def retrieve_chunks(
+    db: Session,
+    subject_id: int,
+    query: str,
+    lesson_range: tuple[int | None, int | None] | None = None,
+    top_k: int = 5,
+    content_version: int | None = None,
+):
+    hits, _ = retrieve_with_suggestions(db, subject_id, query, lesson_range, top_k=top_k, suggest_k=0, content_version=content_version)
+    return hits
+
+
+def _scan_retrieve(db: Session, subject_id: int, content_version: int, query_norm: str, qv, q_terms: list[str], lesson_range, top_k: int):
+    ranked = _scan_candidates(db, subject_id, content_version, query_norm, qv, q_terms, lesson_range)
 
     # Hard guard against off-topic / out-of-book hallucinations:
     # require lexical overlap on meaningful terms from the question.
@@ -46,11 +200,24 @@ def retrieve_chunks(db: Session, subject_id: int, query: str, lesson_range: tupl
     return [r for _, _, _, r in filtered[:top_k]]
 
 
-def _build_citation(db: Session, subject: Subject | None, chunk: Chunk) -> str:
-    toc = db.query(TocItem).filter(TocItem.id == chunk.toc_item_id).first() if chunk.toc_item_id else None
-    unit = None
-    if toc and toc.parent_id:
-        unit = db.query(TocItem).filter(TocItem.id == toc.parent_id).first()
+def _load_chunks(db: Session, subject_id: int, content_version: int, ids: list[int]) -> list[Chunk]:
+    """Chunks for cached ids, in the cached order."""
+    if not ids:
+        return []
+    snap = load_snapshot(subject_id, content_version)
+    if snap is not None:
+        return [snap.chunk(row) for row in snap.rows_for_ids(ids)]
+    by_id = {c.id: c for c in db.query(Chunk).filter(Chunk.id.in_(ids)).all()}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def _parse_ids(value: str) -> list[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+def _build_citation(toc_index: TocIndex, subject: Subject | None, chunk: Chunk) -> str:
+    toc = toc_index.by_id.get(chunk.toc_item_id) if chunk.toc_item_id else None
+    unit = toc_index.unit_of(toc) if toc else None
 
     subject_label = subject.name_ar if subject else "المادة"
     lesson_label = toc.title if toc else "درس غير محدد"
@@ -64,69 +231,88 @@ def _build_citation(db: Session, subject: Subject | None, chunk: Chunk) -> str:
     return f"{subject_label} | {lesson_label} | {page_label}"
 
 
-def _extract_useful_lines(text: str, query: str, limit: int = 4) -> list[str]:
-    q_terms = [t for t in re.findall(r"[\w\u0600-\u06FF]+", normalize_arabic(query).lower()) if len(t) >= 3]
+def _extract_useful_lines(text: str, query: str, limit: int = 4, sentences: list[Sentence] | None = None) -> list[str]:
+    """Best quotable sentences of a chunk for ``query``; ``sentences`` are the chunk's
+    stored rows when available, otherwise the chunk is split on the fly."""
+    q_terms = tokenize(query)
+    if sentences is None:
+        sentences = split_sentences(text)
 
-    # split to sentence-like snippets for cleaner answers
-    raw_parts = re.split(r"[\n\.؛!?]+", text)
-    lines = [ln.strip() for ln in raw_parts if ln and ln.strip()]
     good = []
-    for ln in lines:
-        if re.fullmatch(r"[\d\s\-–—.,:;()]+", ln):
-            continue
-        if len(ln) < 25:
+    for sent in sentences:
+        # avoid very noisy snippets
+        if not sent.is_clean:
             continue
-        ln_norm = normalize_arabic(ln).lower()
-        score = sum(1 for t in q_terms if t in ln_norm)
+        score = sum(1 for t in q_terms if t in sent.norm)
         # prefer explanatory statements over question-list prompts
-        if "؟" not in ln and "?" not in ln:
+        if not sent.is_question:
             score += 2
-        # avoid very noisy snippets
-        arabic_letters = sum(1 for ch in ln if '\u0600' <= ch <= '\u06FF')
-        latin_letters = sum(1 for ch in ln if ('a' <= ch.lower() <= 'z'))
-        if arabic_letters < 8 or latin_letters > arabic_letters:
-            continue
         if score > 0:
-            good.append((score, ln))
+            good.append((score, sent))
     good.sort(key=lambda x: x[0], reverse=True)
-    out = [ln for _, ln in good[:limit]]
+    out = [sent.text(text) for _, sent in good[:limit]]
     if out:
         return out
+    return [sent.text(text) for sent in sentences[:limit]]
 
-    for ln in lines:
-        if len(ln) >= 25 and not re.fullmatch(r"[\d\s\-–—.,:;()]+", ln):
-            out.append(ln)
-        if len(out) >= limit:
-            break
-    return out
+
+# Identical questions arriving together (e.g. a whole class) share one computation.
+answer_flights = SingleFlight()
+
+
+def _with_watermark(answer: str, watermark: str | None) -> str:
+    return f"{answer}\n\n{watermark}" if watermark else answer
 
 
 def answer_question(db: Session, user_id: int, subject_id: int, question: str, lesson_range, watermark: str | None = None):
     subj = db.query(Subject).filter(Subject.id == subject_id).first()
     content_version = str(subj.content_version if subj else settings.CONTENT_VERSION)
+    revision = subj.content_revision if subj else 0
 
     lrange = None
     if lesson_range and isinstance(lesson_range, list) and len(lesson_range) == 2:
         lrange = (lesson_range[0], lesson_range[1])
 
-    ckey = make_cache_key("explain", str(subject_id), str(lrange), question, "det", content_version)
-    cached = get_cache(db, ckey)
+    canonical = canonical_query(question)
+    ckey = make_cache_key("explain", str(subject_id), str(lrange), canonical, "det", content_version)
+    cached = get_cache(db, ckey, revision)
     if cached:
-        return {"answer": cached, "cached": True}
-
-    rkey = make_cache_key("retrieve", str(subject_id), str(lrange), question, "det", content_version)
-    cached_retrieval = get_cache(db, rkey)
-    if cached_retrieval:
-        ids = [int(x) for x in cached_retrieval.split(",") if x]
-        if ids:
-            retrieved = db.query(Chunk).filter(Chunk.id.in_(ids)).all()
+        return {"answer": _with_watermark(cached, watermark), "cached": True}
+
+    out = answer_flights.do(ckey, lambda: _answer_uncached(db, subj, subject_id, question, lrange, content_version, ckey))
+    if out.get("cached") is False:
+        # The cached/shared answer is user-neutral; the caller's watermark goes on last.
+        out = {**out, "answer": _with_watermark(out["answer"], watermark)}
+    return out
+
+
+def _answer_uncached(db: Session, subj: Subject | None, subject_id: int, question: str, lrange, content_version: str, ckey: str):
+    rkey = make_cache_key("retrieve", str(subject_id), str(lrange), canonical_query(question), "det", content_version)
+    revision = subj.content_revision if subj else 0
+    # Cached value: "<in-range ids>|<suggested out-of-range ids>" (older entries have no "|").
+    hit_part, _, suggest_part = (get_cache(db, rkey, revision) or "").partition("|")
+    retrieved = _load_chunks(db, subject_id, int(content_version), _parse_ids(hit_part))
+    suggested = _load_chunks(db, subject_id, int(content_version), _parse_ids(suggest_part))
+    if not retrieved and not suggested and not is_known_miss(db, rkey, revision):
+        # Empty results are not persisted (avoids sticky empty entries); they are only
+        # remembered in-process for a short while so repeats skip retrieval.
+        retrieved, suggested = retrieve_with_suggestions(db, subject_id, question, lrange, content_version=int(content_version))
+        if retrieved or suggested:
+            set_cache(
+                db,
+                rkey,
+                ",".join(str(c.id) for c in retrieved) + "|" + ",".join(str(c.id) for c in suggested),
+                ttl_days=7,
+                subject_id=subject_id,
+                content_version=int(content_version),
+                # Out-of-range suggestions make the entry depend on the whole book.
+                page_range=None if suggested else lrange,
+                revision=revision,
+            )
         else:
-            # avoid sticky empty-cache scenario; recompute retrieval
-            retrieved = retrieve_chunks(db, subject_id, question, lrange)
-            set_cache(db, rkey, ",".join(str(c.id) for c in retrieved), ttl_days=7)
-    else:
-        retrieved = retrieve_chunks(db, subject_id, question, lrange)
-        set_cache(db, rkey, ",".join(str(c.id) for c in retrieved), ttl_days=7)
+            remember_miss(db, rkey, revision=revision)
+
+    toc_index = get_toc_index(db, subject_id, int(content_version), revision)
 
     # Prefer pedagogical lessons over front-matter/preface boilerplate unless explicitly asked.
     q_low = (question or "").lower()
@@ -134,7 +320,7 @@ def answer_question(db: Session, user_id: int, subject_id: int, question: str, l
     if not wants_intro and retrieved:
         cleaned = []
         for c in retrieved:
-            toc = db.query(TocItem).filter(TocItem.id == c.toc_item_id).first() if c.toc_item_id else None
+            toc = toc_index.by_id.get(c.toc_item_id) if c.toc_item_id else None
             title = (toc.title.lower() if toc and toc.title else "")
             if any(k in title for k in ["front matter", "preface", "مقدمه", "فهرس"]):
                 continue
@@ -143,16 +329,15 @@ def answer_question(db: Session, user_id: int, subject_id: int, question: str, l
             retrieved = cleaned
 
     if not retrieved:
-        # Fallback: search across the selected subject to suggest a better lesson
-        global_retrieved = retrieve_chunks(db, subject_id, question, lesson_range=None)
-        if global_retrieved:
+        # Out-of-range hits from the same retrieval pass suggest a better lesson.
+        if suggested:
             suggestions = []
             seen = set()
-            for c in global_retrieved[:3]:
-                toc = db.query(TocItem).filter(TocItem.id == c.toc_item_id).first() if c.toc_item_id else None
+            for c in suggested[:3]:
+                toc = toc_index.by_id.get(c.toc_item_id) if c.toc_item_id else None
                 if not toc:
                     continue
-                unit = db.query(TocItem).filter(TocItem.id == toc.parent_id).first() if toc.parent_id else None
+                unit = toc_index.unit_of(toc)
                 label = f"{unit.title} / {toc.title}" if unit else toc.title
                 if label in seen:
                     continue
@@ -169,7 +354,7 @@ def answer_question(db: Session, user_id: int, subject_id: int, question: str, l
             "citations": [],
         }
 
-    citations = [_build_citation(db, subj, c) for c in retrieved]
+    citations = [_build_citation(toc_index, subj, c) for c in retrieved]
     if not citations:
         return {
             "answer": "لا يمكنني الإجابة دون توثيق واضح. من فضلك اختر درساً/وحدة ثم أعد السؤال.",
@@ -177,8 +362,9 @@ def answer_question(db: Session, user_id: int, subject_id: int, question: str, l
         }
 
     extracted: list[str] = []
+    stored = load_sentences(db, [c.id for c in retrieved[:4]])
     for c in retrieved[:4]:
-        extracted.extend(_extract_useful_lines(c.content, question, limit=2))
+        extracted.extend(_extract_useful_lines(c.content, question, limit=2, sentences=stored.get(c.id)))
     # deduplicate while preserving order
     seen = set()
     filtered = []
@@ -203,7 +389,5 @@ def answer_question(db: Session, user_id: int, subject_id: int, question: str, l
             "citations": [],
         }
 
-    if watermark:
-        answer = f"{answer}\n\n{watermark}"
-    set_cache(db, ckey, answer, ttl_days=30)
+    set_cache(db, ckey, answer, ttl_days=30, subject_id=subject_id, content_version=int(content_version), page_range=lrange, revision=revision)
     return {"answer": answer, "citations": citations, "cached": False}
@@ -1,31 +1,151 @@
-from datetime import datetime, timedelta
 import math
+import threading
+import time
+from dataclasses import dataclass
+from sqlalchemy import case
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.models.entities import RateLimitBucket
+from app.core.config import settings
+from app.db.upsert import dialect_insert
+from app.models.entities import RateLimitState
 
 
-def check_limit_with_meta(db: Session, user_id: int, bucket: str, max_count: int, window_sec: int) -> tuple[bool, int]:
-    now = datetime.utcnow()
-    start = now - timedelta(seconds=window_sec)
-    row = (
-        db.query(RateLimitBucket)
-        .filter(RateLimitBucket.user_id == user_id, RateLimitBucket.bucket == bucket)
-        .order_by(RateLimitBucket.window_start.desc())
-        .first()
+# GCRA: one theoretical arrival time (TAT) per (user, bucket), upserted in a single statement.
+@dataclass(frozen=True)
+class Limit:
+    bucket: str
+    max_count: int
+    window_sec: int
+
+    @property
+    def interval(self) -> float:
+        return self.window_sec / max(self.max_count, 1)
+
+
+@dataclass(frozen=True)
+class LimitResult:
+    bucket: str
+    allowed: bool
+    retry_after_sec: float
+
+    @property
+    def minutes_left(self) -> int:
+        return 0 if self.allowed else int(math.ceil(self.retry_after_sec / 60))
+
+
+def _result(limit: Limit, allowed: bool, tat: float, now: float) -> LimitResult:
+    # Denied means tat + interval would exceed now + window; it fits again after this.
+    retry = 0.0 if allowed else max(0.0, tat + limit.interval - limit.window_sec - now)
+    return LimitResult(limit.bucket, allowed, retry)
+
+
+def _gcra_stmt(bind, user_id: int, limits: list[Limit], now: float):
+    stmt = dialect_insert(bind, RateLimitState).values(
+        [
+            {
+                "user_id": user_id,
+                "bucket": lim.bucket,
+                "tat": now + lim.interval,
+                "interval_sec": lim.interval,
+                "window_sec": float(lim.window_sec),
+                "allowed": True,
+            }
+            for lim in limits
+        ]
     )
-    if row is None or row.window_start < start:
-        row = RateLimitBucket(user_id=user_id, bucket=bucket, window_start=now, count=1)
-        db.add(row)
-        db.commit()
-        return True, 0
-    if row.count >= max_count:
-        sec_left = max(0, int((row.window_start + timedelta(seconds=window_sec) - now).total_seconds()))
-        return False, int(math.ceil(sec_left / 60))
-    row.count += 1
+    new = stmt.excluded
+    now_expr = new.tat - new.interval_sec
+    base = case((RateLimitState.tat > now_expr, RateLimitState.tat), else_=now_expr)
+    fits = base + new.interval_sec - now_expr <= new.window_sec
+    return stmt.on_conflict_do_update(
+        index_elements=[RateLimitState.user_id, RateLimitState.bucket],
+        set_={
+            "tat": case((fits, base + new.interval_sec), else_=RateLimitState.tat),
+            "allowed": fits,
+            "interval_sec": new.interval_sec,
+            "window_sec": new.window_sec,
+        },
+    ).returning(RateLimitState.bucket, RateLimitState.tat, RateLimitState.allowed)
+
+
+class MemoryRateLimiter:
+    """In-process GCRA; entries whose TAT has passed are equivalent to absent and pruned."""
+
+    def __init__(self, prune_every: int = 4096):
+        self._tat: dict[tuple[int, str], float] = {}
+        self._lock = threading.Lock()
+        self._prune_every = prune_every
+        self._since_prune = 0
+
+    def check(self, user_id: int, limits: list[Limit], now: float | None = None) -> list[LimitResult]:
+        now = time.time() if now is None else now
+        out = []
+        with self._lock:
+            for lim in limits:
+                key = (user_id, lim.bucket)
+                base = max(self._tat.get(key, now), now)
+                allowed = base + lim.interval - now <= lim.window_sec
+                if allowed:
+                    self._tat[key] = base + lim.interval
+                out.append(_result(lim, allowed, self._tat.get(key, now), now))
+                if not allowed:
+                    break
+            self._since_prune += 1
+            if self._since_prune >= self._prune_every:
+                self._since_prune = 0
+                self._tat = {k: v for k, v in self._tat.items() if v > now}
+        return out
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tat.clear()
+
+
+memory_limiter = MemoryRateLimiter()
+
+
+def _row_result(limit: Limit, row, now: float) -> LimitResult:
+    _, tat, allowed = row
+    return _result(limit, bool(allowed), tat, now)
+
+
+def check_limits(db: Session, user_id: int, limits: list[Limit]) -> list[LimitResult]:
+    # Buckets apply in order; after the first denial later ones are neither checked nor charged.
+    now = time.time()
+    if settings.RATE_LIMIT_BACKEND == "memory":
+        return memory_limiter.check(user_id, limits, now)
+    out = []
+    for lim in limits:
+        out.append(_row_result(lim, db.execute(_gcra_stmt(db.get_bind(), user_id, [lim], now)).one(), now))
+        if not out[-1].allowed:
+            break
     db.commit()
-    return True, 0
+    return out
+
+
+async def check_limits_async(db: AsyncSession, user_id: int, limits: list[Limit]) -> list[LimitResult]:
+    now = time.time()
+    if settings.RATE_LIMIT_BACKEND == "memory":
+        return memory_limiter.check(user_id, limits, now)
+    out = []
+    for lim in limits:
+        out.append(_row_result(lim, (await db.execute(_gcra_stmt(db.get_bind(), user_id, [lim], now))).one(), now))
+        if not out[-1].allowed:
+            break
+    await db.commit()
+    return out
+
+
+def check_limit_with_meta(db: Session, user_id: int, bucket: str, max_count: int, window_sec: int) -> tuple[bool, int]:
+    (res,) = check_limits(db, user_id, [Limit(bucket, max_count, window_sec)])
+    return res.allowed, res.minutes_left
 
 
 def check_limit(db: Session, user_id: int, bucket: str, max_count: int, window_sec: int) -> bool:
     ok, _ = check_limit_with_meta(db, user_id, bucket, max_count, window_sec)
     return ok
+
+
+async def check_limit_with_meta_async(db: AsyncSession, user_id: int, bucket: str, max_count: int, window_sec: int) -> tuple[bool, int]:
+    (res,) = await check_limits_async(db, user_id, [Limit(bucket, max_count, window_sec)])
+    return res.allowed, res.minutes_left
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import threading
+from bisect import bisect_left
+from itertools import accumulate
 from dataclasses import dataclass
 from typing import Iterable
+from weakref import WeakKeyDictionary
 
 from rapidfuzz import fuzz
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from app.models.entities import TocItem, Chunk
+from app.models.entities import Subject, TocItem, Chunk
 
 
 @dataclass
@@ -38,80 +44,195 @@ def _compute_end_pages(items: list[TocItem]) -> dict[int, int | None]:
     return ends
 
 
-def _is_unit(item: TocItem) -> bool:
+def _is_unit(item) -> bool:
     t = (item.title or "").strip()
     return item.level <= 1 or "الوحدة" in t
 
 
-def get_units(db: Session, subject_id: int) -> list[TocItem]:
-    items = (
-        db.query(TocItem)
-        .filter(TocItem.subject_id == subject_id)
-        .order_by(TocItem.order_index.asc(), TocItem.id.asc())
-        .all()
-    )
-    units = [it for it in items if _is_unit(it)]
-    if units:
-        return units
-    # fallback: derive virtual units by scanning lessons without explicit parents.
-    return [it for it in items if it.level <= 2][:12]
+@dataclass(frozen=True)
+class TocNode:
+    id: int
+    title: str
+    level: int
+    order_index: int
+    parent_id: int | None
+    start_pdf_page: int | None
+    end_pdf_page: int | None
+    printed_page_start: int | None
 
 
-def get_lessons_for_unit(db: Session, subject_id: int, unit_id: int) -> list[LessonView]:
-    items = (
-        db.query(TocItem)
-        .filter(TocItem.subject_id == subject_id)
-        .order_by(TocItem.order_index.asc(), TocItem.id.asc())
-        .all()
-    )
-    by_id = {x.id: x for x in items}
-    unit = by_id.get(unit_id)
-    if not unit:
-        return []
+class TocIndex:
+    """Immutable TOC tree for one (subject, content_version, content_revision)."""
 
-    ends = _compute_end_pages(items)
-
-    lessons: list[TocItem] = [x for x in items if x.parent_id == unit.id and x.id != unit.id]
-    if not lessons:
-        # fallback for flat TOC: take following non-unit items until next unit.
+    def __init__(self, subject_id: int, content_version: int, items: list[TocItem], revision: int = 0):
+        self.subject_id = subject_id
+        self.content_version = content_version
+        self.revision = revision
+        ends = _compute_end_pages(items)
         ordered = sorted(items, key=lambda x: (x.order_index, x.id))
-        uidx = next((i for i, x in enumerate(ordered) if x.id == unit.id), -1)
-        if uidx >= 0:
-            for x in ordered[uidx + 1 :]:
-                if _is_unit(x):
-                    break
-                lessons.append(x)
-
-    out: list[LessonView] = []
-    for ls in lessons:
-        out.append(
-            LessonView(
-                id=ls.id,
-                title=ls.title,
-                unit_id=unit.id,
-                unit_title=unit.title,
-                start_pdf_page=ls.start_pdf_page,
-                end_pdf_page=ends.get(ls.id),
-                printed_page_start=ls.printed_page_start,
+        self.items: tuple[TocNode, ...] = tuple(
+            TocNode(
+                id=it.id,
+                title=it.title,
+                level=it.level,
+                order_index=it.order_index,
+                parent_id=it.parent_id,
+                start_pdf_page=it.start_pdf_page,
+                end_pdf_page=ends.get(it.id),
+                printed_page_start=it.printed_page_start,
             )
+            for it in ordered
         )
-    return out
+        self.by_id: dict[int, TocNode] = {x.id: x for x in self.items}
 
+        units = [it for it in self.items if _is_unit(it)]
+        # fallback: derive virtual units by scanning lessons without explicit parents.
+        self.units: tuple[TocNode, ...] = tuple(units or [it for it in self.items if it.level <= 2][:12])
+        self._lessons_by_unit: dict[int, tuple[LessonView, ...]] = {u.id: self._build_lessons(u) for u in self.units}
 
-def search_lessons(db: Session, subject_id: int, query: str, limit: int = 3) -> list[LessonView]:
-    units = get_units(db, subject_id)
-    unit_ids = {u.id for u in units}
-    items = (
-        db.query(TocItem)
-        .filter(TocItem.subject_id == subject_id)
+        lessons = sorted(
+            (x for x in self.items if x.level >= 2 and x.start_pdf_page is not None),
+            key=lambda x: (x.start_pdf_page, x.order_index, x.id),
+        )
+        self._lesson_starts = [x.start_pdf_page for x in lessons]
+        self._lessons_by_start = lessons
+        # running max of end pages: the first lesson reaching a page is the first one covering it.
+        self._lesson_reach = list(accumulate((x.end_pdf_page if x.end_pdf_page is not None else float("inf") for x in lessons), max))
+
+    def _build_lessons(self, unit: TocNode) -> tuple[LessonView, ...]:
+        lessons = [x for x in self.items if x.parent_id == unit.id and x.id != unit.id]
+        if not lessons:
+            # fallback for flat TOC: take following non-unit items until next unit.
+            uidx = next((i for i, x in enumerate(self.items) if x.id == unit.id), -1)
+            if uidx >= 0:
+                for x in self.items[uidx + 1 :]:
+                    if _is_unit(x):
+                        break
+                    lessons.append(x)
+        return tuple(self.lesson_view(ls, unit) for ls in lessons)
+
+    def unit_of(self, node: TocNode) -> TocNode | None:
+        return self.by_id.get(node.parent_id) if node.parent_id else None
+
+    def lesson_view(self, node: TocNode, unit: TocNode | None = None) -> LessonView:
+        unit = unit or self.unit_of(node)
+        return LessonView(
+            id=node.id,
+            title=node.title,
+            unit_id=unit.id if unit else None,
+            unit_title=unit.title if unit else None,
+            start_pdf_page=node.start_pdf_page,
+            end_pdf_page=node.end_pdf_page,
+            printed_page_start=node.printed_page_start,
+        )
+
+    def lessons_for_unit(self, unit_id: int) -> list[LessonView]:
+        lessons = self._lessons_by_unit.get(unit_id)
+        if lessons is None:
+            unit = self.by_id.get(unit_id)
+            lessons = self._build_lessons(unit) if unit else ()
+        return list(lessons)
+
+    def lesson_for_page(self, page: int) -> TocNode | None:
+        i = bisect_left(self._lesson_reach, page)
+        if i < len(self._lessons_by_start) and self._lesson_starts[i] <= page:
+            return self._lessons_by_start[i]
+        return None
+
+
+_TOC_CACHE: "WeakKeyDictionary[object, dict[int, TocIndex]]" = WeakKeyDictionary()
+_TOC_LOCK = threading.Lock()
+
+
+def _cached_index(bind, subject_id: int, content_version: int, revision: int) -> TocIndex | None:
+    per_bind = _TOC_CACHE.get(bind)
+    idx = per_bind.get(subject_id) if per_bind is not None else None
+    if idx is not None and idx.content_version == content_version and idx.revision == revision:
+        return idx
+    return None
+
+
+def _version_stmt(subject_id: int):
+    return select(Subject.content_version, Subject.content_revision).where(Subject.id == subject_id)
+
+
+def _store_index(bind, idx: TocIndex) -> TocIndex:
+    with _TOC_LOCK:
+        _TOC_CACHE.setdefault(bind, {})[idx.subject_id] = idx
+    return idx
+
+
+def _toc_items_stmt(subject_id: int, content_version: int):
+    return (
+        select(TocItem)
+        .where(TocItem.subject_id == subject_id, TocItem.content_version == content_version)
         .order_by(TocItem.order_index.asc(), TocItem.id.asc())
-        .all()
     )
-    ends = _compute_end_pages(items)
-    by_id = {x.id: x for x in items}
-    by_lesson: dict[int, tuple[int, TocItem]] = {}
 
-    for it in items:
+
+def get_toc_index(db: Session, subject_id: int, content_version: int | None = None, revision: int | None = None) -> TocIndex:
+    """Cached ``TocIndex``; a new ``content_version`` or ``content_revision`` (read from
+    the subject unless given) replaces the subject's entry, in every process."""
+    if content_version is None or revision is None:
+        row = db.execute(_version_stmt(subject_id)).first()
+        live_version, live_revision = row or (0, 0)
+        content_version = live_version if content_version is None else content_version
+        revision = live_revision if revision is None else revision
+    bind = db.get_bind()
+    idx = _cached_index(bind, subject_id, content_version, revision)
+    if idx is not None:
+        return idx
+    items = db.execute(_toc_items_stmt(subject_id, content_version)).scalars().all()
+    return _store_index(bind, TocIndex(subject_id, int(content_version), items, int(revision)))
+
+
+async def get_toc_index_async(
+    db: AsyncSession, subject_id: int, content_version: int | None = None, revision: int | None = None
+) -> TocIndex:
+    if content_version is None or revision is None:
+        row = (await db.execute(_version_stmt(subject_id))).first()
+        live_version, live_revision = row or (0, 0)
+        content_version = live_version if content_version is None else content_version
+        revision = live_revision if revision is None else revision
+    bind = db.get_bind()
+    idx = _cached_index(bind, subject_id, content_version, revision)
+    if idx is not None:
+        return idx
+    items = (await db.execute(_toc_items_stmt(subject_id, content_version))).scalars().all()
+    return _store_index(bind, TocIndex(subject_id, int(content_version), items, int(revision)))
+
+
+def invalidate_toc_index(subject_id: int | None = None) -> None:
+    with _TOC_LOCK:
+        for per_bind in _TOC_CACHE.values():
+            if subject_id is None:
+                per_bind.clear()
+            else:
+                per_bind.pop(subject_id, None)
+
+
+def get_units(db: Session, subject_id: int) -> list[TocNode]:
+    return list(get_toc_index(db, subject_id).units)
+
+
+async def get_units_async(db: AsyncSession, subject_id: int) -> list[TocNode]:
+    return list((await get_toc_index_async(db, subject_id)).units)
+
+
+def get_lessons_for_unit(db: Session, subject_id: int, unit_id: int) -> list[LessonView]:
+    return get_toc_index(db, subject_id).lessons_for_unit(unit_id)
+
+
+async def get_lessons_for_unit_async(db: AsyncSession, subject_id: int, unit_id: int) -> list[LessonView]:
+    return (await get_toc_index_async(db, subject_id)).lessons_for_unit(unit_id)
+
+
+def search_lessons(db: Session, subject_id: int, query: str, limit: int = 3) -> list[LessonView]:
+    index = get_toc_index(db, subject_id)
+    unit_ids = {u.id for u in index.units}
+    by_lesson: dict[int, tuple[int, TocNode]] = {}
+
+    for it in index.items:
         if it.id in unit_ids:
             continue
         if it.level <= 1 and it.parent_id is None:
@@ -124,7 +245,7 @@ def search_lessons(db: Session, subject_id: int, query: str, limit: int = 3) ->
     if len(by_lesson) < limit:
         chunk_rows = (
             db.query(Chunk)
-            .filter(Chunk.subject_id == subject_id, Chunk.toc_item_id.isnot(None))
+            .filter(Chunk.subject_id == subject_id, Chunk.content_version == index.content_version, Chunk.toc_item_id.isnot(None))
             .limit(2500)
             .all()
         )
@@ -133,7 +254,7 @@ def search_lessons(db: Session, subject_id: int, query: str, limit: int = 3) ->
             if score < 35:
                 continue
             lesson_id = int(ch.toc_item_id)
-            toc = by_id.get(lesson_id)
+            toc = index.by_id.get(lesson_id)
             if not toc or toc.id in unit_ids:
                 continue
             prev = by_lesson.get(lesson_id)
@@ -141,38 +262,14 @@ def search_lessons(db: Session, subject_id: int, query: str, limit: int = 3) ->
                 by_lesson[lesson_id] = (score, toc)
 
     ranked = sorted(by_lesson.values(), key=lambda x: x[0], reverse=True)[:limit]
-    out: list[LessonView] = []
-    for _, it in ranked:
-        unit = by_id.get(it.parent_id) if it.parent_id else None
-        out.append(
-            LessonView(
-                id=it.id,
-                title=it.title,
-                unit_id=unit.id if unit else None,
-                unit_title=unit.title if unit else None,
-                start_pdf_page=it.start_pdf_page,
-                end_pdf_page=ends.get(it.id),
-                printed_page_start=it.printed_page_start,
-            )
-        )
+    out: list[LessonView] = [index.lesson_view(it) for _, it in ranked]
 
     # Last-resort: return first lessons so user can continue instead of hard fail.
     if not out:
-        for it in items:
+        for it in index.items:
             if it.id in unit_ids:
                 continue
-            unit = by_id.get(it.parent_id) if it.parent_id else None
-            out.append(
-                LessonView(
-                    id=it.id,
-                    title=it.title,
-                    unit_id=unit.id if unit else None,
-                    unit_title=unit.title if unit else None,
-                    start_pdf_page=it.start_pdf_page,
-                    end_pdf_page=ends.get(it.id),
-                    printed_page_start=it.printed_page_start,
-                )
-            )
+            out.append(index.lesson_view(it))
             if len(out) >= limit:
                 break
 
@@ -0,0 +1,80 @@
+from sqlalchemy import case, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.db.upsert import dialect_insert
+from app.models.entities import EventLog, UsageCounter
+from app.services.events import EventSink
+
+DEMO_QUESTION_LIMIT = 10
+
+
+def question_event(subject_id: int) -> str:
+    return f"q:{subject_id}"
+
+
+def demo_remaining(used: int) -> int:
+    return max(0, DEMO_QUESTION_LIMIT - used)
+
+
+def question_count(db: Session, user_id: int, subject_id: int) -> int:
+    row = db.get(UsageCounter, (user_id, subject_id))
+    return row.count if row else 0
+
+
+async def question_count_async(db: AsyncSession, user_id: int, subject_id: int) -> int:
+    row = await db.get(UsageCounter, (user_id, subject_id))
+    return row.count if row else 0
+
+
+def _increment_stmt(bind, user_id: int, subject_id: int):
+    stmt = dialect_insert(bind, UsageCounter).values(user_id=user_id, subject_id=subject_id, count=1)
+    return stmt.on_conflict_do_update(
+        index_elements=[UsageCounter.user_id, UsageCounter.subject_id],
+        set_={"count": UsageCounter.count + 1},
+    ).returning(UsageCounter.count)
+
+
+def record_question(db: Session, user_id: int, subject_id: int, text: str, sink: EventSink | None = None) -> int:
+    """Bump the question counter and log the question; returns the new count.
+
+    The counter is always committed here. The ``EventLog`` row joins the same
+    transaction, or goes through ``sink`` (buffered, best-effort) when one is given.
+    """
+    if sink is None:
+        db.add(EventLog(user_id=user_id, event_type=question_event(subject_id), payload=text))
+    used = db.execute(_increment_stmt(db.get_bind(), user_id, subject_id)).scalar_one()
+    db.commit()
+    # The ORM copy (if loaded) is stale after the Core upsert.
+    db.expire_all()
+    if sink is not None:
+        sink.emit(user_id, question_event(subject_id), text)
+    return used
+
+
+def backfill_usage_counters(db: Session) -> int:
+    """Raise ``usage_counters`` to the ``q:<subject_id>`` event counts; returns rows upserted.
+
+    Counters only ever go up: buffered event writes may have been dropped and live
+    ``record_question`` upserts run concurrently, so the log is a lower bound.
+    """
+    q = (
+        db.query(EventLog.user_id, EventLog.event_type, func.count(EventLog.id))
+        .filter(EventLog.user_id.is_not(None), EventLog.event_type.like("q:%"))
+        .group_by(EventLog.user_id, EventLog.event_type)
+    )
+    rows = []
+    for user_id, event_type, n in q:
+        subject = event_type.split(":", 1)[1]
+        if subject.isdigit():
+            rows.append({"user_id": user_id, "subject_id": int(subject), "count": n})
+    if rows:
+        stmt = dialect_insert(db.get_bind(), UsageCounter)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=[UsageCounter.user_id, UsageCounter.subject_id],
+                set_={"count": case((UsageCounter.count > stmt.excluded.count, UsageCounter.count), else_=stmt.excluded.count)},
+            ),
+            rows,
+        )
+    db.commit()
+    return len(rows)
@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.db.upsert import dialect_insert
+from app.models.entities import User, UserSession
+
+DEFAULT_GRADE = "الثالث الثانوي - علمي"
+
+
+@dataclass(frozen=True)
+class UserContext:
+    """Plain copy of a user and their session; safe to cache and hand to worker threads."""
+
+    telegram_id: int
+    user_id: int
+    subject_id: int | None = None
+    toc_item_id: int | None = None
+    selected_range_start: int | None = None
+    selected_range_end: int | None = None
+
+
+def _context_stmt(tg_id: int):
+    return (
+        select(
+            User.id,
+            UserSession.id,
+            UserSession.subject_id,
+            UserSession.toc_item_id,
+            UserSession.selected_range_start,
+            UserSession.selected_range_end,
+        )
+        .outerjoin(UserSession, UserSession.user_id == User.id)
+        .where(User.telegram_id == tg_id)
+    )
+
+
+def _insert_user_stmt(bind, tg_id: int, username: str | None):
+    return (
+        dialect_insert(bind, User)
+        .values(telegram_id=tg_id, username=username, grade=DEFAULT_GRADE)
+        .on_conflict_do_nothing(index_elements=[User.telegram_id])
+        .returning(User.id)
+    )
+
+
+def ensure_user_id(db: Session, tg_id: int, username: str | None = None) -> int:
+    """Id of the user with ``tg_id``, inserting it if needed (race-safe, no commit)."""
+    stmt = select(User.id).where(User.telegram_id == tg_id)
+    user_id = db.execute(stmt).scalar()
+    if user_id is None:
+        user_id = db.execute(_insert_user_stmt(db.get_bind(), tg_id, username)).scalar()
+    if user_id is None:  # created concurrently
+        user_id = db.execute(stmt).scalar_one()
+    return user_id
+
+
+async def ensure_user_id_async(db: AsyncSession, tg_id: int, username: str | None = None) -> int:
+    stmt = select(User.id).where(User.telegram_id == tg_id)
+    user_id = (await db.execute(stmt)).scalar()
+    if user_id is None:
+        user_id = (await db.execute(_insert_user_stmt(db.get_bind(), tg_id, username))).scalar()
+    if user_id is None:
+        user_id = (await db.execute(stmt)).scalar_one()
+    return user_id
+
+
+async def load_user_context_async(db: AsyncSession, tg_id: int, username: str | None) -> UserContext:
+    """User and session in one joined SELECT; first contact upserts the missing rows."""
+    row = (await db.execute(_context_stmt(tg_id))).first()
+    if row is not None and row[1] is not None:
+        return UserContext(tg_id, row[0], *row[2:])
+
+    user_id = row[0] if row is not None else await ensure_user_id_async(db, tg_id, username)
+    await db.execute(
+        dialect_insert(db.get_bind(), UserSession).values(user_id=user_id).on_conflict_do_nothing(index_elements=[UserSession.user_id])
+    )
+    await db.commit()
+    row = (await db.execute(_context_stmt(tg_id))).one()
+    return UserContext(tg_id, row[0], *row[2:])
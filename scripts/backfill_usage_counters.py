@@ -0,0 +1,5 @@
+from app.db.session import SessionLocal
+from app.services.usage import backfill_usage_counters
+
+with SessionLocal() as db:
+    print({"usage_counters": backfill_usage_counters(db)})
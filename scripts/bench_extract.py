@@ -0,0 +1,27 @@
+import sys
+import time
+from app.ingest.page_extract import iter_pages
+
+# Usage: python scripts/bench_extract.py data/pdfs/physics.pdf [workers ...]
+if len(sys.argv) < 2:
+    raise SystemExit("Usage: python scripts/bench_extract.py file.pdf [workers ...]")
+
+path = sys.argv[1]
+counts = [int(x) for x in sys.argv[2:]] or [2, 4, 8]
+
+if __name__ == "__main__":
+    # Baseline: the same per-page work (text, digest, TOC signals) on one process.
+    started = time.perf_counter()
+    pages = chars = 0
+    for rec in iter_pages(path, 1):
+        pages += 1
+        chars += len(rec.text)
+    serial = time.perf_counter() - started
+    print({"workers": 1, "pages": pages, "chars": chars, "seconds": round(serial, 2), "pages_per_sec": round(pages / serial, 1)})
+
+    for n in counts:
+        started = time.perf_counter()
+        got = sum(len(rec.text) for rec in iter_pages(path, n))
+        took = time.perf_counter() - started
+        assert got == chars, "parallel extraction must match the serial text"
+        print({"workers": n, "seconds": round(took, 2), "pages_per_sec": round(pages / took, 1), "speedup": round(serial / took, 2)})
@@ -0,0 +1,45 @@
+"""Replay logged questions and compare cache hit rates for raw vs canonical keys.
+
+Usage: python scripts/cache_key_report.py [subject_id]
+
+Each logged question is treated as a request against an unbounded cache keyed by
+(subject, question); the lesson range is not logged, so real hit rates are lower.
+"""
+import sys
+from collections import Counter
+
+from app.db.session import SessionLocal
+from app.models.entities import EventLog
+from app.rag.term_index import canonical_query
+
+
+subject_filter = f"q:{sys.argv[1]}" if len(sys.argv) > 1 else None
+total = raw_hits = canon_hits = 0
+raw_seen: set[tuple[str, str]] = set()
+counts: Counter = Counter()
+variants: dict[tuple[str, str], set[str]] = {}
+with SessionLocal() as db:
+    q = db.query(EventLog.event_type, EventLog.payload).filter(EventLog.event_type.like("q:%"))
+    if subject_filter:
+        q = q.filter(EventLog.event_type == subject_filter)
+    # Stream the log; only the distinct keys are kept in memory.
+    for et, p in q.order_by(EventLog.id.asc()).yield_per(2000):
+        total += 1
+        raw = (et, p or "")
+        raw_hits += raw in raw_seen
+        raw_seen.add(raw)
+        key = (et, canonical_query(p or ""))
+        canon_hits += key in counts
+        counts[key] += 1
+        variants.setdefault(key, set()).add(p or "")
+
+if not total:
+    raise SystemExit("no logged questions")
+
+print(f"questions: {total}")
+print(f"raw keys:       {len(raw_seen):>7} unique, hit rate {raw_hits / total:.1%}")
+print(f"canonical keys: {len(counts):>7} unique, hit rate {canon_hits / total:.1%}")
+print("most merged canonical forms:")
+for key, _ in sorted(counts.items(), key=lambda kv: -len(variants[kv[0]]))[:10]:
+    if len(variants[key]) > 1:
+        print(f"  {key[0]} [{key[1]}] <- {len(variants[key])} spellings, {counts[key]} requests")
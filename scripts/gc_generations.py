@@ -0,0 +1,9 @@
+import sys
+from app.db.session import SessionLocal
+from app.rag.generations import collect_due_generations
+
+# Usage: python scripts/gc_generations.py [min_age_sec]
+# Removes content generations superseded at least min_age_sec (GENERATION_GC_DELAY_SEC) ago.
+delay = float(sys.argv[1]) if len(sys.argv) > 1 else None
+with SessionLocal() as db:
+    print(collect_due_generations(db, delay))
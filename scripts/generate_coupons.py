@@ -0,0 +1,17 @@
+import sys
+from datetime import datetime
+from pathlib import Path
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.services.coupons import generate_coupons_bulk
+
+if len(sys.argv) < 3 or sys.argv[1] not in {"subscription", "subject_unlock"}:
+    raise SystemExit("Usage: python scripts/generate_coupons.py subscription|subject_unlock count [subject_code] [out.csv]")
+
+kind, count = sys.argv[1], int(sys.argv[2])
+subject_code = sys.argv[3] if len(sys.argv) > 3 else None
+stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+out = sys.argv[4] if len(sys.argv) > 4 else Path(settings.COUPON_EXPORT_DIR, f"coupons-{kind}-{subject_code or 'all'}-{stamp}.csv")
+with SessionLocal() as db:
+    report = generate_coupons_bulk(db, kind, count, subject_code, csv_path=out)
+print({"created": report.created, "collisions": report.collisions, "seconds": round(report.seconds, 2), "per_second": round(report.per_second), "csv": report.path})
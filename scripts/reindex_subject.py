@@ -11,9 +11,10 @@ MAP = {
 }
 
 if len(sys.argv) < 2 or sys.argv[1] not in MAP:
-    raise SystemExit("Usage: python scripts/reindex_subject.py physics|math1|math2|science")
+    raise SystemExit("Usage: python scripts/reindex_subject.py physics|math1|math2|science [--full]")
 
 code = sys.argv[1]
 name_ar, path = MAP[code]
+# Same CONTENT_VERSION as the last run: only changed pages are reprocessed unless --full.
 with SessionLocal() as db:
-    print(ingest_subject(db, code, name_ar, path, settings.CONTENT_VERSION))
+    print(ingest_subject(db, code, name_ar, path, settings.CONTENT_VERSION, full="--full" in sys.argv[2:]))
@@ -0,0 +1,11 @@
+import sys
+from app.db.session import SessionLocal
+from app.rag.generations import collect_due_generations
+from app.services.cache_service import sweep_cache
+
+# Usage: python scripts/sweep_cache.py [max_rows] [max_bytes]
+max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else None
+max_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+with SessionLocal() as db:
+    print({"generations": collect_due_generations(db)})
+    print(sweep_cache(db, max_rows=max_rows, max_bytes=max_bytes))
@@ -0,0 +1,66 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.db.base import Base
+from app.db.session import async_database_url
+from app.models.entities import Coupon, Subject, Subscription, TocItem
+from app.services.cache_service import get_cache_async, set_cache_async
+from app.services.coupons import redeem_coupon_async
+from app.services.rate_limit import check_limit_with_meta_async
+from app.services.toc_service import get_lessons_for_unit_async, get_units_async
+from app.services.users import load_user_context_async
+
+
+async def _session_factory():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return engine, async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def test_async_database_url_maps_drivers():
+    assert async_database_url("postgresql://u:p@db:5432/app") == "postgresql+psycopg://u:p@db:5432/app"
+    assert async_database_url("postgresql+psycopg://u:p@db/app") == "postgresql+psycopg://u:p@db/app"
+    assert async_database_url("sqlite:///./x.db") == "sqlite+aiosqlite:///./x.db"
+
+
+def test_async_services_round_trip():
+    async def scenario():
+        engine, Session = await _session_factory()
+        async with Session() as db:
+            ctx = await load_user_context_async(db, 42, "ali")
+            assert await load_user_context_async(db, 42, "ali") == ctx
+
+            results = [await check_limit_with_meta_async(db, ctx.user_id, "global", 2, 600) for _ in range(3)]
+            assert [ok for ok, _ in results] == [True, True, False]
+            assert results[-1][1] > 0
+
+            await set_cache_async(db, "k", "v1", 1)
+            await set_cache_async(db, "k", "v2", 1)
+            assert await get_cache_async(db, "k") == "v2"
+            assert await get_cache_async(db, "missing") is None
+
+            subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+            db.add(subj)
+            await db.commit()
+            unit = TocItem(subject_id=subj.id, title="الوحدة الأولى", level=1, order_index=1, start_pdf_page=0)
+            db.add(unit)
+            await db.commit()
+            db.add(TocItem(subject_id=subj.id, parent_id=unit.id, title="الدرس الأول", level=2, order_index=2, start_pdf_page=3, end_pdf_page=8))
+            db.add(Coupon(code="SUB-1", kind="subscription"))
+            await db.commit()
+
+            units = await get_units_async(db, subj.id)
+            assert [x.title for x in units] == ["الوحدة الأولى"]
+            lessons = await get_lessons_for_unit_async(db, subj.id, unit.id)
+            assert [x.title for x in lessons] == ["الدرس الأول"]
+
+            assert (await redeem_coupon_async(db, 42, "SUB-1"))[0] is True
+            assert (await redeem_coupon_async(db, 42, "SUB-1"))[0] is False
+            assert (await db.execute(select(Subscription).where(Subscription.user_id == ctx.user_id))).scalars().first() is not None
+        await engine.dispose()
+
+    asyncio.run(scenario())
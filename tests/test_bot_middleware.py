@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.bot.middleware import IdentityCache, UserContextMiddleware
+from app.db.base import Base
+from app.models.entities import User, UserSession
+from app.services.users import load_user_context_async
+
+
+def test_context_loaded_once_then_served_from_cache():
+    async def scenario():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+        statements = []
+        event.listen(engine.sync_engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+
+        async with Session() as db:
+            first = await load_user_context_async(db, 7, "sara")
+            statements.clear()
+            again = await load_user_context_async(db, 7, "sara")
+        assert again == first
+        assert len(statements) == 1  # joined user+session SELECT
+
+        cache = IdentityCache(ttl_sec=60, max_size=10)
+        mw = UserContextMiddleware(cache, Session)
+        seen = []
+
+        async def handler(evt, data):
+            seen.append(data["ctx"])
+
+        data = {"event_from_user": SimpleNamespace(id=8, username="omar")}
+        await mw(handler, object(), dict(data))
+        statements.clear()
+        await mw(handler, object(), dict(data))
+        assert statements == []
+        assert seen[0] == seen[1] and seen[0].telegram_id == 8 and seen[0].subject_id is None
+        assert cache.hits == 1 and cache.misses == 1
+
+        async with Session() as db:
+            assert (await db.execute(select(func.count(User.id)))).scalar() == 2
+            assert (await db.execute(select(func.count(UserSession.id)))).scalar() == 2
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_identity_cache_expires_and_bounds_entries():
+    cache = IdentityCache(ttl_sec=0, max_size=2)
+    ctx = SimpleNamespace(telegram_id=1)
+    cache.put(ctx)
+    assert cache.get(1) is None
+
+    cache = IdentityCache(ttl_sec=60, max_size=2)
+    for i in range(3):
+        cache.put(SimpleNamespace(telegram_id=i))
+    assert cache.get(0) is None
+    assert cache.get(2).telegram_id == 2
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import time
+
+from app.bot.workers import BlockingPool
+
+
+def test_blocking_pool_keeps_loop_responsive_and_bounds_work():
+    pool = BlockingPool(max_workers=2, max_pending=3)
+    release = threading.Event()
+    snapshots = []
+
+    def slow(i):
+        release.wait(2)
+        return i * 10
+
+    async def scenario():
+        tasks = [asyncio.create_task(pool.run(slow, i)) for i in range(5)]
+        # The loop is still free while the workers block.
+        t0 = time.perf_counter()
+        await asyncio.sleep(0.05)
+        assert time.perf_counter() - t0 < 1
+        snapshots.append(pool.stats())
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+    pool.shutdown()
+
+    assert results == [0, 10, 20, 30, 40]
+    mid = snapshots[0]
+    assert mid["active"] == 2
+    assert mid["queued"] == 1
+    assert mid["waiting"] == 2
+    final = pool.stats()
+    assert final["completed"] == 5 and final["active"] == 0 and final["queued"] == 0
+
+
+def test_cancelled_callers_leave_the_queue():
+    pool = BlockingPool(max_workers=1, max_pending=3)
+    release = threading.Event()
+
+    async def scenario():
+        tasks = [asyncio.create_task(pool.run(release.wait, 2)) for _ in range(4)]
+        await asyncio.sleep(0.05)
+        assert pool.stats()["queued"] == 2 and pool.stats()["waiting"] == 1
+        for t in tasks[1:]:
+            t.cancel()
+        await asyncio.gather(*tasks[1:], return_exceptions=True)
+        stats = pool.stats()
+        release.set()
+        await tasks[0]
+        return stats
+
+    mid = asyncio.run(scenario())
+    pool.shutdown()
+    assert mid["queued"] == 0 and mid["waiting"] == 0
+    assert pool.stats()["queued"] == 0 and pool.stats()["active"] == 0
@@ -0,0 +1,113 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import Subject
+from app.services import rag_service
+from app.services.cache_service import LocalCache, get_cache, set_cache
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+    return sessionmaker(bind=engine)(), statements
+
+
+def test_local_cache_lru_ttl_and_counters():
+    c = LocalCache(max_entries=2, max_ttl_sec=60)
+    c.put("a", "1", 3600)
+    c.put("b", "2", 3600)
+    assert c.get("a") == "1"
+    c.put("c", "3", 3600)  # evicts least recently used "b"
+    assert c.get("b") is None
+    c.put("d", "4", 0)  # non-positive TTL is not stored
+    assert c.get("d") is None
+    assert c.stats() == {"size": 2, "hits": 1, "misses": 2, "evictions": 1, "expirations": 0}
+
+
+def test_repeat_reads_and_unchanged_writes_skip_the_database():
+    db, statements = _db()
+    set_cache(db, "k", "v", ttl_days=7)
+    statements.clear()
+    assert get_cache(db, "k") == "v"
+    set_cache(db, "k", "v", ttl_days=7)
+    assert statements == []
+
+    set_cache(db, "k", "v2", ttl_days=7)
+    assert any(s.startswith("UPDATE") for s in statements)
+    assert get_cache(db, "k") == "v2"
+
+
+def test_empty_retrieval_is_negatively_cached(monkeypatch):
+    db, _ = _db()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add(subj)
+    db.commit()
+
+    calls = []
+
+    def _empty(*a, **kw):
+        calls.append(1)
+        return [], []
+
+    monkeypatch.setattr(rag_service, "retrieve_with_suggestions", _empty)
+    for _ in range(3):
+        out = rag_service.answer_question(db, user_id=1, subject_id=subj.id, question="ما هي السرعة", lesson_range=[0, 5])
+        assert out["citations"] == []
+    assert len(calls) == 1
+
+
+def test_sweep_removes_expired_superseded_and_over_cap_rows():
+    from datetime import datetime, timedelta
+
+    from app.models.entities import CacheEntry
+    from app.services.cache_service import sweep_cache
+
+    db, _ = _db()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x", content_version=2)
+    db.add(subj)
+    db.commit()
+    now = datetime.utcnow()
+    db.add(CacheEntry(cache_key="expired", value="x", size_bytes=1, expires_at=now - timedelta(days=1)))
+    db.add(CacheEntry(cache_key="old-version", value="x", size_bytes=1, expires_at=now + timedelta(days=1), subject_id=subj.id, content_version=1))
+    for i in range(5):
+        db.add(
+            CacheEntry(
+                cache_key=f"live{i}",
+                value="x" * 10,
+                size_bytes=10,
+                expires_at=now + timedelta(days=1),
+                subject_id=subj.id,
+                content_version=2,
+                last_hit_at=now - timedelta(hours=5 - i),
+            )
+        )
+    db.commit()
+
+    report = sweep_cache(db, batch_size=2, max_rows=4, max_bytes=30)
+    assert report == {"expired": 1, "superseded": 1, "evicted": 2, "bytes_freed": 22}
+    assert sorted(k for (k,) in db.query(CacheEntry.cache_key)) == ["live2", "live3", "live4"]
+
+
+def test_set_cache_records_tags_and_size():
+    from app.models.entities import CacheEntry
+
+    db, _ = _db()
+    set_cache(db, "tagged", "سرعة", ttl_days=7, subject_id=3, content_version=2)
+    row = db.query(CacheEntry).filter(CacheEntry.cache_key == "tagged").one()
+    assert (row.subject_id, row.content_version, row.size_bytes) == (3, 2, len("سرعة".encode("utf-8")))
+
+
+def test_local_copies_are_retired_when_the_revision_moves():
+    from app.models.entities import CacheEntry
+
+    db, _ = _db()
+    set_cache(db, "rev", "old", ttl_days=7, subject_id=1, revision=0)
+    # Another process's in-place reindex deletes the row; this process's copy survives...
+    db.query(CacheEntry).delete()
+    db.commit()
+    assert get_cache(db, "rev", 0) == "old"
+    # ...until the subject's revision it looks up with changes.
+    assert get_cache(db, "rev", 1) is None
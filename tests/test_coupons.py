@@ -0,0 +1,89 @@
+import csv
+from itertools import count
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import Coupon
+from app.services import coupons
+from app.services.coupons import generate_coupons, generate_coupons_bulk
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_bulk_generation_retries_collisions_and_streams_csv(tmp_path, monkeypatch):
+    db = _db()
+    db.add(Coupon(code="EDU-0", kind="subscription"))
+    db.commit()
+    seq = count()
+    # First two draws collide: one with an existing code, one within the batch.
+    draws = iter(["EDU-0", "EDU-1", "EDU-1"])
+    monkeypatch.setattr(coupons, "_new_code", lambda: next(draws, None) or f"EDU-N{next(seq)}")
+
+    out = tmp_path / "codes.csv"
+    report = generate_coupons_bulk(db, "subject_unlock", 5, "physics", csv_path=out, batch_size=3)
+    assert report.created == 5
+    assert report.collisions == 2
+    with open(out, encoding="utf-8") as fh:
+        rows = list(csv.reader(fh))
+    assert rows[0] == ["code", "kind", "subject_code"]
+    assert len(rows) == 6 and len({r[0] for r in rows[1:]}) == 5
+    assert "EDU-0" not in {r[0] for r in rows[1:]}
+    assert db.query(Coupon).filter(Coupon.kind == "subject_unlock").count() == 5
+
+
+def test_generate_coupons_returns_unique_codes():
+    db = _db()
+    codes = generate_coupons(db, "subscription", 500)
+    assert len(set(codes)) == 500 == db.query(Coupon).count()
+
+
+def test_parallel_redemptions_of_one_code_have_one_winner(tmp_path):
+    import threading
+
+    from sqlalchemy import event
+
+    from app.models.entities import Redemption, Subscription
+    from app.services.coupons import redeem_coupon
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'redeem.db'}", connect_args={"timeout": 30, "check_same_thread": False})
+
+    # pysqlite recipe: explicit BEGIN so concurrent writers queue on the lock instead of failing.
+    @event.listens_for(engine, "connect")
+    def _no_autobegin(dbapi_conn, _):
+        dbapi_conn.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as db:
+        db.add(Coupon(code="CLASS-1", kind="subscription"))
+        db.commit()
+
+    start = threading.Barrier(24)
+    results = []
+
+    def attempt(tg_id):
+        start.wait()
+        with Session() as db:
+            results.append(redeem_coupon(db, tg_id, "CLASS-1")[0])
+
+    threads = [threading.Thread(target=attempt, args=(1000 + i,)) for i in range(24)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results.count(True) == 1 and len(results) == 24
+    with Session() as db:
+        assert db.query(Redemption).count() == 1
+        assert db.query(Subscription).count() == 1
+        assert db.query(Coupon.is_used).scalar() is True
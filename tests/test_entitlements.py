@@ -0,0 +1,70 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import Coupon, Subject, SubjectUnlock, Subscription, User
+from app.services.coupons import redeem_coupon
+from app.core.config import settings
+from app.services.entitlements import entitlement_cache_size, get_entitlements, invalidate_entitlements, peek_entitlements, warm_entitlements
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+    return sessionmaker(bind=engine)(), statements
+
+
+def test_entitlements_cached_until_redeem_invalidates():
+    db, statements = _db()
+    user = User(telegram_id=77)
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add_all([user, subj, Coupon(code="SUB", kind="subscription"), Coupon(code="PHY", kind="subject_unlock", subject_code="physics")])
+    db.commit()
+
+    ent = get_entitlements(db, user.id)
+    assert not ent.has_paid_access(subj.id)
+    statements.clear()
+    assert get_entitlements(db, user.id) is ent
+    assert statements == []
+
+    assert redeem_coupon(db, 77, "SUB")[0]
+    assert peek_entitlements(user.id) is None
+    assert get_entitlements(db, user.id).subscribed
+    assert redeem_coupon(db, 77, "PHY")[0]
+    assert get_entitlements(db, user.id).has_paid_access(subj.id)
+
+
+def test_warm_loads_all_entitled_users():
+    db, statements = _db()
+    db.add_all([User(telegram_id=i) for i in (1, 2, 3)] + [Subject(name_ar="فيزياء", code="physics", pdf_path="x")])
+    db.commit()
+    db.add_all([Subscription(user_id=1, active=True), SubjectUnlock(user_id=2, subject_id=1)])
+    db.commit()
+    assert warm_entitlements(db) == 2
+    statements.clear()
+    assert get_entitlements(db, 1).subscribed and get_entitlements(db, 2).unlocked_subjects == {1}
+    assert statements == []
+
+
+def test_entitlement_cache_is_bounded_and_drops_expired(monkeypatch):
+    db, statements = _db()
+    db.add_all([User(telegram_id=i) for i in (1, 2, 3, 4)])
+    db.commit()
+    invalidate_entitlements()
+    monkeypatch.setattr(settings, "ENTITLEMENT_CACHE_SIZE", 2)
+
+    get_entitlements(db, 1)
+    get_entitlements(db, 2)
+    get_entitlements(db, 1)
+    get_entitlements(db, 3)
+    assert entitlement_cache_size() == 2
+    assert peek_entitlements(2) is None and peek_entitlements(1) is not None
+
+    invalidate_entitlements()
+    monkeypatch.setattr(settings, "ENTITLEMENT_TTL_SEC", -1)
+    get_entitlements(db, 4)
+    monkeypatch.setattr(settings, "ENTITLEMENT_TTL_SEC", 300)
+    get_entitlements(db, 2)
+    assert entitlement_cache_size() == 1
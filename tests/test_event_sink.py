@@ -0,0 +1,83 @@
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.db.base import Base
+from app.models.entities import EventLog, Subject, User
+from app.services.events import EventSink
+from app.services.usage import question_count, record_question
+
+
+def _factory():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine)
+
+
+def _wait_for(cond, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not cond() and time.monotonic() < end:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_sink_batches_and_flushes_on_close():
+    Session = _factory()
+    sink = EventSink(Session, batch_size=3, flush_ms=60_000)
+    for i in range(7):
+        sink.emit(None, "view", str(i))
+    assert _wait_for(lambda: sink.written == 6)
+    assert sink.flushes == 2
+    sink.close()
+    assert sink.stats()["written"] == 7
+    with Session() as db:
+        assert [p for (p,) in db.query(EventLog.payload).order_by(EventLog.id)] == [str(i) for i in range(7)]
+    assert sink.emit(None, "late") is False
+
+
+def test_sink_flushes_on_interval_and_drops_on_overflow():
+    Session = _factory()
+    release = threading.Event()
+
+    def slow_factory():
+        release.wait(2)
+        return Session()
+
+    sink = EventSink(slow_factory, batch_size=1, flush_ms=10, max_queue=2)
+    results = [sink.emit(None, "view", str(i)) for i in range(6)]
+    assert results.count(False) >= 2 and sink.dropped == results.count(False)
+    release.set()
+    sink.close()
+    assert sink.written == results.count(True)
+
+
+def test_quota_counter_is_synchronous_with_sink():
+    Session = _factory()
+    sink = EventSink(Session, batch_size=100, flush_ms=60_000)
+    with Session() as db:
+        db.add_all([User(telegram_id=1), Subject(name_ar="فيزياء", code="physics", pdf_path="x")])
+        db.commit()
+        assert record_question(db, 1, 1, "سؤال", sink=sink) == 1
+        assert question_count(db, 1, 1) == 1
+        assert db.query(EventLog).count() == 0
+    sink.close()
+    with Session() as db:
+        assert db.query(EventLog).filter(EventLog.event_type == "q:1").count() == 1
+
+
+def test_close_flushes_synchronously_when_the_writer_died(monkeypatch):
+    Session = _factory()
+    sink = EventSink(Session, batch_size=10, flush_ms=10, max_queue=2)
+    monkeypatch.setattr(sink, "_run", lambda: None)  # writer thread exits at once
+    assert [sink.emit(None, "view", str(i)) for i in range(3)] == [True, True, False]
+    sink._thread.join(1)
+
+    started = time.monotonic()
+    sink.close(timeout=0.2)
+    assert time.monotonic() - started < 1
+    assert sink.stats()["written"] == 2
+    with Session() as db:
+        assert db.query(EventLog).count() == 2
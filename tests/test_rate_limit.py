@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import RateLimitState
+from app.services import rate_limit
+from app.services.rate_limit import Limit, MemoryRateLimiter, check_limits
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *a: statements.append(a[2]))
+    return sessionmaker(bind=engine)(), statements
+
+
+def test_gcra_burst_refill_one_statement_per_bucket(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(time=lambda: clock[0]))
+    db, statements = _db()
+    limits = [Limit("global", 3, 60), Limit("ai_heavy", 2, 60)]
+
+    statements.clear()
+    first = check_limits(db, 5, limits)
+    assert [r.allowed for r in first] == [True, True]
+    assert len([s for s in statements if s.startswith("INSERT")]) == 2
+
+    check_limits(db, 5, limits)
+    third = check_limits(db, 5, limits)
+    assert [r.allowed for r in third] == [True, False]
+    assert third[1].retry_after_sec == 30 and third[1].minutes_left == 1
+
+    fourth = check_limits(db, 5, limits)
+    assert [r.allowed for r in fourth] == [False]
+
+    clock[0] += 30  # one ai_heavy slot (60s / 2) and one and a half global slots refill
+    assert [r.allowed for r in check_limits(db, 5, limits)] == [True, True]
+    assert db.query(RateLimitState).count() == 2
+
+
+def test_memory_backend_matches_db(monkeypatch):
+    clock = [50.0]
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(time=lambda: clock[0]))
+    db, _ = _db()
+    mem = MemoryRateLimiter()
+    limits = [Limit("global", 4, 100)]
+    for step in [0, 0, 0, 0, 0, 10, 25, 0, 60, 0, 0]:
+        clock[0] += step
+        from_db = check_limits(db, 9, limits)
+        from_mem = mem.check(9, limits, clock[0])
+        assert from_db == from_mem
+
+
+def test_global_denial_does_not_charge_ai_heavy(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(rate_limit, "time", SimpleNamespace(time=lambda: clock[0]))
+    db, _ = _db()
+    mem = MemoryRateLimiter()
+    limits = [Limit("global", 1, 60), Limit("ai_heavy", 5, 60)]
+    assert [r.allowed for r in check_limits(db, 5, limits)] == [True, True]
+    assert [r.allowed for r in mem.check(5, limits, clock[0])] == [True, True]
+    ai_tat = db.query(RateLimitState.tat).filter(RateLimitState.bucket == "ai_heavy").scalar()
+
+    for _ in range(3):
+        assert [r.allowed for r in check_limits(db, 5, limits)] == [False]
+        assert [r.allowed for r in mem.check(5, limits, clock[0])] == [False]
+    db.expire_all()
+    assert db.query(RateLimitState.tat).filter(RateLimitState.bucket == "ai_heavy").scalar() == ai_tat
+    assert mem._tat[(5, "ai_heavy")] == ai_tat
@@ -5,3 +5,35 @@ def test_deterministic_embedding_shape():
     v = deterministic_embedding("abc")
     assert len(v) == 1536
     assert abs(sum(x*x for x in v) - 1.0) < 1e-6
+
+
+def test_stored_chunk_embeddings_and_nearest_neighbours():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from app.db.base import Base
+    from app.models.entities import Chunk, Subject
+    from app.rag.vector_index import chunk_similarities, nearest_chunks
+
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add(subj)
+    db.commit()
+    texts = ["الحركة", "القوة", "الطاقة"]
+    chunks = [
+        Chunk(subject_id=subj.id, pdf_page_index=i, content=t, embedding=deterministic_embedding(t) if i < 2 else None)
+        for i, t in enumerate(texts)
+    ]
+    db.add_all(chunks)
+    db.commit()
+
+    qv = deterministic_embedding("القوة")
+    best = nearest_chunks(db, subj.id, qv, lesson_range=(0, 10), limit=1)
+    assert best[0][0] == chunks[1].id
+    assert abs(best[0][1] - 1.0) < 1e-4
+    assert [cid for cid, _ in nearest_chunks(db, subj.id, qv, lesson_range=(0, 0))] == [chunks[0].id]
+
+    sims = chunk_similarities(db, [c.id for c in chunks], deterministic_embedding("الطاقة"))
+    assert abs(sims[chunks[2].id] - 1.0) < 1e-4
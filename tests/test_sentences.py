@@ -0,0 +1,51 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import Chunk, Subject, TocItem
+from app.rag.sentences import build_sentence_index, load_sentences, split_sentences
+from app.services import rag_service
+
+TEXT = (
+    "12 - 13\n"
+    "السرعة المتوسطة هي المسافة الكلية مقسومة على الزمن الكلي.\n"
+    "ما الفرق بين السرعة المتوسطة والسرعة اللحظية؟\n"
+    "v = d / t where v is the velocity of the body in m/s.\n"
+    "قصير جداً."
+)
+
+
+def test_split_keeps_offsets_flags_and_drops_noise():
+    sents = split_sentences(TEXT)
+    assert [s.text(TEXT) for s in sents] == [
+        "السرعة المتوسطة هي المسافة الكلية مقسومة على الزمن الكلي",
+        "ما الفرق بين السرعة المتوسطة والسرعة اللحظية؟",
+        "v = d / t where v is the velocity of the body in m/s",
+    ]
+    assert [s.is_question for s in sents] == [False, True, False]
+    assert [s.is_clean for s in sents] == [True, True, False]
+    assert sents[0].norm.startswith("السرعه")
+
+
+def test_answer_uses_stored_sentences(monkeypatch):
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add(subj)
+    db.commit()
+    lesson = TocItem(subject_id=subj.id, title="السرعة", level=2, order_index=1, start_pdf_page=0, end_pdf_page=5)
+    db.add(lesson)
+    db.commit()
+    db.add(Chunk(subject_id=subj.id, toc_item_id=lesson.id, pdf_page_index=1, content=TEXT))
+    db.commit()
+    assert build_sentence_index(db, subj.id) == 3
+    chunk_id = db.query(Chunk.id).scalar()
+    assert [s.text(TEXT) for s in load_sentences(db, [chunk_id])[chunk_id]] == [s.text(TEXT) for s in split_sentences(TEXT)]
+
+    def _no_split(*a, **kw):
+        raise AssertionError("stored sentences should be used")
+
+    monkeypatch.setattr(rag_service, "split_sentences", _no_split)
+    out = rag_service.answer_question(db, user_id=1, subject_id=subj.id, question="ما هي السرعة المتوسطة", lesson_range=[0, 5])
+    assert "- السرعة المتوسطة هي المسافة الكلية مقسومة على الزمن الكلي" in out["answer"]
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from app.utils.singleflight import SingleFlight
+
+
+def test_concurrent_identical_calls_share_one_execution():
+    flights = SingleFlight()
+    runs = []
+    start = threading.Barrier(8)
+    results = []
+
+    def compute():
+        runs.append(1)
+        time.sleep(0.1)
+        return {"answer": "x"}
+
+    def worker():
+        start.wait()
+        results.append(flights.do("k", compute))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(runs) == 1
+    assert len(results) == 8 and all(r is results[0] for r in results)
+    assert flights.stats() == {"in_flight": 0, "executed": 1, "coalesced": 7}
+
+    # Finished calls are not memoized.
+    flights.do("k", compute)
+    assert len(runs) == 2
+
+
+def test_leader_error_reaches_waiters():
+    flights = SingleFlight()
+    entered = threading.Event()
+    errors = []
+
+    def boom():
+        entered.set()
+        time.sleep(0.2)
+        raise RuntimeError("db down")
+
+    def follower():
+        entered.wait()
+        try:
+            flights.do("k", lambda: "unused")
+        except RuntimeError as e:
+            errors.append(e)
+
+    t = threading.Thread(target=follower)
+    t.start()
+    with pytest.raises(RuntimeError):
+        flights.do("k", boom)
+    t.join()
+    assert len(errors) == 1
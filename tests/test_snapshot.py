@@ -0,0 +1,90 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.core.config import settings
+from app.db.base import Base
+from app.models.entities import Chunk, Subject
+from app.rag.bm25 import build_bm25_stats
+from app.rag.embeddings import deterministic_embedding
+from app.rag.snapshot import load_snapshot, snapshot_path, write_snapshot
+from app.rag.term_index import build_term_index, tokenize
+from app.services.rag_service import retrieve_chunks
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    TestingSession = sessionmaker(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    return TestingSession()
+
+
+def _seed(db):
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add(subj)
+    db.commit()
+    db.refresh(subj)
+    texts = [
+        (7, "الحركة الدائرية المنتظمة وتسارعها المركزي."),
+        (2, "الحركة هي تغير موضع الجسم مع الزمن."),
+        (3, "السرعة المتوسطة تساوي المسافة على الزمن."),
+    ]
+    db.add_all([Chunk(subject_id=subj.id, pdf_page_index=p, content=t, embedding=deterministic_embedding(t[:500])) for p, t in texts])
+    db.commit()
+    build_term_index(db, subj.id)
+    build_bm25_stats(db, subj.id, 1)
+    return subj.id
+
+
+def test_snapshot_round_trip(tmp_path):
+    db = _db()
+    subject_id = _seed(db)
+    write_snapshot(db, subject_id, 1, base_dir=str(tmp_path))
+
+    snap = load_snapshot(subject_id, 1, base_dir=str(tmp_path))
+    assert len(snap) == 3
+    assert list(snap.pages) == [2, 3, 7]
+    assert snap.row_range((3, 7)) == (1, 3)
+    assert snap.df("الزمن") == 2
+    assert load_snapshot(subject_id, 1, base_dir=str(tmp_path)) is snap
+    assert load_snapshot(subject_id, 2, base_dir=str(tmp_path)) is None
+
+    row = snap.rows_for_ids([1])[0]
+    chunk = snap.chunk(row)
+    assert chunk.id == 1 and chunk.pdf_page_index == 7
+    assert chunk.content.startswith("الحركة الدائرية")
+    assert [int(snap.chunk_ids[r]) for r in snap.rows_for_ids([3, 0, 1, 9, 2])] == [3, 1, 2]
+    assert snap.rows_for_ids([]) == []
+
+
+def test_snapshot_retrieval_matches_database_path(tmp_path, monkeypatch):
+    db = _db()
+    subject_id = _seed(db)
+    monkeypatch.setattr(settings, "SNAPSHOT_DIR", str(tmp_path))
+    from_db = [c.id for c in retrieve_chunks(db, subject_id, "الحركة والزمن", (0, 10), content_version=1)]
+
+    write_snapshot(db, subject_id, 1)
+    from_snapshot = retrieve_chunks(db, subject_id, "الحركة والزمن", (0, 10), content_version=1)
+    assert [c.id for c in from_snapshot] == from_db
+    assert all(c.content for c in from_snapshot)
+    assert retrieve_chunks(db, subject_id, "الحركة", (0, 5), content_version=1)[0].pdf_page_index == 2
+
+
+def test_rewrite_swaps_builds_atomically(tmp_path):
+    db = _db()
+    subject_id = _seed(db)
+    write_snapshot(db, subject_id, 1, base_dir=str(tmp_path))
+    first = load_snapshot(subject_id, 1, base_dir=str(tmp_path))
+    assert snapshot_path(subject_id, 1, str(tmp_path)).is_symlink()
+    (term,) = tokenize("المنتظمة")
+    assert first.df(term) == 1 and first.df("غير") == 0
+
+    db.add(Chunk(subject_id=subject_id, pdf_page_index=9, content="القوة المنتظمة", embedding=deterministic_embedding("القوة المنتظمة")))
+    db.commit()
+    build_term_index(db, subject_id)
+    write_snapshot(db, subject_id, 1, base_dir=str(tmp_path))
+
+    second = load_snapshot(subject_id, 1, base_dir=str(tmp_path))
+    assert second is not first and len(second) == 4 and second.df(term) == 2
+    # The earlier reader keeps its mapping; only the served build is left on disk.
+    assert len(first) == 3 and first.text(0)
+    assert [p.name for p in (tmp_path / str(subject_id)).iterdir() if not p.is_symlink()] == [second.path.name]
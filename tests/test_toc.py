@@ -1,4 +1,7 @@
-from app.ingest.toc_extractor import validate_toc_targets
+import fitz
+
+from app.ingest import page_extract, toc_extractor
+from app.ingest.toc_extractor import extract_toc_with_fallback, scan_pdf, validate_toc_targets
 
 
 def test_validate_toc_targets():
@@ -6,3 +9,51 @@ def test_validate_toc_targets():
     m = {10: 20}
     v = validate_toc_targets(toc, m)
     assert v[0]["pdf"] == 20
+
+
+def test_single_scan_feeds_toc_pages_headings_and_page_numbers(tmp_path, monkeypatch):
+    # Latin stand-ins for the Arabic keywords, which the built-in PDF font cannot draw.
+    monkeypatch.setattr(page_extract, "AR_TOC_KEYWORDS", ["Contents"])
+    monkeypatch.setattr(page_extract, "HEADING_KEYWORDS", ("Lesson",))
+    doc = fitz.open()
+    for i in range(6):
+        page = doc.new_page()
+        if i == 0:
+            page.insert_text((72, 72), "Contents\nLesson One 3\nLesson Two 5")
+        elif i in (2, 4):
+            page.insert_text((72, 72), "Lesson heading", fontsize=18)
+        else:
+            page.insert_text((72, 72), "body text")
+        page.insert_text((300, 800), str(i + 1))
+    doc.save(tmp_path / "book.pdf")
+    doc.close()
+
+    dict_reads = []
+    get_text = fitz.Page.get_text
+
+    def counting_get_text(self, opt="text", **kw):
+        if opt == "dict":
+            dict_reads.append(self.number)
+        return get_text(self, opt, **kw)
+
+    monkeypatch.setattr(fitz.Page, "get_text", counting_get_text)
+    scan = scan_pdf(str(tmp_path / "book.pdf"), workers=1)
+
+    assert [r.printed_page for r in scan.pages] == [1, 2, 3, 4, 5, 6]
+    assert scan.pages[0].toc_lines == (("Lesson One", 3), ("Lesson Two", 5))
+    assert [r.index for r in scan.pages if r.headings] == [2, 4]
+    # Only the signals stay in memory; the text is streamed back from the spool.
+    assert all(r.text == "" for r in scan.pages)
+    assert [t.split()[0] for _, t in scan.iter_texts()] == ["Contents", "body", "Lesson", "body", "Lesson", "body"]
+    assert sorted(set(dict_reads)) == [0, 2, 4]
+
+    out = extract_toc_with_fallback(str(tmp_path / "book.pdf"), "physics", str(tmp_path / "toc"), scan=scan)
+    assert out["method"] == "B_toc_pages"
+    assert [v["pdf"] for v in out["validation"]] == [2, 4]
+    scan.close()
+
+    # Without a scan the extractor makes its own and closes the spool behind it.
+    scans = []
+    monkeypatch.setattr(toc_extractor, "scan_pdf", lambda path: scans.append(scan_pdf(path, workers=1)) or scans[-1])
+    assert extract_toc_with_fallback(str(tmp_path / "book.pdf"), "physics", str(tmp_path / "toc")) == out
+    assert scans[0]._spool.closed
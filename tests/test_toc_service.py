@@ -3,7 +3,7 @@ from sqlalchemy.orm import sessionmaker
 
 from app.db.base import Base
 from app.models.entities import Subject, TocItem
-from app.services.toc_service import get_units, get_lessons_for_unit, search_lessons
+from app.services.toc_service import get_toc_index, get_units, get_lessons_for_unit, search_lessons
 
 
 def _db():
@@ -38,3 +38,89 @@ def test_units_lessons_and_search():
     found = search_lessons(db, subj.id, "قوة", limit=3)
     assert found
     assert "القوة" in found[0].title
+
+
+def test_toc_index_is_cached_per_content_version():
+    db = _db()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x", content_version=1)
+    db.add(subj)
+    db.commit()
+    unit = TocItem(subject_id=subj.id, title="الوحدة الأولى", level=1, order_index=1, start_pdf_page=0)
+    db.add(unit)
+    db.flush()
+    db.add_all([
+        TocItem(subject_id=subj.id, parent_id=unit.id, title="الدرس 1: الحركة", level=2, order_index=2, start_pdf_page=3),
+        TocItem(subject_id=subj.id, parent_id=unit.id, title="الدرس 2: القوة", level=2, order_index=3, start_pdf_page=8),
+    ])
+    db.commit()
+
+    idx = get_toc_index(db, subj.id)
+    assert get_toc_index(db, subj.id) is idx
+    assert idx.lesson_for_page(5).title == "الدرس 1: الحركة"
+    assert idx.lesson_for_page(40).title == "الدرس 2: القوة"
+    assert idx.lesson_for_page(1) is None
+    assert idx.unit_of(idx.lesson_for_page(5)).id == unit.id
+
+    # A rebuild writes generation 2 next to the live one; readers switch on the flip.
+    unit2 = TocItem(subject_id=subj.id, content_version=2, title="الوحدة الأولى", level=1, order_index=1, start_pdf_page=0)
+    db.add(unit2)
+    db.flush()
+    db.add_all([
+        TocItem(subject_id=subj.id, content_version=2, parent_id=unit2.id, title=t, level=2, order_index=i + 2, start_pdf_page=p)
+        for i, (t, p) in enumerate([("الدرس 1: الحركة", 3), ("الدرس 2: القوة", 8), ("الدرس 3: الطاقة", 12)])
+    ])
+    db.commit()
+    assert get_toc_index(db, subj.id) is idx
+    assert [u.id for u in get_units(db, subj.id)] == [unit.id]
+
+    subj.content_version = 2
+    db.commit()
+    assert len(get_lessons_for_unit(db, subj.id, unit2.id)) == 3
+    assert get_toc_index(db, subj.id).lesson_for_page(8).end_pdf_page == 11
+
+
+def test_toc_index_follows_content_revision_without_local_invalidation():
+    db = _db()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x", content_version=1)
+    db.add(subj)
+    db.commit()
+    unit = TocItem(subject_id=subj.id, title="الوحدة الأولى", level=1, order_index=1, start_pdf_page=0)
+    db.add(unit)
+    db.flush()
+    db.add(TocItem(subject_id=subj.id, parent_id=unit.id, title="الدرس 1: الحركة", level=2, order_index=2, start_pdf_page=3))
+    db.commit()
+    assert len(get_lessons_for_unit(db, subj.id, unit.id)) == 1
+
+    # An incremental reindex in another process: same version, bumped revision.
+    db.add(TocItem(subject_id=subj.id, parent_id=unit.id, title="الدرس 2: القوة", level=2, order_index=3, start_pdf_page=8))
+    db.commit()
+    assert len(get_lessons_for_unit(db, subj.id, unit.id)) == 1
+    subj.content_revision = 1
+    db.commit()
+    assert len(get_lessons_for_unit(db, subj.id, unit.id)) == 2
+
+
+def test_lesson_for_page_matches_linear_scan_on_shared_start_pages():
+    db = _db()
+    subj = Subject(name_ar="فيزياء", code="physics", pdf_path="x")
+    db.add(subj)
+    db.commit()
+    unit = TocItem(subject_id=subj.id, title="الوحدة الأولى", level=1, order_index=1, start_pdf_page=0)
+    db.add(unit)
+    db.flush()
+    db.add_all([
+        TocItem(subject_id=subj.id, parent_id=unit.id, title=t, level=2, order_index=i + 2, start_pdf_page=p, end_pdf_page=e)
+        for i, (t, p, e) in enumerate([("أ", 3, 7), ("ب", 3, 7), ("ج", 12, None), ("د", 8, 20), ("هـ", 10, 11)])
+    ])
+    db.commit()
+
+    idx = get_toc_index(db, subj.id)
+    lessons = sorted((x for x in idx.items if x.level >= 2), key=lambda x: x.start_pdf_page)
+
+    def linear(page):
+        return next((x for x in lessons if x.start_pdf_page <= page <= (x.end_pdf_page if x.end_pdf_page is not None else 99)), None)
+
+    assert idx.lesson_for_page(3).title == "أ"
+    assert idx.lesson_for_page(15).title == "د"
+    for page in range(30):
+        assert idx.lesson_for_page(page) is linear(page)
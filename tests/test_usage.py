@@ -0,0 +1,38 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.db.base import Base
+from app.models.entities import EventLog, Subject, UsageCounter, User
+from app.services.usage import backfill_usage_counters, question_count, record_question
+
+
+def _db():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([User(telegram_id=1), User(telegram_id=2), Subject(name_ar="فيزياء", code="physics", pdf_path="x")])
+    db.commit()
+    return db
+
+
+def test_record_question_logs_and_counts_together():
+    db = _db()
+    assert question_count(db, 1, 1) == 0
+    assert [record_question(db, 1, 1, f"س{i}") for i in range(3)] == [1, 2, 3]
+    assert question_count(db, 1, 1) == 3
+    assert question_count(db, 2, 1) == 0
+    assert db.query(EventLog).filter(EventLog.event_type == "q:1").count() == 3
+
+
+def test_backfill_raises_counters_from_events_but_never_lowers_them():
+    db = _db()
+    db.add_all(
+        [EventLog(user_id=1, event_type="q:1", payload="a") for _ in range(4)]
+        + [EventLog(user_id=2, event_type="q:1", payload="b"), EventLog(user_id=2, event_type="login", payload="")]
+    )
+    db.add(UsageCounter(user_id=1, subject_id=1, count=2))
+    db.add(UsageCounter(user_id=2, subject_id=1, count=7))
+    db.commit()
+    assert backfill_usage_counters(db) == 2
+    db.expire_all()
+    assert (question_count(db, 1, 1), question_count(db, 2, 1)) == (4, 7)